@@ -1,13 +1,93 @@
+""" The public API, loaded on first use
 
-# PRIMARY FITTING FUNCTIONS
-from SparseSC.fit_loo import loo_v_matrix, loo_weights, loo_score
-from SparseSC.fit_ct import ct_v_matrix, ct_weights, ct_score
+    `import SparseSC` doesn't import the fitting modules (or numpy, SciPy and
+    scikit-learn): each name below is imported from its module the first
+    time it is looked up, so short-lived processes only pay for what they
+    use.  Python 2 and Python < 3.7 don't support a module level
+    __getattr__(), so there the names are imported eagerly.
+"""
+import sys
 
-# Public API
-from SparseSC.cross_validation import score_train_test, score_train_test_sorted_lambdas, CV_score, joint_penalty_optimzation, estimate_effects
-from SparseSC.tensor import tensor
-from SparseSC.weights import weights
-from SparseSC.lambda_utils import get_max_lambda, L2_pen_guestimate
+_PUBLIC_API = {
+    # PRIMARY FITTING FUNCTIONS
+    "loo_v_matrix": "SparseSC.fit_loo",
+    "loo_weights": "SparseSC.fit_loo",
+    "loo_score": "SparseSC.fit_loo",
+    "ct_v_matrix": "SparseSC.fit_ct",
+    "ct_weights": "SparseSC.fit_ct",
+    "ct_score": "SparseSC.fit_ct",
+    # Public API
+    "score_train_test": "SparseSC.cross_validation",
+    "score_train_test_sorted_lambdas": "SparseSC.cross_validation",
+    "CV_score": "SparseSC.cross_validation",
+    "CV_score_iter": "SparseSC.cross_validation",
+    "CV_score_racing": "SparseSC.cross_validation",
+    "joint_penalty_optimzation": "SparseSC.cross_validation",
+    "estimate_effects": "SparseSC.cross_validation",
+    "estimate_effects_batch": "SparseSC.cross_validation",
+    "estimate_effects_streaming": "SparseSC.cross_validation",
+    "tensor": "SparseSC.tensor",
+    "CompactTensor": "SparseSC.tensor",
+    "weights": "SparseSC.weights",
+    "SyntheticControl": "SparseSC.estimator",
+    "get_max_lambda": "SparseSC.lambda_utils",
+    "L2_pen_guestimate": "SparseSC.lambda_utils",
+    "adaptive_lambda_search": "SparseSC.penalty_search",
+    "joint_penalty_search": "SparseSC.penalty_search",
+    "load_panel": "SparseSC.panel",
+    "Panel": "SparseSC.panel",
+    "profile": "SparseSC.utils.instrumentation",
+    "FitStats": "SparseSC.utils.instrumentation",
+}
+
+__all__ = sorted(_PUBLIC_API)
 
 # The version as used in the setup.py
 __version__ = "0.1.0"
+
+def __getattr__(name):
+    if name not in _PUBLIC_API:
+        raise AttributeError("module 'SparseSC' has no attribute %r" % (name,))
+    import importlib
+    value = getattr(importlib.import_module(_PUBLIC_API[name]), name)
+    globals()[name] = value # later lookups don't call __getattr__()
+    return value
+
+def __dir__():
+    return sorted(set(globals()) | set(_PUBLIC_API))
+
+if sys.version_info < (3, 7):
+    for _name in _PUBLIC_API:
+        __getattr__(_name)
+else:
+    import types
+
+    class _Package(types.ModuleType):
+        """ Keeps the submodules `tensor` and `weights` from shadowing the
+            functions of the same name
+
+            When a submodule is first imported, the import system binds it
+            as an attribute of its package, e.g. looking up
+            `SC.SyntheticControl` imports SparseSC.estimator, which runs
+            `from SparseSC.tensor import tensor`, and that sets
+            `SparseSC.tensor` to the module.  A later `SC.tensor(...)` would
+            then raise "'module' object is not callable".  The module level
+            __getattr__() is only called for missing names, so it can't
+            prevent this; the binding has to be refused in __setattr__(),
+            which for a module means setting its __class__ (supported since
+            Python 3.5).
+
+            As in 0.1.0 (which imported the functions eagerly),
+            `SparseSC.tensor` and `SparseSC.weights` are always the
+            functions, so `import SparseSC.tensor as T` binds the function
+            (`import ... as` looks the name up on the package).  The
+            submodules are still in sys.modules, so `from SparseSC.tensor
+            import CompactTensor` works as usual and
+            `importlib.import_module("SparseSC.tensor")` returns the module.
+        """
+        def __setattr__(self, name, value):
+            if name in _PUBLIC_API and isinstance(value, types.ModuleType):
+                return
+            types.ModuleType.__setattr__(self, name, value)
+
+    sys.modules[__name__].__class__ = _Package
@@ -0,0 +1,214 @@
+""" Heuristics for choosing an execution plan for CV_score() and tensor()
+
+    The cost of fitting a V matrix is dominated by calls to
+    `numpy.linalg.solve()` in the gradient, and the memory requirement is
+    dominated by the (N0 x N0) system and the copies of its sub-systems made
+    for each solve (the partial derivatives are rank one and are never
+    stored).  Both can be computed from N0, N1 and K ahead of time, so a quick probe (a few gradient
+    evaluations on a small subset of the data plus a single mid-sized solve to
+    measure BLAS throughput) is enough to choose between leave-one-out and
+    k-fold gradient descent, and between process and thread based parallelism.
+"""
+import os
+import time
+import multiprocessing
+from collections import namedtuple
+import numpy as np
+from SparseSC.utils.sparse_matrix import nbytes, row_stack
+
+ExecutionPlan = namedtuple("ExecutionPlan",
+                           "parallel worker_type max_workers grad_splits lambda_chunk est_fold_seconds est_worker_bytes")
+ExecutionPlan.__doc__ = """ The execution plan chosen by autotune()
+
+    :param parallel: whether the cross validation folds are run in a worker pool
+    :param worker_type: "process" or "thread"
+    :param max_workers: number of workers in the pool
+    :param grad_splits: None for leave-one-out gradient descent, otherwise the
+        number of folds used in k-fold gradient descent (controls-only case)
+    :param lambda_chunk: number of L1 penalties submitted per task, or None to
+        submit each fold as a single task
+    :param est_fold_seconds: estimated time to fit a single fold (all penalties)
+    :param est_worker_bytes: estimated memory required by each worker
+"""
+
+# Candidate number of gradient folds, from most to least accurate
+_GRAD_SPLIT_CANDIDATES = (10, 5, 3, 2)
+
+def _physical_memory():
+    """ total physical memory in bytes, or None if it cannot be determined """
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+def _gradient_cost(N0, N1, K, grad_splits=None, treated=False):
+    """ Returns the number of `linalg.solve()` calls, the (approximate) number
+        of floating point operations and the bytes required for the linear
+        systems of a single gradient evaluation.
+    """
+    if treated:
+        # ct_v_matrix: one N0 x N0 system with N1 right hand sides per moment
+        n_solves = K + 1
+        flops = n_solves * (N0 ** 3 / 3. + N0 ** 2 * N1)
+        nbytes = 8. * (2 * N0 * N0 + 2 * N0 * N1)
+    elif grad_splits is None:
+        # loo_v_matrix: one (N0-1) x (N0-1) system per treated unit and moment
+        n = N0 - 1
+        n_solves = N1 * (K + 1)
+        flops = n_solves * (n ** 3 / 3. + n ** 2)
+        nbytes = 8. * (N0 * N0 + 2 * n * n + 2 * n)
+    else:
+        # fold_v_matrix: one system per gradient fold and moment
+        n_test = N1 / float(grad_splits)
+        n = N0 - n_test
+        n_solves = grad_splits * (K + 1)
+        flops = n_solves * (n ** 3 / 3. + n ** 2 * n_test)
+        nbytes = 8. * (N0 * N0 + 2 * n * n + 2 * n * n_test)
+    return n_solves, flops, nbytes
+
+def _probe(X, Y, X_treat, Y_treat, n_probe, n_probe_evals):
+    """ Times a few gradient evaluations on a small subset of the data and a
+        single mid-sized solve; returns the per-solve overhead (seconds) and
+        the BLAS throughput (flops / second).
+    """
+    from SparseSC.fit_loo import loo_v_matrix
+    from SparseSC.fit_ct import ct_v_matrix
+
+    n = max(3, min(n_probe, X.shape[0]))
+    if X_treat is not None:
+        n_t = max(1, min(n_probe, X_treat.shape[0]))
+    best = np.inf
+    for _ in range(n_probe_evals):
+        t0 = time.time()
+        try:
+            if X_treat is None:
+                loo_v_matrix(X[:n, :], Y[:n, :], max_lambda=True)
+            else:
+                ct_v_matrix(row_stack(X[:n, :], X_treat[:n_t, :]),
+                            np.vstack((Y[:n, :], Y_treat[:n_t, :])),
+                            control_units=np.arange(n),
+                            treated_units=np.arange(n_t) + n,
+                            max_lambda=True)
+        except ValueError:
+            # the gradient at the origin had no negative elements; the timing
+            # is still valid
+            pass
+        best = min(best, time.time() - t0)
+    if X_treat is None:
+        n_solves, _, _ = _gradient_cost(n, n, X.shape[1])
+    else:
+        n_solves, _, _ = _gradient_cost(n, n_t, X.shape[1], treated=True)
+    overhead = best / n_solves
+
+    # BLAS THROUGHPUT
+    m = 400
+    A = np.random.random((m, m))
+    A = A.dot(A.T) + m * np.eye(m)
+    b = np.random.random((m, 1))
+    t0 = time.time()
+    np.linalg.solve(A, b)
+    rate = (m ** 3 / 3.) / max(time.time() - t0, 1e-6)
+    return overhead, rate
+
+def autotune(X, Y, LAMBDA=None, X_treat=None, Y_treat=None, splits=5,
+             cache=False, memory_limit=None, n_grad_evals=25,
+             max_grad_seconds=30., min_parallel_seconds=2., large_n=500,
+             n_probe=25, n_probe_evals=3):
+    """ Chooses an execution plan for CV_score() or tensor() from the size of
+        the problem and a quick probe of the machine.
+
+    :param X: Matrix of Covariates (control units)
+    :param Y: Matrix of Outcomes (control units)
+    :param LAMBDA: L1 penalty or iterable of L1 penalties to be scored
+    :param X_treat: Matrix of Covariates (treated units) or None
+    :param Y_treat: Matrix of Outcomes (treated units) or None
+    :param splits: number of cross validation folds, or None when planning a
+        single fit on all the data (i.e. tensor())
+    :param cache: If True the V matrix is cached between penalties, in which
+        case the penalties for a single fold are never split across tasks
+    :param memory_limit: bytes available for the fit.  Defaults to half of the
+        physical memory (or 4GB if that can't be determined)
+    :param n_grad_evals: assumed number of gradient evaluations per fit
+    :param max_grad_seconds: leave-one-out gradient descent is only chosen when
+        a single gradient is expected to take less than this many seconds
+    :param min_parallel_seconds: folds are only run in parallel when a single
+        fold is expected to take at least this many seconds
+    :param large_n: training sets with at least this many units use threads
+        (which share memory, and spend most of their time in BLAS calls which
+        release the GIL) rather than processes
+    :param n_probe: number of units used when probing gradient evaluations
+    :param n_probe_evals: number of probe gradient evaluations (at least one)
+
+    :return: the chosen plan
+    :rtype: ExecutionPlan
+    """
+    # PARAMETER QC
+    if n_probe_evals < 1:
+        raise ValueError("n_probe_evals must be at least 1, got %s" % (n_probe_evals,))
+
+    if memory_limit is None:
+        memory_limit = _physical_memory()
+        memory_limit = 4 * 2 ** 30 if memory_limit is None else memory_limit / 2
+
+    try:
+        n_lambda = len(LAMBDA)
+    except TypeError:
+        n_lambda = 1
+
+    K = X.shape[1]
+    if X_treat is None:
+        N = X.shape[0]
+    else:
+        N = X_treat.shape[0]
+    if splits is None:
+        n_splits = 1
+        n_train = N
+    else:
+        try:
+            n_splits = len(list(splits))
+        except TypeError:
+            n_splits = splits
+        n_train = int(np.ceil(N * (n_splits - 1) / float(n_splits))) if n_splits > 1 else N
+
+    overhead, rate = _probe(X, Y, X_treat, Y_treat, n_probe, n_probe_evals)
+
+    def grad_seconds(n_solves, flops):
+        return n_solves * overhead + flops / rate
+
+    # CHOOSE THE GRADIENT DESCENT METHOD
+    if X_treat is not None:
+        grad_splits = None
+        n_solves, flops, worker_bytes = _gradient_cost(X.shape[0], n_train, K, treated=True)
+    else:
+        grad_splits = None
+        n_solves, flops, worker_bytes = _gradient_cost(n_train, n_train, K)
+        if worker_bytes > memory_limit or grad_seconds(n_solves, flops) > max_grad_seconds:
+            for grad_splits in _GRAD_SPLIT_CANDIDATES:
+                n_solves, flops, worker_bytes = _gradient_cost(n_train, n_train, K, grad_splits)
+                if worker_bytes <= memory_limit:
+                    break
+    est_fold_seconds = grad_seconds(n_solves, flops) * n_grad_evals * n_lambda
+
+    # CHOOSE THE PARALLEL STRATEGY
+    cpu_count = multiprocessing.cpu_count()
+    worker_type = "thread" if n_train >= large_n else "process"
+    if worker_type == "process":
+        # each process gets its own copy of the data
+        worker_bytes += nbytes(X) + nbytes(Y)
+        if X_treat is not None:
+            worker_bytes += nbytes(X_treat) + nbytes(Y_treat)
+    lambda_chunk = None
+    max_workers = min(max(cpu_count - 2, 1), n_splits, max(1, int(memory_limit // max(worker_bytes, 1))))
+    parallel = (n_splits > 1 and max_workers > 1 and est_fold_seconds >= min_parallel_seconds)
+    if parallel and n_lambda > 1 and not cache:
+        # spread the penalties for each fold across the remaining cores
+        chunks_per_fold = min(n_lambda, max(1, (max(cpu_count - 2, 1)) // n_splits))
+        if chunks_per_fold > 1:
+            lambda_chunk = int(np.ceil(n_lambda / float(chunks_per_fold)))
+            max_workers = min(max(cpu_count - 2, 1), n_splits * chunks_per_fold,
+                              max(1, int(memory_limit // max(worker_bytes, 1))))
+    if not parallel:
+        max_workers = None
+
+    return ExecutionPlan(parallel, worker_type, max_workers, grad_splits, lambda_chunk,
+                         est_fold_seconds, worker_bytes)
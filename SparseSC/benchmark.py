@@ -0,0 +1,308 @@
+""" A benchmark suite for the fitting paths
+
+    Each case (a fitting function called the way the public API calls it) is
+    run on data drawn from `tests.ge_dgp()` or `tests.factor_dgp()` at every
+    point of a scaling grid over the number of control units (N0), treated
+    units (N1), covariates (K) and pre-/post-periods (T).  For each run the
+    suite records the (best of `repeat`) wall time, and from a separate run
+    the peak memory allocated (via `tracemalloc`) and the number of calls to
+    the linear algebra routines which dominate the cost (`numpy.linalg.solve`,
+    `numpy.linalg.eigh` and `scipy.linalg.lu_factor`).  The parallel
+    CV_score() case runs in a process pool, so only its wall time is
+    recorded.
+
+    The results are written as JSON, and a stored baseline can be compared
+    against to flag regressions:
+
+        python -m SparseSC.benchmark --grid quick --output baseline.json
+        python -m SparseSC.benchmark --grid quick --baseline baseline.json
+
+    which exits with a non-zero status if any case got slower, used more
+    memory or made more solves than the baseline allows.
+"""
+import os
+import sys
+import json
+import time
+import timeit
+import platform
+import argparse
+import tracemalloc
+from contextlib import contextmanager, redirect_stdout
+import numpy as np
+
+def _scaling_grid(base, axes):
+    """ The base configuration plus each configuration which changes a single
+        axis of it
+    """
+    grid = [dict(base)]
+    for axis, values in axes:
+        for value in values:
+            config = dict(base, **{axis: value})
+            if config not in grid:
+                grid.append(config)
+    return grid
+
+GRIDS = {
+    "quick": _scaling_grid({"N0": 20, "N1": 5, "K": 6, "T": 6},
+                           [("N0", (40,)), ("N1", (10,)), ("K", (12,)), ("T", (12,))]),
+    "full": _scaling_grid({"N0": 50, "N1": 10, "K": 10, "T": 10},
+                          [("N0", (100, 200, 400)), ("N1", (50,)), ("K", (40, 160)), ("T", (40,))]),
+}
+
+def _data(config, dgp, seed):
+    """ Draws a panel and the (untimed) penalties and V used by the cases """
+    from SparseSC.tests import ge_dgp, factor_dgp
+    from SparseSC.lambda_utils import get_max_lambda, L2_pen_guestimate
+    np.random.seed(seed)
+    N0, N1, K, T = config["N0"], config["N1"], config["K"], config["T"]
+    if dgp == "ge":
+        # half causal covariates, a quarter confounders and a quarter noise
+        S = K // 4
+        X_c, X_t, Y_pre_c, Y_pre_t, Y_post_c, Y_post_t = \
+            ge_dgp(N0, N1, T, T, K - K // 2 - S, S, K // 2, 1, 2, 4, 1)
+    elif dgp == "factor":
+        X_c, X_t, Y_pre_c, Y_pre_t, Y_post_c, Y_post_t = factor_dgp(N0, N1, T, T, K - K // 2, K // 2, 2)
+    else:
+        raise ValueError("Unknown dgp: %s" % dgp)
+    X = np.asarray(np.vstack((X_c, X_t)))
+    Y_pre = np.asarray(np.vstack((Y_pre_c, Y_pre_t)))
+    Y_post = np.asarray(np.vstack((Y_post_c, Y_post_t)))
+    d = {"X": X,
+         "Y_pre": Y_pre,
+         "Y_post": Y_post,
+         # covariates and pre-period outcomes, as in estimate_effects()
+         "X_and_Y_pre": np.hstack((X, Y_pre)),
+         "control_units": np.arange(N0),
+         "treated_units": np.arange(N1) + N0}
+    d["X_c"] = d["X_and_Y_pre"][:N0]
+    d["Y_c"] = Y_post[:N0]
+    d["L2_PEN_W"] = L2_pen_guestimate(d["X_c"])
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        d["LAMBDA"] = 0.1 * get_max_lambda(d["X_c"], d["Y_c"], L2_PEN_W=d["L2_PEN_W"])
+    v = np.random.exponential(1, d["X_c"].shape[1])
+    v[np.random.random(len(v)) < 0.5] = 0
+    d["V"] = np.diag(v)
+    return d
+
+def _ct_v_matrix(d):
+    from SparseSC.fit_ct import ct_v_matrix
+    ct_v_matrix(d["X_and_Y_pre"], d["Y_post"], LAMBDA=d["LAMBDA"], L2_PEN_W=d["L2_PEN_W"],
+                treated_units=d["treated_units"], control_units=d["control_units"])
+
+def _loo_v_matrix(d):
+    from SparseSC.fit_loo import loo_v_matrix
+    loo_v_matrix(d["X_c"], d["Y_c"], LAMBDA=d["LAMBDA"], L2_PEN_W=d["L2_PEN_W"])
+
+def _fold_v_matrix(d):
+    from SparseSC.fit_fold import fold_v_matrix
+    fold_v_matrix(d["X_c"], d["Y_c"], LAMBDA=d["LAMBDA"], L2_PEN_W=d["L2_PEN_W"], grad_splits=5)
+
+def _ct_weights(d):
+    from SparseSC.fit_ct import ct_weights
+    ct_weights(d["X_and_Y_pre"], d["V"], d["L2_PEN_W"],
+               treated_units=d["treated_units"], control_units=d["control_units"])
+
+def _loo_weights(d):
+    from SparseSC.fit_loo import loo_weights
+    loo_weights(d["X_c"], d["V"], d["L2_PEN_W"])
+
+def _fold_weights(d):
+    from SparseSC.fit_fold import fold_weights
+    fold_weights(d["X_c"], d["V"], d["L2_PEN_W"], grad_splits=5)
+
+def _cv_score(d):
+    from SparseSC.cross_validation import CV_score
+    CV_score(d["X_c"], d["Y_c"], LAMBDA=d["LAMBDA"], L2_PEN_W=d["L2_PEN_W"], splits=3, quiet=True)
+
+def _cv_score_parallel(d):
+    from SparseSC.cross_validation import CV_score
+    CV_score(d["X_c"], d["Y_c"], LAMBDA=d["LAMBDA"], L2_PEN_W=d["L2_PEN_W"], splits=3, quiet=True,
+             parallel=True, max_workers=2)
+
+def _get_max_lambda(d):
+    from SparseSC.lambda_utils import get_max_lambda
+    get_max_lambda(d["X_c"], d["Y_c"], L2_PEN_W=d["L2_PEN_W"])
+
+def _estimate_effects(d):
+    from SparseSC.cross_validation import estimate_effects
+    estimate_effects(d["X"], d["Y_pre"], d["Y_post"], d["treated_units"],
+                     V_penalty=d["LAMBDA"], W_penalty=d["L2_PEN_W"], max_n_pl=1000, seed=0)
+
+# name -> (function, whether it runs in this process)
+CASES = {
+    "ct_v_matrix": (_ct_v_matrix, True),
+    "loo_v_matrix": (_loo_v_matrix, True),
+    "fold_v_matrix": (_fold_v_matrix, True),
+    "ct_weights": (_ct_weights, True),
+    "loo_weights": (_loo_weights, True),
+    "fold_weights": (_fold_weights, True),
+    "CV_score": (_cv_score, True),
+    "CV_score_parallel": (_cv_score_parallel, False),
+    "get_max_lambda": (_get_max_lambda, True),
+    "estimate_effects": (_estimate_effects, True),
+}
+
+@contextmanager
+def _count_solves():
+    """ Counts the calls to the dense solvers and factorizations used by the
+        fitting functions
+    """
+    import scipy.linalg
+    counts = {}
+    patched = []
+    def count(module, name):
+        original = getattr(module, name)
+        def counted(*args, **kwargs):
+            counts[name] = counts.get(name, 0) + 1
+            return original(*args, **kwargs)
+        setattr(module, name, counted)
+        patched.append((module, name, original))
+    count(np.linalg, "solve")
+    count(np.linalg, "eigh")
+    count(scipy.linalg, "lu_factor")
+    try:
+        yield counts
+    finally:
+        for module, name, original in reversed(patched):
+            setattr(module, name, original)
+
+def run_benchmarks(grid="quick", cases=None, dgp="ge", repeat=3, seed=12345, quiet=True):
+    """ Runs the benchmark suite
+
+    :param grid: the name of a grid in GRIDS, or a list of dicts with the
+        keys N0, N1, K and T
+    :param cases: names of the cases to run (default: all of CASES)
+    :param dgp: "ge" (tests.ge_dgp) or "factor" (tests.factor_dgp)
+    :param repeat: number of timed runs of each case (the minimum is kept)
+    :param seed: seed for the data generating process
+    :param quiet: If False, print each result as it completes
+    :return: a list of dicts with the case, the configuration, `seconds`,
+        `peak_bytes` and `solves` (None for cases run in other processes)
+    """
+    if isinstance(grid, str):
+        if grid not in GRIDS:
+            raise ValueError("Unknown grid: %s" % grid)
+        grid = GRIDS[grid]
+    if cases is None:
+        cases = sorted(CASES)
+    for case in cases:
+        if case not in CASES:
+            raise ValueError("Unknown case: %s" % case)
+    if repeat < 1:
+        raise ValueError("repeat must be positive")
+
+    results = []
+    warm = set()
+    for config in grid:
+        d = _data(config, dgp, seed)
+        for case in cases:
+            fun, in_process = CASES[case]
+            with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+                if case not in warm:
+                    # the first call imports the modules the case uses
+                    fun(d)
+                    warm.add(case)
+                seconds = []
+                for _ in range(repeat):
+                    start = timeit.default_timer()
+                    fun(d)
+                    seconds.append(timeit.default_timer() - start)
+                peak_bytes = solves = None
+                if in_process:
+                    with _count_solves() as solves:
+                        tracemalloc.start()
+                        try:
+                            fun(d)
+                            peak_bytes = tracemalloc.get_traced_memory()[1]
+                        finally:
+                            tracemalloc.stop()
+            result = dict(config, case=case, seconds=min(seconds), peak_bytes=peak_bytes, solves=solves)
+            results.append(result)
+            if not quiet:
+                print("%-18s N0=%-4s N1=%-4s K=%-4s T=%-4s %9.4fs %12s bytes %s" %
+                      (case, config["N0"], config["N1"], config["K"], config["T"],
+                       result["seconds"], peak_bytes, solves))
+    return results
+
+def _key(result):
+    return (result["case"], result["N0"], result["N1"], result["K"], result["T"])
+
+def compare(results, baseline, tolerance=0.25, min_seconds=0.01):
+    """ Compares results with a baseline
+
+    :param results: results of run_benchmarks()
+    :param baseline: the baseline results (as written by main())
+    :param tolerance: allowed relative increase in the wall time and peak memory
+    :param min_seconds: increases in wall time smaller than this are ignored
+        as noise
+    :return: a list of the regressions, as dicts with the case, the
+        configuration, the metric and its baseline and current values
+    """
+    baseline = dict((_key(r), r) for r in baseline)
+    regressions = []
+    for result in results:
+        base = baseline.get(_key(result))
+        if base is None:
+            continue
+        checks = [("seconds", result["seconds"] > base["seconds"] * (1 + tolerance) and
+                              result["seconds"] - base["seconds"] > min_seconds)]
+        if result["peak_bytes"] is not None and base["peak_bytes"] is not None:
+            checks.append(("peak_bytes", result["peak_bytes"] > base["peak_bytes"] * (1 + tolerance)))
+        if result["solves"] is not None and base["solves"] is not None:
+            checks.append(("solves", sum(result["solves"].values()) > sum(base["solves"].values())))
+        for metric, regressed in checks:
+            if regressed:
+                regression = dict((k, result[k]) for k in ("case", "N0", "N1", "K", "T"))
+                regression.update(metric=metric, baseline=base[metric], current=result[metric])
+                regressions.append(regression)
+    return regressions
+
+def _environment():
+    import scipy
+    from SparseSC import __version__
+    return {"SparseSC": __version__,
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "scipy": scipy.__version__,
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "cpu_count": os.cpu_count(),
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+def main(argv=None):
+    """ Command line entry point; see `python -m SparseSC.benchmark --help` """
+    parser = argparse.ArgumentParser(prog="python -m SparseSC.benchmark", description=__doc__.split("\n")[0].strip(),
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--grid", default="quick", choices=sorted(GRIDS))
+    parser.add_argument("--cases", default=None, help="comma separated names of the cases to run: %s" % ", ".join(sorted(CASES)))
+    parser.add_argument("--dgp", default="ge", choices=["ge", "factor"])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=12345)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare the results with this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args(argv)
+
+    cases = args.cases.split(",") if args.cases else None
+    results = run_benchmarks(args.grid, cases, args.dgp, args.repeat, args.seed, quiet=False)
+    report = {"environment": _environment(),
+              "settings": {"grid": args.grid, "dgp": args.dgp, "repeat": args.repeat, "seed": args.seed},
+              "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline["results"], args.tolerance)
+        for r in regressions:
+            print("REGRESSION: %(case)s (N0=%(N0)s, N1=%(N1)s, K=%(K)s, T=%(T)s) %(metric)s: %(baseline)s -> %(current)s" % r)
+        if regressions:
+            return 1
+        print("No regressions against %s" % args.baseline)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,10 +3,15 @@ from SparseSC.fit_loo import  loo_v_matrix, loo_score, loo_weights
 from SparseSC.fit_ct import  ct_v_matrix, ct_score
 #-- from SparseSC.optimizers.cd_line_search import cdl_search
 from SparseSC.lambda_utils import get_max_lambda, L2_pen_guestimate
-import atexit
+from SparseSC.autotune import autotune as _autotune, ExecutionPlan
+from SparseSC.placebo import _gen_placebo_stats_from_diffs, _gen_placebo_stats_from_diff_blocks
+from SparseSC.utils.validation import as_float_array
+from SparseSC.utils.sparse_matrix import mean_var
+from SparseSC.utils.result_cache import fingerprint, as_result_cache
+from SparseSC.utils.instrumentation import profiling, report, call_profiled
+import os
 import numpy as np
 import itertools
-from concurrent import futures
 import warnings
 from collections import namedtuple
 
@@ -18,11 +23,47 @@ def score_train_test(X,
                      Y_treat=None,
                      FoldNumber=None, # For consistency with score_train_test_sorted_lambdas()
                      grad_splits=None, #  If present, use  k fold gradient descent. See fold_v_matrix for details
+                     dtype=np.float64,
+                     refine=0,
+                     result_cache=None,
                      **kwargs):
     """ presents a unified api for ct_v_matrix and loo_v_matrix
         and returns the v_mat, l2_pen_w (possibly calculated, possibly a parameter), and the score 
+
+    :param dtype: floating point type used to fit V and compute the
+        out-of-sample weights (see SparseSC.utils.mixed_precision)
+    :param refine: number of steps of iterative refinement for the
+        out-of-sample weights
+    :param result_cache: a SparseSC.utils.result_cache.ResultCache (or the
+        path of a cache directory) in which the result is looked up and
+        stored, keyed by a fingerprint of the arguments
     """
+    if result_cache is not None:
+        result_cache = as_result_cache(result_cache)
+        key = fingerprint("score_train_test", X, Y, train, test, X_treat, Y_treat, grad_splits,
+                          np.dtype(dtype).str, refine, kwargs)
+        result = result_cache.get(key)
+        if result is None:
+            result = score_train_test(X, Y, train, test, X_treat, Y_treat, FoldNumber, grad_splits,
+                                      dtype, refine, **kwargs)
+            result_cache.put(key, result)
+        return result
+
     # to use `pdb.set_trace()` here, set `parallel = False` above
+    fold = _fold_problem(X, Y, train, test, X_treat, Y_treat, grad_splits, kwargs.pop("L2_PEN_W", None))
+    return _score_fold(fold, dtype, refine, **kwargs)
+
+
+_FoldProblem = namedtuple("_FoldProblem", "fit score L2_PEN_W")
+
+def _fold_problem(X, Y, train, test, X_treat=None, Y_treat=None, grad_splits=None, L2_PEN_W=None):
+    """ Validates the data for a fold of score_train_test() and copies (or
+        stacks) the training rows once, so that the fits for every L1 penalty
+        share the same arrays
+
+    :return: a _FoldProblem with the arguments of the V-matrix fit and of the
+        out-of-sample score, and the (default) L2_PEN_W
+    """
     if X_treat is None != Y_treat is None:
         raise ValueError("parameters `X_treat` and `Y_treat` must both be Matrices or None")
 
@@ -30,14 +71,10 @@ def score_train_test(X,
         # >> K-fold validation on the Treated units; assuming that Y and Y_treat are pre-intervention outcomes
 
         # PARAMETER QC
-        try:
-            X = np.asmatrix(X)
-        except ValueError:
-            raise ValueError("X is not coercible to a matrix")
-        try:
-            Y = np.asmatrix(Y)
-        except ValueError:
-            raise ValueError("Y is not coercible to a matrix")
+        X = as_float_array(X, "X")
+        Y = as_float_array(Y, "Y")
+        X_treat = as_float_array(X_treat, "X_treat")
+        Y_treat = as_float_array(Y_treat, "Y_treat")
         if X_treat.shape[1] == 0:
             raise ValueError("X_treat.shape[1] == 0")
         if Y_treat.shape[1] == 0:
@@ -46,72 +83,59 @@ def score_train_test(X,
             raise ValueError("X_treat and Y_treat have different number of rows (%s and %s)" % 
                              (X.shape[0], Y.shape[0],))
 
-        # FIT THE V-MATRIX AND POSSIBLY CALCULATE THE L2_PEN_W
-        # note that the weights, score, and loss function value returned here are for the in-sample predictions
-        _, v_mat, _, _, l2_pen_w, _ = \
-                    ct_v_matrix(X = np.vstack((X,X_treat[train, :])),
-                                Y = np.vstack((Y,Y_treat[train, :])),
-                                treated_units = [X.shape[0] + i for i in  range(len(train))],
-                                # method = cdl_search,
-                                **kwargs)
-
-        # GET THE OUT-OF-SAMPLE PREDICTION ERROR
-        s = ct_score(X = np.vstack((X,X_treat[test, :])),
-                     Y = np.vstack((Y,Y_treat[test, :])), 
-                     treated_units = [X.shape[0] + i for i in  range(len(test))],
-                     V = v_mat,
-                     L2_PEN_W = l2_pen_w)
-
-    else: # X_treat *is* None
-        # >> K-fold validation on the only control units; assuming that Y contains post-intervention outcomes 
-        if grad_splits is not None:
+        # the treated units are stacked below the controls and indexed by the fit and the score
+        controls = np.arange(X.shape[0])
+        train = X.shape[0] + np.asarray(train)
+        test = X.shape[0] + np.asarray(test)
+        X = np.vstack((X, X_treat))
+        Y = np.vstack((Y, Y_treat))
+        if L2_PEN_W is None:
+            L2_PEN_W = mean_var(X[np.concatenate((controls, train)), :])
+        return _FoldProblem(dict(fitter = ct_v_matrix, X = X, Y = Y, treated_units = train, control_units = controls),
+                            dict(X = X, Y = Y, treated_units = test, control_units = controls),
+                            L2_PEN_W)
+
+    # >> K-fold validation on the only control units; assuming that Y contains post-intervention outcomes 
+    fit = dict(fitter = loo_v_matrix, X = X[train, :], Y = Y[train, :])
+    if grad_splits is not None:
+        try:
+            iter(grad_splits)
+        except TypeError:
+            # not iterable
+            pass
+        else:
+            # TRIM THE GRAD SPLITS NEED TO THE TRAINING SET
+            match = lambda a, b: np.concatenate([np.where(a == x)[0] for x in b])# inspired by R's match() function
+            grad_splits = [ (match(train,_X),match(train,_Y) ) for _X,_Y in grad_splits]
+        fit.update(fitter = fold_v_matrix, grad_splits = grad_splits)
+    return _FoldProblem(fit, dict(X = X, Y = Y, treated_units = test), L2_PEN_W)
 
 
-            try:
-                iter(grad_splits)
-            except TypeError:
-                # not iterable
-                pass
-            else:
-                # TRIM THE GRAD SPLITS NEED TO THE TRAINING SET
-                match = lambda a, b: np.concatenate([np.where(a == x)[0] for x in b])# inspired by R's match() function
-                grad_splits = [ (match(train,_X),match(train,_Y) ) for _X,_Y in grad_splits]
-
-            # FIT THE V-MATRIX AND POSSIBLY CALCULATE THE L2_PEN_W
-            # note that the weights, score, and loss function value returned here are for the in-sample predictions
-            _, v_mat, _, _, l2_pen_w, _ = \
-                    fold_v_matrix(X = X[train, :],
-                                  Y = Y[train, :], 
-                                  # treated_units = [X.shape[0] + i for i in  range(len(train))],
-                                  # method = cdl_search,
-                                  grad_splits = grad_splits,
-                                  **kwargs)
-
-            # GET THE OUT-OF-SAMPLE PREDICTION ERROR (could also use loo_score, actually...)
-            s = ct_score(X = X, Y = Y,  # formerly: fold_score
-                           treated_units = test,
-                           V = v_mat,
-                           L2_PEN_W = l2_pen_w)
-
-        else:
+def _score_fold(fold, dtype=np.float64, refine=0, **kwargs):
+    """ Fits V for a _FoldProblem and returns the v_mat, l2_pen_w and the
+        out-of-sample score, as for score_train_test()
+    """
+    fit = dict(fold.fit)
+    fitter = fit.pop("fitter")
 
-            # FIT THE V-MATRIX AND POSSIBLY CALCULATE THE L2_PEN_W
-            # note that the weights, score, and loss function value returned here are for the in-sample predictions
-            try:
-                _, v_mat, _, _, l2_pen_w, _ = \
-                        loo_v_matrix(X = X[train, :],
-                                     Y = Y[train, :], 
-                                     # treated_units = [X.shape[0] + i for i in  range(len(train))],
-                                     # method = cdl_search,
-                                     **kwargs)
-            except MemoryError as err:
-                raise RuntimeError("MemoryError encountered.  Try setting `grad_splits` parameter to reduce memory requirements.")
-
-            # GET THE OUT-OF-SAMPLE PREDICTION ERROR
-            s = ct_score(X = X, Y = Y, 
-                          treated_units = test,
-                          V = v_mat,
-                          L2_PEN_W = l2_pen_w)
+    # FIT THE V-MATRIX AND POSSIBLY CALCULATE THE L2_PEN_W
+    # note that the weights, score, and loss function value returned here are for the in-sample predictions
+    try:
+        _, v_mat, _, _, l2_pen_w, _ = fitter(L2_PEN_W = fold.L2_PEN_W,
+                                             # method = cdl_search,
+                                             dtype = dtype,
+                                             **dict(fit, **kwargs))
+    except MemoryError as err:
+        if fitter is not loo_v_matrix:
+            raise
+        raise RuntimeError("MemoryError encountered.  Try setting `grad_splits` parameter to reduce memory requirements.")
+
+    # GET THE OUT-OF-SAMPLE PREDICTION ERROR (formerly: fold_score for the gradient folds)
+    s = ct_score(V = v_mat,
+                 L2_PEN_W = l2_pen_w,
+                 dtype = dtype,
+                 refine = refine,
+                 **fold.score)
 
     return v_mat, l2_pen_w, s
 
@@ -121,21 +145,38 @@ def score_train_test_sorted_lambdas(LAMBDA,
                                     cache=False,
                                     progress=False,
                                     FoldNumber=None,
+                                    ret_times=False,
                                     **kwargs):
     """ a wrapper which calls  score_train_test() for each element of an
         array of `LAMBDA`'s, optionally caching the optimized v_mat and using it
         as the start position for the next iteration.
+
+        If `ret_times` is True, a fourth list containing the time (in seconds)
+        spent on each element of `LAMBDA` is also returned.
     """
 
     # DEFAULTS
     values = [None]*len(LAMBDA)
+    times = [None]*len(LAMBDA)
+
+    if kwargs.get("result_cache") is None:
+        # VALIDATE AND COPY THE FOLD ONCE, OUTSIDE THE LOOP OVER LAMBDA
+        fold_args = dict(kwargs)
+        fold_args.pop("result_cache", None)
+        fold = _fold_problem(*[fold_args.pop(name, None) for name in
+                               ("X", "Y", "train", "test", "X_treat", "Y_treat", "grad_splits", "L2_PEN_W")])
+        score = lambda **kw: _score_fold(fold, **dict(fold_args, **kw))
+    else:
+        score = lambda **kw: score_train_test(**dict(kwargs, **kw))
 
+    import time
     if progress > 0:
-        import time
         t0 = time.time()
 
     for i,Lam in enumerate(LAMBDA):
-        v_mat, _, _ = values[i] = score_train_test( LAMBDA = Lam, start = start, **kwargs)
+        t_start = time.time()
+        v_mat, _, _ = values[i] = score( LAMBDA = Lam, start = start)
+        times[i] = time.time() - t_start
 
         if cache: 
             start = np.diag(v_mat)
@@ -153,31 +194,22 @@ def score_train_test_sorted_lambdas(LAMBDA,
                 #      (FoldNumber, i+1, len(LAMBDA), t1 - t0, Lam, np.diag(v_mat),))
             t0 = time.time() 
 
+    if ret_times:
+        return list(zip(*values)) + [times]
     return list(zip(*values))
 
 
-def CV_score(X,Y,
-             LAMBDA,
-             X_treat=None,
-             Y_treat=None,
-             splits=5,
-             sub_splits=None, # ignore pylint -- this is here for consistency...
-             quiet=False,
-             parallel=False,
-             max_workers=None,
-             **kwargs):
-    """ Cross fold validation for 1 or more L1 Penalties, holding the L2 penalty fixed. 
+CVFoldResult = namedtuple("CVFoldResult", "fold lambda_index LAMBDA score v_mat l2_pen_w seconds")
+CVFoldResult.__doc__ = """ The result of fitting a single fold for a single L1 penalty; yielded by CV_score_iter() """
+
+
+def _CV_setup(X, Y, LAMBDA, X_treat, Y_treat, splits, quiet):
+    """ Parameter QC and fold construction shared by CV_score() and CV_score_iter()
     """
 
     # PARAMETER QC
-    try:
-        X = np.asmatrix(X)
-    except ValueError:
-        raise ValueError("X is not coercible to a matrix")
-    try:
-        Y = np.asmatrix(Y)
-    except ValueError:
-        raise ValueError("X is not coercible to a matrix")
+    X = as_float_array(X, "X")
+    Y = as_float_array(Y, "Y")
     if X_treat is None != Y_treat is None:
         raise ValueError("parameters `X_treat` and `Y_treat` must both be Matrices or None")
     if X.shape[1] == 0:
@@ -188,23 +220,20 @@ def CV_score(X,Y,
         raise ValueError("X and Y have different number of rows (%s and %s)" % (X.shape[0], Y.shape[0],))
 
     try:
-        _LAMBDA = iter(LAMBDA)
+        iter(LAMBDA)
     except TypeError:
         # Lambda is a single value 
         multi_lambda = False
-        __score_train_test__ = score_train_test
     else:
         # Lambda is an iterable of values
         multi_lambda = True
-        __score_train_test__ = score_train_test_sorted_lambdas
+        LAMBDA = list(LAMBDA)
 
     if X_treat is not None:
 
         # PARAMETER QC
-        if not isinstance(X_treat, np.matrix):
-            raise TypeError("X_treat is not a matrix")
-        if not isinstance(Y_treat, np.matrix):
-            raise TypeError("Y_treat is not a matrix")
+        X_treat = as_float_array(X_treat, "X_treat", TypeError)
+        Y_treat = as_float_array(Y_treat, "Y_treat", TypeError)
         if X_treat.shape[1] == 0:
             raise ValueError("X_treat.shape[1] == 0")
         if Y_treat.shape[1] == 0:
@@ -217,7 +246,7 @@ def CV_score(X,Y,
             iter(splits)
         except TypeError: 
             from sklearn.model_selection import KFold
-            splits = KFold(splits,True).split(np.arange(X_treat.shape[0]))
+            splits = KFold(splits, shuffle=True).split(np.arange(X_treat.shape[0]))
         train_test_splits = list(splits)
         n_splits = len(train_test_splits)
 
@@ -226,53 +255,6 @@ def CV_score(X,Y,
             print("%s-fold validation with %s control and %s treated units %s predictors and %s outcomes, holding out one fold among Treated units; Assumes that `Y` and `Y_treat` are pre-intervention outcomes" % 
                   (n_splits, X.shape[0] , X_treat.shape[0],X.shape[1],Y.shape[1],))
 
-        if parallel: 
-
-            if max_workers is None:
-                # CALCULATE A DEFAULT FOR MAX_WORKERS
-                import multiprocessing
-                multiprocessing.cpu_count()
-                if n_splits == 1:
-                    print("WARNING: Using Parallel options with a single split is expected reduce performance")
-                max_workers = min(max(multiprocessing.cpu_count() - 2,1),len(train_test_splits))
-                if max_workers == 1 and n_splits > 1:
-                    print("WARNING: Default for max_workers is 1 on a machine with %s cores is 1.")
-
-            _initialize_Global_worker_pool(max_workers)
-
-            try:
-
-                promises = [ _worker_pool.submit(__score_train_test__,
-                                                 X = X,
-                                                 Y = Y,
-                                                 LAMBDA = LAMBDA,
-                                                 X_treat = X_treat, 
-                                                 Y_treat = Y_treat, 
-                                                 train = train,
-                                                 test = test,
-                                                 FoldNumber = fold,
-                                                 **kwargs)
-                             for fold, (train,test) in enumerate(train_test_splits) ] 
-                results = [ promise.result() for promise in futures.as_completed(promises)]
-
-            finally:
-
-                _clean_up_worker_pool()
-
-        else:
-
-            results = [ __score_train_test__(X = X,
-                                             Y = Y,
-                                             X_treat = X_treat, 
-                                             Y_treat = Y_treat, 
-                                             LAMBDA = LAMBDA,
-                                             train = train,
-                                             test = test,
-                                             FoldNumber = fold,
-                                             **kwargs)
-                        for fold, (train,test) in enumerate(train_test_splits) ] 
-
-
     else: # X_treat *is* None
 
         try:
@@ -288,60 +270,311 @@ def CV_score(X,Y,
             print("%s-fold Cross Validation with %s control units, %s predictors and %s outcomes; Y may contain post-intervention outcomes" % 
                   (n_splits, X.shape[0],X.shape[1],Y.shape[1],) )
 
-        if parallel: 
+    return X, Y, X_treat, Y_treat, LAMBDA, multi_lambda, train_test_splits
 
-            if max_workers is None:
-                # CALCULATE A DEFAULT FOR MAX_WORKERS
-                import multiprocessing
-                multiprocessing.cpu_count()
-                if n_splits == 1:
-                    print("WARNING: Using Parallel options with a single split is expected reduce performance")
-                max_workers = min(max(multiprocessing.cpu_count() - 2,1),len(train_test_splits))
-                if max_workers == 1 and n_splits > 1:
-                    print("WARNING: Default for max_workers is 1 on a machine with %s cores is 1.")
 
-            _initialize_Global_worker_pool(max_workers)
+def _CV_results(X, Y, LAMBDA, X_treat, Y_treat, train_test_splits,
+                parallel, max_workers, worker_type, lambda_chunk, pool=None, **kwargs):
+    """ Yields a CVFoldResult for each fold and L1 penalty, as each task completes
 
-            try:
+    :param pool: an existing worker pool to use when `parallel` is True.  By
+        default a pool is created for (and shut down after) this call.
+    """
+    n_splits = len(train_test_splits)
+    lambdas = LAMBDA if isinstance(LAMBDA, list) else [LAMBDA]
 
-                promises = [ _worker_pool.submit(__score_train_test__,
-                                                 X = X,
-                                                 Y = Y,
-                                                 LAMBDA = LAMBDA,
-                                                 train = train,
-                                                 test = test,
-                                                 FoldNumber = fold,
-                                                 **kwargs)
-                             for fold, (train,test) in enumerate(train_test_splits) ] 
+    if lambda_chunk:
+        lambda_chunks = [ list(range(i, min(i + lambda_chunk, len(lambdas)))) for i in range(0, len(lambdas), lambda_chunk) ]
+    else:
+        lambda_chunks = [ list(range(len(lambdas))) ]
+
+    def _records(fold, chunk, result):
+        v_mats, l2_pen_ws, scores, times = result
+        for j, i in enumerate(lambda_chunks[chunk]):
+            yield CVFoldResult(fold, i, lambdas[i], scores[j], v_mats[j], l2_pen_ws[j], times[j])
+
+    if parallel and pool is None: 
+
+        if max_workers is None:
+            # CALCULATE A DEFAULT FOR MAX_WORKERS
+            import multiprocessing
+            multiprocessing.cpu_count()
+            if n_splits == 1:
+                print("WARNING: Using Parallel options with a single split is expected reduce performance")
+            max_workers = min(max(multiprocessing.cpu_count() - 2,1),len(train_test_splits))
+            if max_workers == 1 and n_splits > 1:
+                print("WARNING: Default for max_workers is 1 on a machine with %s cores is 1.")
+
+        pool = _new_worker_pool(max_workers, worker_type)
+        records = _CV_results(X, Y, LAMBDA, X_treat, Y_treat, train_test_splits,
+                              parallel, max_workers, worker_type, lambda_chunk, pool, **kwargs)
+        try:
+            for record in records:
+                yield record
+        finally:
+            records.close() # cancels the outstanding folds before the pool is shut down
+            pool.shutdown()
+
+    elif parallel:
 
-                results = [ promise.result() for promise in futures.as_completed(promises)]
+        from concurrent import futures
 
-            finally:
+        promises = {}
+        try:
 
-                _clean_up_worker_pool()
+            for fold, (train,test) in enumerate(train_test_splits):
+                for chunk, chunk_index in enumerate(lambda_chunks):
+                    promise = _submit(pool,
+                                      score_train_test_sorted_lambdas,
+                                      X = X,
+                                      Y = Y,
+                                      LAMBDA = [lambdas[i] for i in chunk_index],
+                                      X_treat = X_treat, 
+                                      Y_treat = Y_treat, 
+                                      train = train,
+                                      test = test,
+                                      FoldNumber = fold,
+                                      ret_times = True,
+                                      **kwargs)
+                    promises[promise] = (fold, chunk)
+            for promise in futures.as_completed(promises):
+                fold, chunk = promises[promise]
+                for record in _records(fold, chunk, _result(promise)):
+                    yield record
+
+        finally:
+
+            # if the caller stopped early, don't wait for the remaining folds
+            for promise in promises:
+                promise.cancel()
 
-        else:
-            results = [ __score_train_test__(X = X,
-                                             Y = Y,
-                                             LAMBDA = LAMBDA,
-                                             train = train,
-                                             test = test,
-                                             FoldNumber = fold,
-                                             **kwargs)
-                        for fold, (train,test) in enumerate(train_test_splits) ] 
-
-    # extract the score.
-    _, _, scores = list(zip(* results))
+    else:
+
+        for fold, (train,test) in enumerate(train_test_splits):
+            result = score_train_test_sorted_lambdas(X = X,
+                                                     Y = Y,
+                                                     X_treat = X_treat, 
+                                                     Y_treat = Y_treat, 
+                                                     LAMBDA = lambdas,
+                                                     train = train,
+                                                     test = test,
+                                                     FoldNumber = fold,
+                                                     ret_times = True,
+                                                     **kwargs)
+            for record in _records(fold, 0, result):
+                yield record
+
+
+def _CV_plan(X, Y, LAMBDA, X_treat, Y_treat, train_test_splits, autotune, quiet,
+             parallel, max_workers, worker_type, lambda_chunk, kwargs):
+    """ applies the autotuned execution plan, if requested """
+    if autotune:
+        if not isinstance(autotune, ExecutionPlan):
+            autotune = _autotune(X, Y, LAMBDA, X_treat=X_treat, Y_treat=Y_treat,
+                                 splits=train_test_splits, cache=kwargs.get("cache", False))
+        if not quiet:
+            print("Autotuned execution plan: %s" % (autotune,))
+        parallel, worker_type, max_workers, lambda_chunk = \
+                autotune.parallel, autotune.worker_type, autotune.max_workers, autotune.lambda_chunk
+        if X_treat is None:
+            kwargs["grad_splits"] = autotune.grad_splits
+    if not isinstance(LAMBDA, list):
+        lambda_chunk = None
+    return parallel, max_workers, worker_type, lambda_chunk
+
+
+def CV_score_iter(X,Y,
+                  LAMBDA,
+                  X_treat=None,
+                  Y_treat=None,
+                  splits=5,
+                  quiet=False,
+                  parallel=False,
+                  max_workers=None,
+                  worker_type="process",
+                  lambda_chunk=None,
+                  autotune=False,
+                  **kwargs):
+    """ A generator version of CV_score() which yields a `CVFoldResult`
+        (fold, lambda_index, LAMBDA, score, v_mat, l2_pen_w, seconds) for each
+        fold and L1 penalty as soon as it is available, rather than the summed
+        score at the end.  With `parallel = True` results arrive in order of
+        completion from a worker pool owned by the generator; closing the
+        generator early cancels the outstanding folds and shuts down its pool.
+
+        Parameters are the same as for CV_score().
+    """
+    X, Y, X_treat, Y_treat, LAMBDA, _, train_test_splits = _CV_setup(X, Y, LAMBDA, X_treat, Y_treat, splits, quiet)
+    parallel, max_workers, worker_type, lambda_chunk = \
+            _CV_plan(X, Y, LAMBDA, X_treat, Y_treat, train_test_splits, autotune, quiet,
+                     parallel, max_workers, worker_type, lambda_chunk, kwargs)
+    return _CV_results(X, Y, LAMBDA, X_treat, Y_treat, train_test_splits,
+                       parallel, max_workers, worker_type, lambda_chunk, **kwargs)
+
+
+def CV_score(X,Y,
+             LAMBDA,
+             X_treat=None,
+             Y_treat=None,
+             splits=5,
+             sub_splits=None, # ignore pylint -- this is here for consistency...
+             quiet=False,
+             parallel=False,
+             max_workers=None,
+             worker_type="process",
+             lambda_chunk=None,
+             autotune=False,
+             **kwargs):
+    """ Cross fold validation for 1 or more L1 Penalties, holding the L2 penalty fixed. 
+
+    :param worker_type: "process" or "thread"; the kind of worker pool used when `parallel` is True
+    :param lambda_chunk: if set (and `LAMBDA` is an iterable), the penalties for
+        each fold are submitted to the worker pool in chunks of this size so
+        that more workers than folds can be kept busy.  Note that with `cache
+        = True` the cached V matrix is not carried across chunks.
+    :param autotune: If True, the execution plan (`parallel`, `worker_type`,
+        `max_workers`, `lambda_chunk` and, for the controls-only case,
+        `grad_splits`) is chosen by SparseSC.autotune.autotune() and
+        reported, overriding the values passed in.  A previously computed
+        `ExecutionPlan` may also be passed.
+    :param kwargs: additional arguments passed to score_train_test(),
+        including `dtype` (np.float32 fits V and the out-of-sample weights in
+        single precision), `refine` (steps of iterative refinement for the
+        out-of-sample weights) and `result_cache` (an on-disk cache of the
+        result for each fold and L1 penalty)
+
+    See CV_score_iter() for access to the per-fold results.
+    """
+    X, Y, X_treat, Y_treat, LAMBDA, multi_lambda, train_test_splits = _CV_setup(X, Y, LAMBDA, X_treat, Y_treat, splits, quiet)
+    parallel, max_workers, worker_type, lambda_chunk = \
+            _CV_plan(X, Y, LAMBDA, X_treat, Y_treat, train_test_splits, autotune, quiet,
+                     parallel, max_workers, worker_type, lambda_chunk, kwargs)
+
+    # extract the score (summed in fold order).
+    results = sorted(_CV_results(X, Y, LAMBDA, X_treat, Y_treat, train_test_splits,
+                                 parallel, max_workers, worker_type, lambda_chunk, **kwargs),
+                     key = lambda r: (r.fold, r.lambda_index))
+    scores = [ [ r.score for r in results if r.fold == fold ] for fold in range(len(train_test_splits)) ]
 
     if multi_lambda:
         total_score = [sum(s) for s in zip(*scores)]
     else:
-        total_score = sum(scores)
+        total_score = sum(s[0] for s in scores)
 
     return total_score
 
 
-def joint_penalty_optimzation(X, Y, L1_pen_start = None, L2_pen_start = None, bounds = ((-6,6,),)*2, X_treat = None, Y_treat = None):
+RaceResults = namedtuple("RaceResults", "best_lambda best_score scores n_fits")
+RaceResults.__doc__ = """ Results from CV_score_racing()
+
+    :param best_lambda: the L1 penalty with the lowest cross validation error among the penalties that survived the longest
+    :param best_score: its (partial) cross validation error
+    :param scores: a len(LAMBDA) x n_splits array of fold scores, with `nan` for folds on which a penalty was not evaluated
+    :param n_fits: the number of V matrices that were fit
+"""
+
+
+def CV_score_racing(X,Y,
+                    LAMBDA,
+                    X_treat=None,
+                    Y_treat=None,
+                    splits=5,
+                    eta=2,
+                    min_folds=1,
+                    tol_range=None,
+                    rtol=0.01,
+                    quiet=False,
+                    parallel=False,
+                    max_workers=None,
+                    worker_type="process",
+                    **kwargs):
+    """ Cross validation for several L1 Penalties using successive halving:
+        every surviving penalty is scored on one fold at a time, and after
+        each fold only the best `1/eta` of the survivors (by partial cross
+        validation error) are kept, along with any penalty whose partial
+        error is within `rtol` of the leader's.  Racing stops when a single
+        penalty remains or the folds are exhausted.
+
+    :param eta: the fraction (1/eta) of the surviving penalties which are kept after each fold
+    :param min_folds: number of folds on which every penalty is scored before any are dropped
+    :param rtol: a penalty is only dropped if its partial cross validation
+        error exceeds the leader's by more than this fraction, so that
+        penalties within noise of the leader are never raced out
+    :param tol_range: optional pair (loose, tight) of optimizer tolerances
+        (the `tol` parameter of cdl_search() or scipy.optimize.minimize()).
+        The tolerance is tightened geometrically from `loose` on the first
+        fold to `tight` on the last, so cheap fits are used while there are
+        many candidates and accurate fits once few remain.
+    :param parallel: If True, the surviving penalties for each fold are fit
+        in parallel, in a single worker pool kept for the whole race
+
+    Remaining parameters are the same as for CV_score().
+
+    :return: the best penalty and the table of partial scores
+    :rtype: RaceResults
+    """
+    assert eta > 1, "eta must be greater than 1"
+    X, Y, X_treat, Y_treat, LAMBDA, multi_lambda, train_test_splits = _CV_setup(X, Y, LAMBDA, X_treat, Y_treat, splits, quiet)
+    if not multi_lambda:
+        LAMBDA = [LAMBDA]
+    n_splits = len(train_test_splits)
+
+    scores = np.full((len(LAMBDA), n_splits), np.nan)
+    alive = list(range(len(LAMBDA)))
+    n_fits = 0
+
+    pool = None
+    if parallel:
+        if max_workers is None:
+            import multiprocessing
+            max_workers = min(max(multiprocessing.cpu_count() - 2, 1), len(LAMBDA))
+        pool = _new_worker_pool(max_workers, worker_type)
+    try:
+        for fold, split in enumerate(train_test_splits):
+            if tol_range is not None:
+                loose, tight = tol_range
+                kwargs["tol"] = loose * (tight / float(loose)) ** (fold / float(max(n_splits - 1, 1)))
+
+            for record in _CV_results(X, Y, [LAMBDA[i] for i in alive], X_treat, Y_treat, [split],
+                                      parallel, max_workers, worker_type, 1 if parallel else None, pool, **kwargs):
+                scores[alive[record.lambda_index], fold] = record.score
+            n_fits += len(alive)
+
+            # DROP THE DOMINATED PENALTIES
+            if fold + 1 >= min_folds and fold + 1 < n_splits:
+                partial = scores[alive, :fold + 1].sum(axis=1)
+                n_keep = int(np.ceil(len(alive) / float(eta)))
+                keep = set(np.argsort(partial, kind="mergesort")[:n_keep])
+                keep.update(np.where(partial <= partial.min() * (1 + rtol))[0])
+                alive = [alive[i] for i in sorted(keep)]
+                if not quiet:
+                    print("Fold %s: %s penalties remaining" % (fold, len(alive),))
+                if len(alive) == 1:
+                    break
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    # THE BEST OF THE PENALTIES THAT WERE SCORED ON THE MOST FOLDS
+    n_scored = np.sum(~np.isnan(scores), axis=1)
+    candidates = np.where(n_scored == n_scored.max())[0]
+    partial = np.nansum(scores[candidates, :], axis=1)
+    best = candidates[np.argmin(partial)]
+
+    return RaceResults(LAMBDA[best], partial.min(), scores, n_fits)
+
+
+def joint_penalty_optimzation(X, Y, L1_pen_start = None, L2_pen_start = None, bounds = ((-6,6,),)*2, X_treat = None, Y_treat = None,
+                              method = "differential_evolution", quiet = False, **kwargs):
+    """ Joint optimization of the L1 and L2 penalties
+
+    :param method: "differential_evolution" (scipy.optimize.differential_evolution,
+        which runs hundreds to thousands of serial cross validations) or "grid"
+        (SparseSC.penalty_search.joint_penalty_search(), a coarse 2-D grid with
+        local refinement, which scores candidate batches in parallel)
+    :param quiet: If True, don't print the result of each call to the objective function
+    :param kwargs: additional arguments passed to CV_score() or joint_penalty_search()
+    """
     #TODO: Default bounds?
     # -----------------------------------------------------------------
     # Optimization of the L2 and L1 Penalties Simultaneously
@@ -354,6 +587,14 @@ def joint_penalty_optimzation(X, Y, L1_pen_start = None, L2_pen_start = None, bo
 
     L1_pen_start  = get_max_lambda(X,Y,X_treat=X_treat,Y_treat=Y_treat) #TODO: is this right?
 
+    if method == "grid":
+        from SparseSC.penalty_search import joint_penalty_search
+        return joint_penalty_search(X, Y, X_treat = X_treat, Y_treat = Y_treat,
+                                    L1_pen_start = L1_pen_start, L2_pen_start = L2_pen_start,
+                                    bounds = bounds, quiet = quiet, **kwargs)
+    if method != "differential_evolution":
+        raise ValueError("Unknown method: %s" % method)
+
     # build the objective function to be minimized
     n_calls = [0,]
     temp_results =[]
@@ -367,10 +608,12 @@ def joint_penalty_optimzation(X, Y, L1_pen_start = None, L2_pen_start = None, bo
                             LAMBDA = L1_pen_start * np.exp(x[0]),
                             L2_PEN_W = L2_pen_start * np.exp(x[1]),
                             # suppress the analysis type message
-                            quiet = True)
+                            quiet = True,
+                            **kwargs)
         t2 = time.time()
         temp_results.append((n_calls[0],x,score))
-        print("calls: %s, time: %0.4f, x0: %0.4f, Cross Validation Error: %s" % (n_calls[0], t2 - t1, x[0], score))
+        if not quiet:
+            print("calls: %s, time: %0.4f, x0: %0.4f, Cross Validation Error: %s" % (n_calls[0], t2 - t1, x[0], score))
         #print("calls: %s, time: %0.4f, x0: %0.4f, x1: %0.4f, Cross Validation Error: %s, R-Squared: %s" % (n_calls[0], t2 - t1, x[0], x[1], score, 1 - score / SS ))
         return score
 
@@ -381,128 +624,26 @@ def joint_penalty_optimzation(X, Y, L1_pen_start = None, L2_pen_start = None, bo
     return diff_results
 
 
-def _ncr(n, r):
-    #https://stackoverflow.com/questions/4941753/is-there-a-math-ncr-function-in-python
-    import operator as op
-    import functools
-    r = min(r, n-r)
-    numer = functools.reduce(op.mul, range(n, n-r, -1), 1) #from py2 xrange()
-    denom = functools.reduce(op.mul, range(1, r+1), 1) #from py2 xrange()
-    return numer//denom
-
-def random_combination(iterable, r):
-    "Random selection from itertools.combinations(iterable, r)"
-    #https://stackoverflow.com/questions/22229796/choose-at-random-from-combinations
-    import random
-
-    pool = tuple(iterable)
-    n = len(pool)
-    indices = sorted(random.sample(range(n), r))
-    return tuple(pool[i] for i in indices)
-
-def repeatfunc(func, times=None, *args):
-    """Repeat calls to func with specified arguments.
-
-    Example:  repeatfunc(random.random)
-    """
-
-    if times is None:
-        return itertools.starmap(func, itertools.repeat(args))
-    return itertools.starmap(func, itertools.repeat(args, times))
-
-def _gen_placebo_stats_from_diffs(effect_vecs, pre_tr_rmspes,
-                                  control_effect_vecs, pre_c_rmspes,
-                                  max_n_pl = 1000000, ret_pl = False, ret_CI=False, level=0.95):
-    N1 = effect_vecs.shape[0]
-    N0 = control_effect_vecs.shape[0]
-    T1 = effect_vecs.shape[1]
-    #ret_p1s=False
-    keep_pl = ret_pl or ret_CI
-
-    #Get rest of the outcomes
-    ##Get the joint effects
-    joint_effects = np.sqrt(np.mean(np.square(effect_vecs), axis=1))
-    control_joint_effects = np.sqrt(np.mean(np.square(control_effect_vecs), axis=1))
-    ## Standardized effect vecs
-    std_effect_vecs = np.diagflat(1/pre_tr_rmspes).dot(effect_vecs)
-    control_std_effect_vecs = np.diagflat(1/ pre_c_rmspes).dot(control_effect_vecs)
-    ##Get the standardized joint effects
-    joint_std_effects = np.multiply((1 / pre_tr_rmspes), joint_effects)
-    control_joint_std_effects = np.multiply((1/ pre_c_rmspes), control_joint_effects) 
-
-    #Compute the outcomes for treatment
-    effect_vec = np.mean(effect_vecs, axis=0)
-    std_effect_vec = np.mean(std_effect_vecs, axis=0)
-    joint_effect = np.mean(joint_effects)
-    joint_std_effect = np.mean(joint_std_effects)
-
-    n_pl = _ncr(N0, N1)
-    if (max_n_pl > 0 & n_pl > max_n_pl): #randomize
-        comb_iter = itertools.combinations(range(N0), N1)
-        comb_len = max_n_pl
-    else:
-        comb_iter = repeatfunc(random_combination, n_pl, range(N0), N1)
-        comb_len = n_pl
-    placebo_effect_vecs = None
-    if keep_pl:
-        placebo_effect_vecs = np.empty((comb_len,T1))
-    p2s = np.zeros((1,T1))
-    p2s_std = np.zeros((1,T1))
-    #p1s = np.zero((1,T1))
-    #p1s_std = np.zero((1,T1))
-    #effect_vec_sgn = np.sign(effect_vec)
-    joint_p = 0
-    joint_std_p = 0
-    for idx, comb in enumerate(comb_iter):
-        placebo_effect_vec = np.mean(control_effect_vecs[comb,:], 0)
-        placebo_std_effect_vec = np.mean(control_std_effect_vecs[comb,:], 0)
-        placebo_joint_effect = np.mean(control_joint_effects[comb,:])
-        placebo_joint_std_effect = np.mean(control_joint_std_effects[comb,:])
-
-        p2s += (abs(placebo_effect_vec) >= abs(effect_vec))
-        p2s_std += (abs(placebo_std_effect_vec) >= abs(std_effect_vec))
-        #p1s += (effect_vec_sgn*placebo_effect_vec >= effect_vec_sgn*effect_vec)
-        #p1s_std += (effect_vec_sgn*placebo_std_effect_vec >= effect_vec_sgn*std_effect_vec)
-        joint_p += (placebo_joint_effect >= joint_effect)
-        joint_std_p += (placebo_joint_std_effect >= joint_std_effect)
-        if keep_pl:
-            placebo_effect_vecs[idx,:] = placebo_effect_vec
-    p2s = p2s/comb_len
-    p2s_std = p2s_std/comb_len
-    #p1s = p1s/comb_len
-    #p1s_std = p1s_std/comb_len
-    joint_p = joint_p/comb_len
-    joint_std_p = joint_std_p/comb_len
-    #p2s = 2*p1s #Ficher 2-sided p-vals (less common)
-    if ret_CI:
-        #CI - All hypothetical true effects (beta0) that would not be reject at the certain level
-        # To test non-zero beta0, apply beta0 to get unexpected deviation beta_hat-beta0 and compare to permutation distribution
-        # This means that we take the level-bounds of the permutation distribution then "flip it around beta_hat"
-        # To make the math a bit nicer, I will reject a hypothesis if pval<=(1-level)
-        assert level<=1; "Use a level in [0,1]"
-        alpha = (1-level)
-        p2min = 2/n_pl
-        alpha_ind = max((1,round(alpha/p2min)))
-        alpha = alpha_ind* p2min
-        CIs = np.empty((2,T1))
-        for t in range(T1):
-            sorted_eff = np.sort(placebo_effect_vecs[:,t]) #TODO: check with Stata about sort order
-            low_effect = sorted_eff[alpha_ind]
-            high_effect = sorted_eff[(comb_len+1)-alpha_ind]
-            if np.sign(low_effect)==np.sign(high_effect):
-                warnings.warn("CI doesn't containt effect. You might not have enough placebo effects.")
-            CIs[:,t] = (effect_vec[t] - high_effect, effect_vec[t] - low_effect) 
-    else:
-        CIs = None
-
-    EstResultCI = namedtuple('EstResults', 'effect p ci')
-    
-    SparseSCEstResults = namedtuple('SparseSCEstResults', 'effect_vec_res std_p joint_p joint_std_p N_placebo placebo_effect_vecs')
-    ret_struct = SparseSCEstResults(EstResultCI(effect_vec, p2s, CIs), p2s_std, joint_p, joint_std_p, comb_len, placebo_effect_vecs)
-    return ret_struct
-
 def estimate_effects(X, Y_pre, Y_post, treated_units, max_n_pl = 1000000, ret_pl = False, ret_CI=False, level=0.95, 
-                     V_penalty = None, W_penalty=None, **kwargs):
+                     V_penalty = None, W_penalty=None, seed=None, placebo_parallel=False,
+                     placebo_max_workers=None, placebo_worker_type="process",
+                     p_tol=None, p_tol_level=0.99, n_pl_batch=1000, **kwargs):
+    """ Estimates the effects for the treated units and the placebo inference
+
+    :param seed: seed for the random placebo draws; for a given seed the
+        results are identical regardless of `placebo_parallel` and
+        `placebo_max_workers`
+    :param placebo_parallel: If True, random placebo draws are spread across a worker pool
+    :param placebo_max_workers: number of workers used for the placebo draws
+    :param placebo_worker_type: "process" or "thread"
+    :param p_tol: If not None, stop drawing random placebos once every
+        p-value is known to within +/- `p_tol` (at level `p_tol_level`),
+        checking every `n_pl_batch` draws.  The number of placebos drawn is
+        returned as `N_placebo`.
+
+    Remaining keyword arguments are passed to joint_penalty_optimzation()
+    when the penalties are not given.
+    """
     #TODO: Cleanup returning placebo distribution (incl pre?)
     #N1 = len(treated_units)
     X_and_Y_pre = np.hstack( ( X, Y_pre,) )
@@ -510,9 +651,104 @@ def estimate_effects(X, Y_pre, Y_post, treated_units, max_n_pl = 1000000, ret_pl
     #N0 = N - N1
     #T1 = Y_post.shape[1]
     control_units = list(set(range(N)) - set(treated_units)) 
-    all_units = list(range(N))
+
+    weights = _effects_weights(X_and_Y_pre, Y_post, control_units, V_penalty, W_penalty, **kwargs)
+    Y_pre_sc = weights.dot(Y_pre[control_units, :])
+    Y_post_sc = weights.dot(Y_post[control_units, :])
+
+    return _gen_placebo_stats_from_diffs(*_effect_diffs(Y_pre, Y_post, Y_pre_sc, Y_post_sc, treated_units, control_units),
+                                 max_n_pl = max_n_pl,
+                                 ret_pl = ret_pl,
+                                 ret_CI = ret_CI,
+                                 level = level,
+                                 seed = seed,
+                                 parallel = placebo_parallel,
+                                 max_workers = placebo_max_workers,
+                                 worker_type = placebo_worker_type,
+                                 p_tol = p_tol,
+                                 p_tol_level = p_tol_level,
+                                 n_pl_batch = n_pl_batch)
+
+def estimate_effects_streaming(X, Y_pre, Y_post, treated_units, weights, period_block = 1000,
+                               max_n_pl = 1000000, ret_pl = False, ret_CI=False, level=0.95,
+                               seed=None, placebo_parallel=False,
+                               placebo_max_workers=None, placebo_worker_type="process"):
+    """ estimate_effects() which reads the outcomes in blocks of periods, so
+        that the synthetic outcomes, the effects and the placebo statistics
+        are never held in memory for more than two blocks of
+        `period_block` periods at a time, and peak memory doesn't grow with
+        the number of periods (apart from the returned per-period results,
+        and the placebo effect vectors if `ret_pl`).
+
+        The placebo combinations are enumerated (or drawn) once and replayed
+        against each block, so their memory depends on the number of
+        placebos, not on the number of periods.
+
+    :param Y_pre: Matrix of pre-period outcomes: an array, a `numpy.memmap`,
+        or the path (a str or `pathlib.Path`) to a .npy file (which is
+        memory mapped)
+    :param Y_post: Matrix of post-period outcomes (as for `Y_pre`)
+    :param weights: the (N x N0) matrix of weights for every unit (with the
+        control units in increasing order), e.g. from loo_v_matrix() and
+        loo_weights() fit on the covariates and (a window of) the
+        pre-period outcomes.  These are required: fitting V as in
+        estimate_effects() needs the outcomes of every period in memory.
+    :param period_block: number of periods read at a time
+
+    The remaining parameters are as in estimate_effects().  The random
+    placebos are drawn from `seed` (or a seed drawn from the global numpy
+    random state), so that every block is tested against the same placebos.
+    """
+    Y_pre = _open_outcomes(Y_pre)
+    Y_post = _open_outcomes(Y_post)
+    N = X.shape[0]
+    control_units = list(set(range(N)) - set(treated_units)) 
+
+    # PARAMETER QC
+    if weights is None:
+        raise ValueError("weights are required, as fitting V needs the outcomes of every period in memory (use estimate_effects() instead)")
+    weights = np.asarray(weights)
+    if weights.shape != (N, len(control_units)):
+        raise ValueError("weights must be an (N x N0) matrix, with N = %s and N0 = %s" % (N, len(control_units)))
+
+    # PRE-PERIOD RMSPES
+    sum_squares = np.zeros(N)
+    for start in range(0, Y_pre.shape[1], period_block):
+        Y_block = np.asarray(Y_pre[:, start:start + period_block], dtype=float)
+        sum_squares += np.square(Y_block - weights.dot(Y_block[control_units, :])).sum(axis=1)
+    pre_rmspes = np.sqrt(sum_squares / Y_pre.shape[1])
+
+    def diff_blocks():
+        for start in range(0, Y_post.shape[1], period_block):
+            Y_block = np.asarray(Y_post[:, start:start + period_block], dtype=float)
+            effects = Y_block - weights.dot(Y_block[control_units, :])
+            yield effects[treated_units, :], effects[control_units, :]
+
+    return _gen_placebo_stats_from_diff_blocks(diff_blocks(),
+                                               pre_rmspes[treated_units],
+                                               pre_rmspes[control_units],
+                                               max_n_pl = max_n_pl,
+                                               ret_pl = ret_pl,
+                                               ret_CI = ret_CI,
+                                               level = level,
+                                               seed = seed,
+                                               parallel = placebo_parallel,
+                                               max_workers = placebo_max_workers,
+                                               worker_type = placebo_worker_type)
+
+def _open_outcomes(Y):
+    """ memory maps outcomes given as the path (a str or os.PathLike, as for
+        np.load()) to a .npy file """
+    if isinstance(Y, (str, os.PathLike)):
+        return np.load(os.fspath(Y), mmap_mode="r")
+    return Y
+
+def _effects_weights(X_and_Y_pre, Y_post, control_units, V_penalty, W_penalty, **kwargs):
+    """ Fits V on the control units (choosing the penalties if not given) and
+        returns the (N x N0) matrix of weights for every unit
+    """
+    all_units = list(range(X_and_Y_pre.shape[0]))
     Y_post_c = Y_post[control_units, :]
-    Y_post_tr = Y_post[treated_units, :]
     X_and_Y_pre_c = X_and_Y_pre[control_units, :]
     
     if V_penalty is None: #TODO (handle this case better)
@@ -523,53 +759,156 @@ def estimate_effects(X, Y_pre, Y_post, treated_units, max_n_pl = 1000000, ret_pl
                      Y = Y_post_c,
                      LAMBDA = V_penalty, L2_PEN_W = W_penalty)
 
-    weights = loo_weights(X = X_and_Y_pre,
-                          V = V,
-                          L2_PEN_W = W_penalty,
-                          treated_units = all_units,
-                          control_units = control_units)
-    Y_post_sc = weights.dot(Y_post_c)
+    return loo_weights(X = X_and_Y_pre,
+                       V = V,
+                       L2_PEN_W = W_penalty,
+                       treated_units = all_units,
+                       control_units = control_units)
+
+def _effect_diffs(Y_pre, Y_post, Y_pre_sc, Y_post_sc, treated_units, control_units):
+    """ Returns the post-period effects and the pre-period RMSPEs of the
+        treated and control units, given the synthetic outcomes for every unit
+    """
     # Get post effects
-    Y_post_tr_sc = Y_post_sc[treated_units, :]
-    Y_post_c_sc = Y_post_sc[control_units, :]
-    effect_vecs = Y_post_tr - Y_post_tr_sc
-    control_effect_vecs = Y_post_c - Y_post_c_sc
+    effect_vecs = Y_post[treated_units, :] - Y_post_sc[treated_units, :]
+    control_effect_vecs = Y_post[control_units, :] - Y_post_sc[control_units, :]
     
     # Get pre match MSE (match quality)
-    Y_pre_tr = Y_pre[treated_units, :]
-    Y_pre_c = Y_pre[control_units, :]
-    Y_pre_sc = weights.dot(Y_pre_c)
-    Y_pre_tr_sc = Y_pre_sc[treated_units, :]
-    Y_pre_c_sc = Y_pre_sc[control_units, :]
-    pre_tr_pes = Y_pre_tr - Y_pre_tr_sc
-    pre_c_pes = Y_pre_c - Y_pre_c_sc
+    pre_tr_pes = Y_pre[treated_units, :] - Y_pre_sc[treated_units, :]
+    pre_c_pes = Y_pre[control_units, :] - Y_pre_sc[control_units, :]
     pre_tr_rmspes = np.sqrt(np.mean(np.square(pre_tr_pes), axis=1))
     pre_c_rmspes = np.sqrt(np.mean(np.square(pre_c_pes), axis=1))
 
-
-    return _gen_placebo_stats_from_diffs(effect_vecs, pre_tr_rmspes,
-                                 control_effect_vecs, pre_c_rmspes,
-                                 max_n_pl, ret_pl, ret_CI, level)
+    return effect_vecs, pre_tr_rmspes, control_effect_vecs, pre_c_rmspes
+
+def _array_key(*arrays):
+    """ A hashable digest of the shapes, types and contents of the arrays """
+    import hashlib
+    digest = hashlib.sha1()
+    for a in arrays:
+        a = np.ascontiguousarray(a)
+        digest.update(("%s%s" % (a.shape, a.dtype)).encode("ascii"))
+        digest.update(a.tobytes())
+    return digest.hexdigest()
+
+def estimate_effects_batch(X, jobs, control_units=None, max_n_pl = 1000000, ret_pl = False, ret_CI=False, level=0.95,
+                           V_penalty = None, W_penalty=None, seed=None, placebo_parallel=False,
+                           placebo_max_workers=None, placebo_worker_type="process",
+                           p_tol=None, p_tol_level=0.99, n_pl_batch=1000, **kwargs):
+    """ estimate_effects() for many outcomes or treatment cohorts which share
+        the covariates `X`.
+
+        Jobs with the same control units share a single fit of V (and of the
+        penalties, if they are not given) and a single weight matrix.  V is
+        fit jointly to the distinct outcomes of the jobs in the group (as
+        for a multi-column `Y`), and the synthetic outcomes of every unit for
+        every job in the group are computed with one matrix product.  The
+        placebo inference for every job is then run through the same engine.
+
+        When the jobs of a group share their outcomes (e.g. treatment cohorts
+        drawn from one control pool), each job's results are the same as
+        estimate_effects() for the control and treated units of the job.
+
+    :param X: Matrix of covariates (all units)
+    :param jobs: an iterable of (Y_pre, Y_post, treated_units) tuples
+    :param control_units: the control units shared by every job.  If None,
+        the controls for each job are all of the units which are not treated
+        in that job (as in estimate_effects()), in which case only jobs with
+        the same treated units can share a fit.
+    :param seed: seed for the random placebo draws.  Job i uses the seed
+        [seed, i].
+
+    The remaining parameters are as in estimate_effects()
+
+    :return: a list with the SparseSCEstResults for each job
+    """
+    jobs = [(np.asarray(Y_pre), np.asarray(Y_post), list(treated_units))
+            for Y_pre, Y_post, treated_units in jobs]
+    N = X.shape[0]
+    if control_units is not None:
+        control_units = list(control_units)
+        for _, _, treated_units in jobs:
+            if set(treated_units) & set(control_units):
+                raise ValueError("treated_units and control_units must be disjoint")
+
+    # GROUP THE JOBS WHICH SHARE A FIT (BY CONTROL UNITS), AND WITHIN A GROUP
+    # THE JOBS WHICH SHARE THEIR OUTCOMES
+    groups = {}
+    for i, (Y_pre, Y_post, treated_units) in enumerate(jobs):
+        if control_units is None:
+            job_control_units = list(set(range(N)) - set(treated_units))
+        else:
+            job_control_units = control_units
+        outcomes = groups.setdefault(tuple(job_control_units), {})
+        outcomes.setdefault(_array_key(Y_pre, Y_post), []).append(i)
+
+    out = [None] * len(jobs)
+    for job_control_units, outcomes in groups.items():
+        job_control_units = list(job_control_units)
+        outcome_jobs = list(outcomes.values())
+        Y_pres = [jobs[job_indexes[0]][0] for job_indexes in outcome_jobs]
+        Y_posts = [jobs[job_indexes[0]][1] for job_indexes in outcome_jobs]
+        weights = _effects_weights(np.hstack([X] + Y_pres), np.hstack(Y_posts), job_control_units,
+                                   V_penalty, W_penalty, **kwargs)
+
+        # synthetic pre and post outcomes of every unit for every job in the group in one product
+        Y_sc = weights.dot(np.hstack(Y_pres + Y_posts)[job_control_units, :])
+        pre_start = np.cumsum([0] + [Y_pre.shape[1] for Y_pre in Y_pres])
+        post_start = pre_start[-1] + np.cumsum([0] + [Y_post.shape[1] for Y_post in Y_posts])
+        for k, job_indexes in enumerate(outcome_jobs):
+            Y_pre, Y_post = Y_pres[k], Y_posts[k]
+            Y_pre_sc = Y_sc[:, pre_start[k]:pre_start[k + 1]]
+            Y_post_sc = Y_sc[:, post_start[k]:post_start[k + 1]]
+            for i in job_indexes:
+                treated_units = jobs[i][2]
+                out[i] = _gen_placebo_stats_from_diffs(*_effect_diffs(Y_pre, Y_post, Y_pre_sc, Y_post_sc,
+                                                                     treated_units, job_control_units),
+                                                       max_n_pl = max_n_pl,
+                                                       ret_pl = ret_pl,
+                                                       ret_CI = ret_CI,
+                                                       level = level,
+                                                       seed = None if seed is None else [seed, i],
+                                                       parallel = placebo_parallel,
+                                                       max_workers = placebo_max_workers,
+                                                       worker_type = placebo_worker_type,
+                                                       p_tol = p_tol,
+                                                       p_tol_level = p_tol_level,
+                                                       n_pl_batch = n_pl_batch)
+    return out
 
 # ------------------------------------------------------------
 # utilities for maintaining a worker pool
 # ------------------------------------------------------------
 
-_worker_pool = None
-
-def _initialize_Global_worker_pool(n_workers):
-    global _worker_pool
-
-    if _worker_pool is not None:
-        return # keep it itempotent, please
-
-    _worker_pool = futures.ProcessPoolExecutor(max_workers=n_workers)
-
-def _clean_up_worker_pool():
-    global _worker_pool
-
-    if _worker_pool is not None:
-        _worker_pool.shutdown()
-        _worker_pool = None
-
-atexit.register(_clean_up_worker_pool)
+def _new_worker_pool(n_workers, worker_type="process"):
+    """ Returns a new worker pool, which the caller owns and shuts down (so
+        that concurrent callers, e.g. two CV_score_iter() generators, never
+        share or tear down each other's pool)
+    """
+    from concurrent import futures
+    if worker_type == "process":
+        return futures.ProcessPoolExecutor(max_workers=n_workers)
+    if worker_type == "thread":
+        return futures.ThreadPoolExecutor(max_workers=n_workers)
+    raise ValueError("Unknown worker_type: %s" % worker_type)
+
+def _submit(pool, fun, *args, **kwargs):
+    """ Submits a task to the worker pool.  Within a profile() context, a
+        task run in a process pool returns its counters with its result.
+    """
+    from concurrent import futures
+    if profiling() and isinstance(pool, futures.ProcessPoolExecutor):
+        promise = pool.submit(call_profiled, fun, *args, **kwargs)
+        promise.profiled = True
+        return promise
+    return pool.submit(fun, *args, **kwargs)
+
+def _result(promise):
+    """ Returns the result of a task submitted with _submit(), adding its
+        counters to the active profilers
+    """
+    if getattr(promise, "profiled", False):
+        result, stats = promise.result()
+        report(stats)
+        return result
+    return promise.result()
@@ -0,0 +1,303 @@
+""" A fitted synthetic control model which caches the tensor matrix (V) and
+    the factorization of the control system
+
+    For a fixed V the weights for a treated unit (x) are the solution to
+
+        A w = X_c (2V) x + 2 * L2_PEN_W / N0
+
+    where A = X_c (2V) X_c.T + 2 * L2_PEN_W * I depends only on the control
+    units.  V is diagonal (and usually sparse), so A is built from the active
+    covariates only, and its Cholesky factor is computed once when the model
+    is fit.  The weights for any number of new treated units then cost a
+    single pair of triangular solves.
+
+    The model can also be updated as the panel grows: new periods only
+    extend the synthetic outcomes, and new control units extend the
+    Cholesky factor by a block update,
+
+        chol([[A, C], [C.T, D]]) = [[L, 0], [S.T, chol(D - S.T S)]],  S = L^-1 C
+
+    which costs O(N0^2 m) for m new controls rather than O((N0 + m)^3).
+
+    A fitted model can be saved with save() and re-loaded with load(), which
+    memory maps the arrays (see SparseSC.utils.persistence), so a serving
+    process doesn't need to re-fit V or refactor the control system.
+"""
+import json
+import warnings
+import numpy as np
+from scipy.linalg import cholesky, cho_solve, solve_triangular
+from SparseSC.tensor import tensor
+from SparseSC.lambda_utils import L2_pen_guestimate
+from SparseSC.utils.persistence import save_arrays, load_arrays
+
+# the arrays written by SyntheticControl.save()
+_SAVED_ARRAYS = ("V_", "active_", "_scale", "X_control_", "_X_c_active", "weights_",
+                 "synthetic_", "Y_control_", "X_treat_", "Y_treat_")
+
+class SyntheticControl(object):
+    """ Synthetic control estimator
+
+    :param LAMBDA: L1 penalty used to fit V
+    :param L2_PEN_W: L2 penalty on the weights.  Defaults to
+        L2_pen_guestimate() of the covariates used to fit V.
+    :param grad_splits: passed to tensor() when there are no treated units
+    :param kwargs: additional arguments passed to tensor()
+
+    Attributes set by fit():
+
+    :param V_: the fitted tensor matrix
+    :param L2_PEN_W_: the L2 penalty used for the weights
+    :param active_: the index of the covariates with non-zero weight in V
+    :param weights_: the weights for the treated units passed to fit() (if any)
+    :param synthetic_: the synthetic outcomes for the treated units passed to
+        fit(), for the periods in `Y` and any added by add_periods()
+    """
+    def __init__(self, LAMBDA=0, L2_PEN_W=None, grad_splits=None, **kwargs):
+        self.LAMBDA = LAMBDA
+        self.L2_PEN_W = L2_PEN_W
+        self.grad_splits = grad_splits
+        self.kwargs = kwargs
+
+    def fit(self, X, Y, X_treat=None, Y_treat=None, V=None):
+        """ Fits V (unless it is given) and factors the control system
+
+        :param X: Matrix of covariates for the control units
+        :param Y: Matrix of outcomes for the control units
+        :param X_treat: Matrix of covariates for the treated units (optional)
+        :param Y_treat: Matrix of outcomes for the treated units (optional)
+        :param V: a previously fitted (diagonal) tensor matrix, in which case
+            Y and Y_treat are only used for the synthetic outcomes (and may be
+            None)
+
+        :return: self
+        """
+        X = np.asarray(X, dtype=float)
+        if X_treat is not None:
+            X_treat = np.asarray(X_treat, dtype=float)
+            if X_treat.shape[1] != X.shape[1]:
+                raise ValueError("X and X_treat have different number of columns (%s and %s)" %
+                                 (X.shape[1], X_treat.shape[1],))
+
+        self.Y_control_ = None if Y is None else np.asarray(Y, dtype=float)
+        self.X_treat_ = X_treat
+        self.Y_treat_ = None if Y_treat is None else np.asarray(Y_treat, dtype=float)
+
+        if V is None:
+            V = tensor(X = X,
+                       Y = Y,
+                       X_treat = X_treat,
+                       Y_treat = Y_treat,
+                       grad_splits = self.grad_splits,
+                       LAMBDA = self.LAMBDA,
+                       L2_PEN_W = self.L2_PEN_W,
+                       **self.kwargs)
+
+        if self.L2_PEN_W is None:
+            # the default used by the fitting functions
+            self.L2_PEN_W_ = L2_pen_guestimate(X if X_treat is None else np.vstack((X, X_treat)))
+        else:
+            self.L2_PEN_W_ = float(self.L2_PEN_W)
+
+        self._factor(X, V)
+        return self
+
+    def _factor(self, X, V):
+        """ Factors the control system for the tensor matrix V """
+        V = np.asarray(V)
+        v = np.diag(V)
+        if V.shape != (X.shape[1], X.shape[1]) or np.count_nonzero(V - np.diag(v)):
+            raise ValueError("V must be a diagonal (K x K) matrix, with K = %s" % X.shape[1])
+        self.V_ = V
+        self.active_ = np.flatnonzero(v)
+        self._scale = np.sqrt(2 * v[self.active_])
+        self.X_control_ = X
+        self._X_c_active = X[:, self.active_] * self._scale
+
+        N0 = X.shape[0]
+        A = self._X_c_active.dot(self._X_c_active.T) + 2 * self.L2_PEN_W_ * np.eye(N0)
+        self.cho_ = (cholesky(A, lower=True), True)
+        self._update_treated()
+
+    def _update_treated(self):
+        """ Recomputes the weights and synthetic outcomes for the fitted treated units """
+        self.weights_ = None if self.X_treat_ is None else self.weights_for(self.X_treat_)
+        self.synthetic_ = None
+        if self.weights_ is not None and self.Y_control_ is not None:
+            self.synthetic_ = self.weights_.dot(self.Y_control_)
+
+    def add_periods(self, Y_control, Y_treat=None):
+        """ Adds new periods (outcome columns).  V and the weights are
+            unchanged, so this only extends the synthetic outcomes.
+
+        :param Y_control: Matrix of outcomes for the control units in the new periods
+        :param Y_treat: Matrix of outcomes for the treated units in the new periods
+
+        :return: self
+        """
+        Y_control = np.asarray(Y_control, dtype=float)
+        if Y_control.shape[0] != self.X_control_.shape[0]:
+            raise ValueError("Y_control has %s rows, expected %s" % (Y_control.shape[0], self.X_control_.shape[0]))
+        if self.Y_control_ is None:
+            self.Y_control_ = Y_control
+        else:
+            self.Y_control_ = np.hstack((self.Y_control_, Y_control))
+        if Y_treat is not None and self.Y_treat_ is not None:
+            self.Y_treat_ = np.hstack((self.Y_treat_, np.asarray(Y_treat, dtype=float)))
+        if self.weights_ is not None:
+            new = self.weights_.dot(Y_control)
+            self.synthetic_ = new if self.synthetic_ is None else np.hstack((self.synthetic_, new))
+        return self
+
+    def add_controls(self, X, Y=None, refit=False):
+        """ Adds new control units
+
+        Without `refit`, V and L2_PEN_W_ are unchanged and the Cholesky factor
+        of the control system is extended by a block update.  With `refit`, V
+        is re-optimized by tensor(), starting from the current V, and the
+        system is refactored.
+
+        :param X: Matrix of covariates for the new control units
+        :param Y: Matrix of outcomes for the new control units (for the
+            periods passed to fit() and add_periods()); required if the model
+            has outcomes
+        :param refit: If True, re-optimize V
+
+        :return: self
+        """
+        X = np.asarray(X, dtype=float)
+        if X.ndim == 1:
+            X = X[None, :]
+        if X.shape[1] != self.X_control_.shape[1]:
+            raise ValueError("X has %s columns, expected %s" % (X.shape[1], self.X_control_.shape[1]))
+        if self.Y_control_ is not None:
+            if Y is None:
+                raise ValueError("Y is required for the new control units")
+            Y = np.asarray(Y, dtype=float)
+            if Y.shape[0] != X.shape[0]:
+                raise ValueError("X and Y have different number of rows (%s and %s)" % (X.shape[0], Y.shape[0],))
+            self.Y_control_ = np.vstack((self.Y_control_, Y))
+        elif refit:
+            raise ValueError("refit requires the outcomes for the existing control units (Y in fit())")
+        X_all = np.vstack((self.X_control_, X))
+
+        if refit:
+            kwargs = dict(self.kwargs)
+            kwargs["start"] = np.diag(self.V_).copy()
+            V = tensor(X = X_all,
+                       Y = self.Y_control_,
+                       X_treat = self.X_treat_,
+                       Y_treat = self.Y_treat_,
+                       grad_splits = self.grad_splits,
+                       LAMBDA = self.LAMBDA,
+                       L2_PEN_W = self.L2_PEN_W_,
+                       **kwargs)
+            self._factor(X_all, V)
+            return self
+
+        # BLOCK UPDATE OF THE CHOLESKY FACTOR
+        L = self.cho_[0]
+        X_new_active = X[:, self.active_] * self._scale
+        C = self._X_c_active.dot(X_new_active.T)
+        D = X_new_active.dot(X_new_active.T) + 2 * self.L2_PEN_W_ * np.eye(X.shape[0])
+        S = solve_triangular(L, C, lower=True)
+        L22 = cholesky(D - S.T.dot(S), lower=True)
+        N0, m = L.shape[0], X.shape[0]
+        L_new = np.zeros((N0 + m, N0 + m))
+        L_new[:N0, :N0] = L
+        L_new[N0:, :N0] = S.T
+        L_new[N0:, N0:] = L22
+        self.cho_ = (L_new, True)
+        self.X_control_ = X_all
+        self._X_c_active = np.vstack((self._X_c_active, X_new_active))
+        self._update_treated()
+        return self
+
+    def weights_for(self, X_treat):
+        """ The weights for new treated units
+
+        :param X_treat: Matrix of covariates for the treated units
+        :return: (N1 x N0) matrix of weights
+        """
+        X_treat = np.asarray(X_treat, dtype=float)
+        if X_treat.ndim == 1:
+            X_treat = X_treat[None, :]
+        N0 = self.X_control_.shape[0]
+        B = self._X_c_active.dot((X_treat[:, self.active_] * self._scale).T) + 2 * self.L2_PEN_W_ / N0
+        return cho_solve(self.cho_, B).T
+
+    def predict(self, Y_control, X_treat=None):
+        """ The synthetic outcomes for the treated units
+
+        :param Y_control: Matrix of outcomes for the control units (any periods)
+        :param X_treat: Matrix of covariates for the treated units.  Defaults to
+            the treated units passed to fit().
+        """
+        return self._weights(X_treat).dot(np.asarray(Y_control))
+
+    def effects(self, Y_treat, Y_control, X_treat=None):
+        """ The difference between the outcomes of the treated units and their
+            synthetic outcomes
+
+        :param Y_treat: Matrix of outcomes for the treated units
+        :param Y_control: Matrix of outcomes for the control units (same periods)
+        :param X_treat: Matrix of covariates for the treated units.  Defaults to
+            the treated units passed to fit().
+        """
+        return np.asarray(Y_treat) - self.predict(Y_control, X_treat)
+
+    def save(self, path):
+        """ Saves the fitted model to a directory (see SparseSC.utils.persistence)
+
+        The tensor matrix, the penalties, the Cholesky factor, the weights
+        and the data needed by add_periods() and add_controls() are saved.
+        Arguments (`grad_splits` and `kwargs`) which cannot be stored as JSON
+        are dropped with a warning; they are only needed to re-fit V.
+
+        :param path: directory to write
+        """
+        if not hasattr(self, "V_"):
+            raise ValueError("The model has not been fit")
+        params = dict(self.kwargs, grad_splits = self.grad_splits)
+        for key, value in list(params.items()):
+            try:
+                json.dumps(value)
+            except TypeError:
+                warnings.warn("The argument `%s` cannot be saved and was dropped" % key)
+                del params[key]
+        attrs = {"LAMBDA": float(self.LAMBDA),
+                 "L2_PEN_W": None if self.L2_PEN_W is None else float(self.L2_PEN_W),
+                 "grad_splits": params.pop("grad_splits", None),
+                 "kwargs": params,
+                 "L2_PEN_W_": float(self.L2_PEN_W_)}
+        arrays = dict((name, getattr(self, name)) for name in _SAVED_ARRAYS)
+        arrays["cho_"] = self.cho_[0]
+        save_arrays(path, "SyntheticControl", arrays, attrs)
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        """ Loads a model saved by save()
+
+        :param path: the directory passed to save()
+        :param mmap_mode: "r" (the default) memory maps the arrays read-only;
+            None reads them into memory
+
+        :return: the fitted model
+        """
+        attrs, arrays = load_arrays(path, "SyntheticControl", mmap_mode)
+        model = cls(LAMBDA = attrs["LAMBDA"],
+                    L2_PEN_W = attrs["L2_PEN_W"],
+                    grad_splits = attrs["grad_splits"],
+                    **attrs["kwargs"])
+        model.L2_PEN_W_ = attrs["L2_PEN_W_"]
+        for name in _SAVED_ARRAYS:
+            setattr(model, name, arrays.get(name))
+        model.cho_ = (arrays["cho_"], True)
+        return model
+
+    def _weights(self, X_treat):
+        if X_treat is not None:
+            return self.weights_for(X_treat)
+        if self.weights_ is None:
+            raise ValueError("X_treat is required when the model was fit without treated units")
+        return self.weights_
@@ -2,6 +2,12 @@ from numpy import ones, diag, matrix, ndarray, zeros, absolute, mean,var, linalg
 import numpy as np
 import warnings
 from SparseSC.optimizers.cd_line_search import cdl_search
+from SparseSC.utils.ridge_path import ridge_path_solve
+from SparseSC.utils.validation import as_float_array
+from SparseSC.utils.mixed_precision import gram_matvec, refined_solve
+from SparseSC.utils.sparse_matrix import gram, column, mean_var, issparse
+from SparseSC.utils.pruning import prune
+from SparseSC.utils.instrumentation import FitStats, report, count_weights, timer
 warnings.filterwarnings('ignore')
 
 def ct_v_matrix(X,
@@ -14,6 +20,7 @@ def ct_v_matrix(X,
                 method = cdl_search, 
                 intercept = True,
                 max_lambda = False,  # this is terrible at least without documentation...
+                dtype = np.float64,
                 verbose = False,
                 **kwargs):
     '''
@@ -33,6 +40,8 @@ def ct_v_matrix(X,
         of controls, else weights are penalized toward zero
     :param max_lambda: if True, the return value is the maximum L1 penalty for
         which at least one element of the tensor matrix is non-zero
+    :param dtype: floating point type (np.float64 or np.float32) used to build
+        and solve the control system; see SparseSC.utils.mixed_precision
     :param verbose: If true, print progress to the console (default: false)
     :param kwargs: additional arguments passed to the optimizer
 
@@ -55,14 +64,8 @@ def ct_v_matrix(X,
     # Parameter QC
     if set(treated_units).intersection(control_units):
         raise ValueError("Treated and Control units must be exclusive")
-    try:
-        X = np.asmatrix(X)
-    except ValueError:
-        raise ValueError("X is not coercible to a matrix")
-    try:
-        Y = np.asmatrix(Y)
-    except ValueError:
-        raise ValueError("Y is not coercible to a matrix")
+    X = as_float_array(X, "X", dtype=dtype, accept_sparse=True)
+    Y = as_float_array(Y, "Y", dtype=dtype)
     if X.shape[1] == 0:
         raise ValueError("X.shape[1] == 0")
     if Y.shape[1] == 0:
@@ -72,7 +75,7 @@ def ct_v_matrix(X,
     if not isinstance(LAMBDA, (float, int)):
         raise TypeError( "LAMBDA is not a number")
     if L2_PEN_W is None:
-        L2_PEN_W = mean(var(X, axis = 0))
+        L2_PEN_W = mean_var(X)
     else: 
         L2_PEN_W = float(L2_PEN_W)
     if not isinstance(L2_PEN_W, (float, int)):
@@ -86,15 +89,26 @@ def ct_v_matrix(X,
     Y_control = Y[control_units,:]
     X_treated = X[treated_units,:]
     X_control = X[control_units,:]
+    # fast access to the columns of a sparse X
+    X_treated_cols = X_treated.tocsc() if issparse(X) else X_treated
+    X_control_cols = X_control.tocsc() if issparse(X) else X_control
 
-    # INITIALIZE PARTIAL DERIVATIVES
-    dA_dV_ki = [ 2 * X_control[:, k ].dot(X_control[:, k ].T) for k in range(K)] # 8
-    dB_dV_ki = [ 2 * X_control[:, k ].dot(X_treated[:, k ].T) for k in range(K)] # 9
+    # PARTIAL DERIVATIVES
+    # For moment k, dA_dV_ki = 2 * outer(X_control[:, k], X_control[:, k]) # 8
+    #           and dB_dV_ki = 2 * outer(X_control[:, k], X_treated[:, k]) # 9
+    # are rank one, so (dB - dA.dot(b)) is computed as 2 * outer(x, xt - x.dot(b))
+    # rather than storing K (N0 x N0) matrices
+
+    # INSTRUMENTATION (see SparseSC.utils.instrumentation)
+    stats = FitStats()
+    solve = stats.solver(linalg.solve)
+    # per gradient: dGamma0_dV_term2 and a right hand side and dPI_dV per moment
+    derivative_bytes = (2 * K * N0 * N1 * X.dtype.itemsize + 8 * K, 2 * N0 * N1 * X.dtype.itemsize + 8 * K)
 
     def _score(V):
         dv = diag(V)
         weights, _, _ ,_ = _weights(dv)
-        Ey = (Y_treated - weights.T.dot(Y_control)).getA()
+        Ey = Y_treated - weights.T.dot(Y_control)
         # note that (...).copy() assures that x.flags.writeable is True:
         return (np.einsum('ij,ij->',Ey,Ey) + LAMBDA * absolute(V).sum()).copy() # (Ey **2).sum() -> einsum
 
@@ -105,31 +119,35 @@ def ct_v_matrix(X,
         """
         dv = diag(V)
         weights, A, _, AinvB = _weights(dv)
-        Ey = (weights.T.dot(Y_control) - Y_treated).getA()
+        Ey = weights.T.dot(Y_control) - Y_treated
         dGamma0_dV_term2 = zeros(K)
+        stats.count_derivatives(*derivative_bytes)
         #dPI_dV = zeros((N0, N1)) # stupid notation: PI = W.T
         #Ai = A.I
         for k in range(K):
             if verbose:  # for large sample sizes, linalg.solve is a huge bottle neck,
                 print("Calculating gradient, linalg.solve() call %s of %s" % (k ,K,))
             #dPI_dV.fill(0) # faster than re-allocating the memory each loop.
-            dA = dA_dV_ki[k]
-            dB = dB_dV_ki[k]
-            dPI_dV = linalg.solve(A,(dB - dA.dot(AinvB))) 
+            x = column(X_control_cols, k)
+            dPI_dV = solve(A,2 * np.outer(x, column(X_treated_cols, k) - x.dot(AinvB))) # dB - dA.dot(AinvB)
             #dPI_dV = Ai.dot(dB - dA.dot(AinvB))
             dGamma0_dV_term2[k] = np.einsum("ij,kj,ki->",Ey, Y_control, dPI_dV)  # (Ey * Y_control.T.dot(dPI_dV).T.getA()).sum()
         return LAMBDA + 2 * dGamma0_dV_term2
 
-    L2_PEN_W_mat = 2 * L2_PEN_W * diag(ones(X_control.shape[0]))
+    L2_PEN_W_mat = 2 * L2_PEN_W * diag(ones(X_control.shape[0], dtype=X.dtype))
     def _weights(V):
-        weights = zeros((N0, N1))
-        A = X_control.dot(2*V).dot(X_control.T) + L2_PEN_W_mat # 5
-        B = X_treated.dot(2*V).dot(X_control.T).T + 2 * L2_PEN_W / X_control.shape[0] # 6
-        b = linalg.solve(A,B)
+        V = V.astype(X.dtype, copy=False)
+        weights = zeros((N0, N1), dtype=X.dtype)
+        A = gram(X_control, 2*V) + L2_PEN_W_mat # 5
+        B = gram(X_treated, 2*V, X_control).T + 2 * L2_PEN_W / X_control.shape[0] # 6
+        b = solve(A,B)
         return weights, A, B,b
 
+    _score, _grad, _weights = stats.timed("score", _score), stats.timed("grad", _grad), stats.timed("weights", _weights)
+
     if max_lambda:
         grad0 = _grad(zeros(K))
+        report(stats)
         return -grad0[grad0 < 0].min()
 
     # DO THE OPTIMIZATION
@@ -146,10 +164,24 @@ def ct_v_matrix(X,
     errors = Y_treated - weights.T.dot(Y_control)
     ts_loss = opt.fun
     ts_score = linalg.norm(errors) / sqrt(prod(errors.shape))
+    stats.fits, stats.iterations = 1, getattr(opt, "nit", 0)
+    opt.stats = stats
+    report(stats)
 
     return weights, v_mat, ts_score, ts_loss, L2_PEN_W, opt
 
-def ct_weights(X, V, L2_PEN_W, treated_units = None, control_units = None, intercept = True):
+def ct_weights(X, V, L2_PEN_W, treated_units = None, control_units = None, intercept = True,
+               dtype = np.float64, refine = 0):
+    """ Computes the weights for the treated units
+
+    :param dtype: floating point type (np.float64 or np.float32) used to build
+        and factor the control system
+    :param refine: number of steps of iterative refinement against the
+        float64 system (see SparseSC.utils.mixed_precision)
+    """
+    start = timer()
+    X = as_float_array(X, "X", accept_sparse=True)
+    X, V = prune(X, V) # only the active covariates enter the control system
     if treated_units is None: 
         if control_units is None: 
             raise ValueError("At least on of treated_units or control_units is required")
@@ -162,10 +194,13 @@ def ct_weights(X, V, L2_PEN_W, treated_units = None, control_units = None, inter
     X_treated = X[treated_units,:]
     X_control = X[control_units,:]
 
-    A = X_control.dot(2*V).dot(X_control.T)   + 2 * L2_PEN_W * diag(ones(X_control.shape[0])) # 5
-    B = X_treated.dot(2*V).dot(X_control.T).T + 2 * L2_PEN_W / X_control.shape[0]# 6
+    X_control_lo = X_control.astype(dtype, copy=False)
+    V_lo = np.asarray(2*V, dtype=dtype)
+    A = gram(X_control_lo, V_lo) + 2 * L2_PEN_W * diag(ones(X_control.shape[0], dtype=dtype)) # 5
+    B = gram(X_treated, 2*V, X_control).T + 2 * L2_PEN_W / X_control.shape[0]# 6
 
-    weights = linalg.solve(A,B)
+    weights = refined_solve(A, B, gram_matvec(X_control, 2*V, L2_PEN_W) if refine else None, refine)
+    count_weights(start, [N0])
     return weights.T
 
 def ct_score(Y, X, V, L2_PEN_W, LAMBDA = 0, treated_units = None, control_units = None,**kwargs):
@@ -176,6 +211,15 @@ def ct_score(Y, X, V, L2_PEN_W, LAMBDA = 0, treated_units = None, control_units
         treated_units = list(set(range(X.shape[0])) - set(control_units))  
     if control_units is None: 
         control_units = list(set(range(X.shape[0])) - set(treated_units)) 
+
+    try:
+        iter(L2_PEN_W)
+    except TypeError:
+        pass
+    else:
+        # L2_PEN_W is an iterable of values: score them all using a single eigendecomposition
+        return _ct_score_l2_path(Y, X, V, L2_PEN_W, LAMBDA, treated_units, control_units, **kwargs)
+
     weights = ct_weights(X = X,
                          V = V,
                          L2_PEN_W = L2_PEN_W,
@@ -184,6 +228,30 @@ def ct_score(Y, X, V, L2_PEN_W, LAMBDA = 0, treated_units = None, control_units
                          **kwargs)
     Y_tr = Y[treated_units, :]
     Y_c = Y[control_units, :]
-    Ey = (Y_tr - weights.dot(Y_c)).getA()
+    Ey = np.asarray(Y_tr - weights.dot(Y_c))
     return np.einsum('ij,ij->',Ey,Ey) + LAMBDA * V.sum() # (Ey **2).sum() -> einsum
 
+
+def _ct_score_l2_path(Y, X, V, L2_PEN_W, LAMBDA, treated_units, control_units,
+                      intercept = True, dtype = np.float64, refine = 0):
+    """ ct_score() for each element of `L2_PEN_W` (see SparseSC.utils.ridge_path),
+        taking the same keyword arguments as ct_weights()
+    """
+    if refine:
+        raise ValueError("refine is not supported for an iterable L2_PEN_W, which is solved by eigendecomposition")
+    X = as_float_array(X, "X", dtype=dtype, accept_sparse=True)
+    Y = np.asarray(Y)
+    V = np.asarray(V, dtype=dtype)
+    X, V = prune(X, V)
+    X_treated = X[treated_units,:]
+    X_control = X[control_units,:]
+    Y_tr = Y[treated_units, :]
+    Y_c = Y[control_units, :]
+
+    G = gram(X_control, 2*V) # 5
+    B = gram(X_treated, 2*V, X_control).T # 6
+    scores = []
+    for b in ridge_path_solve(G, B, L2_PEN_W):
+        Ey = Y_tr - b.T.dot(Y_c)
+        scores.append(np.einsum('ij,ij->',Ey,Ey) + LAMBDA * V.sum())
+    return np.array(scores)
@@ -1,9 +1,14 @@
 from numpy import ones, diag, array, matrix, ndarray, zeros, mean,var, linalg, prod, sqrt, absolute
 import numpy as np
-import itertools
 import warnings
 #from SparseSC.utils.sub_matrix_inverse import subinv_k, all_subinverses
 from SparseSC.optimizers.cd_line_search import cdl_search
+from SparseSC.utils.ridge_path import ridge_path_solve
+from SparseSC.utils.validation import as_float_array
+from SparseSC.utils.mixed_precision import gram_matvec, refined_solve
+from SparseSC.utils.sparse_matrix import gram, column, mean_var, issparse
+from SparseSC.utils.pruning import prune
+from SparseSC.utils.instrumentation import FitStats, report, count_weights, timer
 warnings.filterwarnings('ignore')
 
 
@@ -20,6 +25,7 @@ def fold_v_matrix(X,
                   max_lambda = False,  # this is terrible at least without documentation...
                   grad_splits = 5,
                   random_state = 10101,
+                  dtype = np.float64,
                   verbose = False,
                   **kwargs):
     '''
@@ -45,6 +51,8 @@ def fold_v_matrix(X,
                         descent step. An integer, or a list/generator of train
                         and test units in each fold of the gradient descent.
     :param random_state: Integer, used for setting the random state for consistency of fold splits across calls
+    :param dtype: floating point type (np.float64 or np.float32) used to build
+        and solve the control system; see SparseSC.utils.mixed_precision
     :param verbose: If true, print progress to the console (default: false)
     :param kwargs: additional arguments passed to the optimizer
     :param non_neg_weights: not implemented
@@ -74,14 +82,8 @@ def fold_v_matrix(X,
     treated_units = np.array(treated_units)
 
     # parameter QC
-    try:
-        X = np.asmatrix(X)
-    except ValueError:
-        raise ValueError("X is not coercible to a matrix")
-    try:
-        Y = np.asmatrix(Y)
-    except ValueError:
-        raise ValueError("Y is not coercible to a matrix")
+    X = as_float_array(X, "X", dtype=dtype, accept_sparse=True)
+    Y = as_float_array(Y, "Y", dtype=dtype)
     if X.shape[1] == 0:
         raise ValueError("X.shape[1] == 0")
     if Y.shape[1] == 0:
@@ -91,7 +93,7 @@ def fold_v_matrix(X,
     if not isinstance(LAMBDA, (float, int)):
         raise TypeError( "LAMBDA is not a number")
     if L2_PEN_W is None:
-        L2_PEN_W = mean(var(X, axis = 0))
+        L2_PEN_W = mean_var(X)
     else: 
         L2_PEN_W = float(L2_PEN_W)
     if not isinstance(L2_PEN_W, (float, int)):
@@ -131,25 +133,28 @@ def fold_v_matrix(X,
     # handy constants (for speed purposes):
     Y_treated = Y[treated_units,:]
     Y_control = Y[control_units,:]
-
-    # INITIALIZE PARTIAL DERIVATIVES
-    dA_dV_ki = [ [None,] *N1 for i in range(K)]
-    dB_dV_ki = [ [None,] *N1 for i in range(K)]
+    X_cols = X.tocsc() if issparse(X) else X # fast access to the columns of a sparse X
+
+    # PARTIAL DERIVATIVES
+    # For gradient fold i and moment k, with x = X[in_controls[i], k] and xt = X[treated_units[test], k]:
+    #     dA_dV_ki = 2 * x.dot(x.T) # 8
+    #     dB_dV_ki = 2 * x.dot(xt.T) # 9
+    # are rank one, so (dB - dA.dot(b)) is computed as 2 * outer(x, xt - x.dot(b))
+    # rather than storing the matrices
     b_i = [None,] *N1 
-    for i, k in  itertools.product(range(len(splits)), range(K)): # TREATED unit i, moment k
-        _, test = splits[i]
-        Xc = X[in_controls[i], : ]
-        Xt = X[treated_units[test], : ]
-        dA_dV_ki [k][i] = 2 * Xc[:, k ].dot(Xc[:, k ].T) # Xc[:, k ].dot(Xc[:, k ].T) + Xc[:, k ].dot(Xc[:, k ].T) # 8
-        dB_dV_ki [k][i] = 2 * Xc[:, k ].dot(Xt[:, k ].T) # Xc[:, k ].dot(Xt[:, k ].T) + Xt[:, k ].dot(Xc[:, k ].T) # 9
 
-    k=0 # for linting...
-    del Xc, Xt, i, k
+    # INSTRUMENTATION (see SparseSC.utils.instrumentation)
+    stats = FitStats()
+    solve = stats.solver(linalg.solve)
+    # per gradient: dPI_dV, dGamma0_dV_term2 and a right hand side and solution per (fold, moment)
+    rhs_size = [len(index) * len(test) for index, (_, test) in zip(in_controls, splits)]
+    derivative_bytes = (X.dtype.itemsize * (N0 * N1 + 2 * K * sum(rhs_size)) + 8 * K,
+                        X.dtype.itemsize * (N0 * N1 + 2 * max(rhs_size)) + 8 * K)
 
     def _score(V):
         dv = diag(V)
         weights, _, _ = _weights(dv)
-        Ey = (Y_treated - weights.T.dot(Y_control)).getA()
+        Ey = Y_treated - weights.T.dot(Y_control)
         # (...).copy() assures that x.flags.writeable is True
         return (np.einsum('ij,ij->',Ey,Ey) + LAMBDA * absolute(V).sum()).copy()  # (Ey **2).sum() -> einsum
 
@@ -162,35 +167,41 @@ def fold_v_matrix(X,
         weights, A, _ = _weights(dv)
         #Ey = (weights.T.dot(Y_control) - Y_treated).getA()
         dGamma0_dV_term2 = zeros(K)
-        dPI_dV = zeros((N0, N1)) # stupid notation: PI = W.T
+        dPI_dV = zeros((N0, N1), dtype=X.dtype) # stupid notation: PI = W.T
+        stats.count_derivatives(*derivative_bytes)
         for k in range(K):
             if verbose:  # for large sample sizes, linalg.solve is a huge bottle neck,
                 print("Calculating gradient, for moment %s of %s" % (k ,K,))
             dPI_dV.fill(0) # faster than re-allocating the memory each loop.
+            X_k = column(X_cols, k)
             for i, (_, (_, test)) in enumerate(zip(in_controls,splits)):
                 if verbose >=2:  # for large sample sizes, linalg.solve is a huge bottle neck,
                     print("Calculating gradient, linalg.solve() call %s of %s" % (i + k*len(splits) ,K*len(splits),))
-                dA = dA_dV_ki[k][i]
-                dB = dB_dV_ki[k][i]
-                b = linalg.solve(A[in_controls2[i]],dB - dA.dot(b_i[i]))
+                x = X_k[in_controls[i]]
+                dB_dA_b = 2 * np.outer(x, X_k[treated_units[test]] - x.dot(b_i[i])) # dB - dA.dot(b_i[i])
+                b = solve(A[in_controls2[i]],dB_dA_b)
                 dPI_dV[np.ix_(in_controls[i], treated_units[test])] = b
             dGamma0_dV_term2[k] = 2 * np.einsum("ij,kj,ki->",(weights.T.dot(Y_control) - Y_treated), Y_control, dPI_dV) # (Ey * Y_control.T.dot(dPI_dV).T.getA()).sum()
         return LAMBDA + dGamma0_dV_term2 
 
     def _weights(V):
-        weights = zeros((N0, N1))
-        A = X.dot(V + V.T).dot(X.T) + 2 * L2_PEN_W * diag(ones(X.shape[0])) # 5
-        B = X.dot(V + V.T).dot(X.T).T # 6
+        V = V.astype(X.dtype, copy=False)
+        weights = zeros((N0, N1), dtype=X.dtype)
+        A = gram(X, V + V.T) + 2 * L2_PEN_W * diag(ones(X.shape[0], dtype=X.dtype)) # 5
+        B = gram(X, V + V.T).T # 6
         for i, (control,test) in enumerate(splits):
             if verbose >=2:  # for large sample sizes, linalg.solve is a huge bottle neck,
                 print("Calculating weights, linalg.solve() call %s of %s" % (i,len(splits),))
-            b = b_i[i] = linalg.solve(A[in_controls2[i]], 
+            b = b_i[i] = solve(A[in_controls2[i]], 
                                         B[np.ix_(in_controls[i], treated_units[test])] + 2 * L2_PEN_W / len(in_controls[i]) )
             weights[np.ix_(out_controls[i], test)] = b
         return weights, A, B
 
+    _score, _grad, _weights = stats.timed("score", _score), stats.timed("grad", _grad), stats.timed("weights", _weights)
+
     if max_lambda:
         grad0 = _grad(zeros(K))
+        report(stats)
         return -grad0[grad0 < 0].min()
 
     # DO THE OPTIMIZATION
@@ -206,6 +217,9 @@ def fold_v_matrix(X,
     errors = Y_treated - weights.T.dot(Y_control)
     ts_loss = opt.fun
     ts_score = linalg.norm(errors) / sqrt(prod(errors.shape))
+    stats.fits, stats.iterations = 1, getattr(opt, "nit", 0)
+    opt.stats = stats
+    report(stats)
 
     return weights, v_mat, ts_score, ts_loss, L2_PEN_W, opt
 
@@ -219,9 +233,21 @@ def fold_weights(X,
                  intercept = True,
                  grad_splits = 5,
                  random_state = 10101,
-                 verbose=False):
+                 verbose=False,
+                 dtype = np.float64,
+                 refine = 0):
+    """ Computes the k-fold weights for the treated units
+
+    :param dtype: floating point type (np.float64 or np.float32) used to build
+        and factor the control system
+    :param refine: number of steps of iterative refinement against the
+        float64 system (see SparseSC.utils.mixed_precision)
+    """
+    start = timer()
+    X = as_float_array(X, "X", accept_sparse=True)
     if L2_PEN_W is None:
-        L2_PEN_W = mean(var(X, axis = 0))
+        L2_PEN_W = mean_var(X)
+    X, V = prune(X, V) # only the active covariates enter the control system
     if treated_units is None: 
         if control_units is None: 
             # both not provided, include all samples as both treat and control unit.
@@ -261,16 +287,27 @@ def fold_weights(X,
     # X_treat = X[treated_units,:]
     weights = zeros((N0, N1))
 
-    A = X.dot(V + V.T).dot(X.T) + 2 * L2_PEN_W * diag(ones(X.shape[0])) # 5
-    B = X.dot(V + V.T).dot(X.T).T # 6
+    X_lo = X.astype(dtype, copy=False)
+    VV = np.asarray(V + V.T)
+    A = gram(X_lo, VV.astype(dtype)) + 2 * L2_PEN_W * diag(ones(X.shape[0], dtype=dtype)) # 5
+    B = gram(X_lo, VV.astype(dtype)).T # 6
 
     for i, (_,test) in enumerate(splits):
         if verbose >=2:  # for large sample sizes, linalg.solve is a huge bottle neck,
             print("Calculating weights, linalg.solve() call %s of %s" % (i,len(splits),))
-        b = linalg.solve(A[in_controls2[i]], 
-                         B[np.ix_(in_controls[i], treated_units[test])] + 2 * L2_PEN_W / len(in_controls[i]))
+        if refine:
+            # float64 right hand side for the iterative refinement
+            X_c = X[in_controls[i], :]
+            b = refined_solve(A[in_controls2[i]],
+                              gram(X_c, VV, X[treated_units[test], :]) + 2 * L2_PEN_W / len(in_controls[i]),
+                              gram_matvec(X_c, VV, L2_PEN_W),
+                              refine)
+        else:
+            b = linalg.solve(A[in_controls2[i]], 
+                             B[np.ix_(in_controls[i], treated_units[test])] + 2 * L2_PEN_W / len(in_controls[i]))
         indx2 = np.ix_(out_controls[i], test)
         weights[indx2] = b
+    count_weights(start, map(len, in_controls))
     return weights.T
 
 
@@ -288,6 +325,16 @@ def fold_score(Y, X, V, L2_PEN_W, LAMBDA = 0, treated_units = None, control_unit
         if control_units is None: 
             # Set the control units to the not-treated units
             control_units = list(set(range(X.shape[0])) - set(treated_units)) 
+
+    try:
+        iter(L2_PEN_W)
+    except TypeError:
+        pass
+    else:
+        # L2_PEN_W is an iterable of values: score them all using a single
+        # eigendecomposition of each sub-problem
+        return _fold_score_l2_path(Y, X, V, L2_PEN_W, LAMBDA, treated_units, control_units, **kwargs)
+
     weights = fold_weights(X = X,
                            V = V,
                            L2_PEN_W = L2_PEN_W,
@@ -296,5 +343,47 @@ def fold_score(Y, X, V, L2_PEN_W, LAMBDA = 0, treated_units = None, control_unit
                            **kwargs)
     Y_tr = Y[treated_units, :]
     Y_c = Y[control_units, :]
-    Ey = (Y_tr - weights.dot(Y_c)).getA()
+    Ey = np.asarray(Y_tr - weights.dot(Y_c))
     return np.einsum('ij,ij->',Ey,Ey) + LAMBDA * V.sum() # (Ey **2).sum() -> einsum
+
+
+def _fold_score_l2_path(Y, X, V, L2_PEN_W, LAMBDA, treated_units, control_units,
+                        intercept = True, grad_splits = 5, random_state = 10101, verbose = False,
+                        dtype = np.float64, refine = 0):
+    """ fold_score() for each element of `L2_PEN_W` (see SparseSC.utils.ridge_path),
+        taking the same keyword arguments as fold_weights()
+    """
+    if refine:
+        raise ValueError("refine is not supported for an iterable L2_PEN_W, which is solved by eigendecomposition")
+    control_units = np.array(control_units)
+    treated_units = np.array(treated_units)
+    X = as_float_array(X, "X", dtype=dtype, accept_sparse=True)
+    Y = np.asarray(Y)
+    V = np.asarray(V, dtype=dtype)
+    X, V = prune(X, V)
+    L2_PEN_W = list(L2_PEN_W)
+
+    # the same splits and indexes as fold_weights()
+    splits = grad_splits # for readability...
+    try:
+        iter(splits)
+    except TypeError: 
+        from sklearn.model_selection import KFold
+        splits = KFold(splits, shuffle=True, random_state = random_state).split(np.arange(len(treated_units)))
+    splits = list(splits)
+    in_controls = [list(set(control_units) - set(treated_units[test])) for _,test in splits]
+    ctrl_rng = np.arange(len(control_units))
+    out_controls = [ctrl_rng[np.logical_not(np.isin(control_units, treated_units[test]))] for _,test in splits] 
+
+    Y_tr = Y[treated_units, :]
+    Y_c = Y[control_units, :]
+    G = gram(X, V + V.T) # 5
+
+    sse = np.zeros(len(L2_PEN_W))
+    for i, (_,test) in enumerate(splits):
+        Y_c_i = Y_c[out_controls[i], :]
+        for j, b in enumerate(ridge_path_solve(G[np.ix_(in_controls[i], in_controls[i])],
+                                               G[np.ix_(in_controls[i], treated_units[test])], L2_PEN_W)):
+            Ey = Y_tr[test, :] - b.T.dot(Y_c_i)
+            sse[j] += np.einsum('ij,ij->',Ey,Ey)
+    return sse + LAMBDA * V.sum()
@@ -1,10 +1,15 @@
 from numpy import ones, diag, matrix, ndarray, zeros, absolute, mean,var, linalg, prod, sqrt
 import numpy as np
-import itertools
 import warnings
 # only used by the step-down method (currently not implemented):
 # from SparseSC.utils.sub_matrix_inverse import subinv_k, all_subinverses
 from SparseSC.optimizers.cd_line_search import cdl_search
+from SparseSC.utils.ridge_path import ridge_path_solve
+from SparseSC.utils.validation import as_float_array
+from SparseSC.utils.mixed_precision import gram_matvec, refined_solve
+from SparseSC.utils.sparse_matrix import gram, column, mean_var, issparse
+from SparseSC.utils.pruning import prune
+from SparseSC.utils.instrumentation import FitStats, report, count_weights, timer
 warnings.filterwarnings('ignore')
 
 def complete_treated_control_list(N, treated_units = None, control_units = None):
@@ -34,6 +39,7 @@ def loo_v_matrix(X,
                  intercept = True,
                  max_lambda = False,  # this is terrible at least without documentation...
                  solve_method = "standard",
+                 dtype = np.float64,
                  verbose = False,
                  **kwargs):
     '''
@@ -56,6 +62,8 @@ def loo_v_matrix(X,
         which at least one element of the tensor matrix is non-zero
     :param solve_method: Method for solving A.I.dot(B). Either "standard" or
         "step-down". https://math.stackexchange.com/a/208021/252693
+    :param dtype: floating point type (np.float64 or np.float32) used to build
+        and solve the control system; see SparseSC.utils.mixed_precision
     :param verbose: If true, print progress to the console (default: false)
     :param kwargs: additional arguments passed to the optimizer
     :param non_neg_weights: not implemented
@@ -71,14 +79,8 @@ def loo_v_matrix(X,
     treated_units = np.array(treated_units)
 
     # parameter QC
-    try:
-        X = np.asmatrix(X)
-    except ValueError:
-        raise TypeError("X is not coercible to a matrix")
-    try:
-        Y = np.asmatrix(Y)
-    except ValueError:
-        raise TypeError("Y is not coercible to a matrix")
+    X = as_float_array(X, "X", TypeError, dtype, accept_sparse=True)
+    Y = as_float_array(Y, "Y", TypeError, dtype)
     if X.shape[1] == 0:
         raise ValueError("X.shape[1] == 0")
     if Y.shape[1] == 0:
@@ -88,7 +90,7 @@ def loo_v_matrix(X,
     if not isinstance(LAMBDA, (float, int)):
         raise TypeError( "LAMBDA is not a number")
     if L2_PEN_W is None:
-        L2_PEN_W = mean(var(X, axis = 0))
+        L2_PEN_W = mean_var(X)
     else: 
         L2_PEN_W = float(L2_PEN_W)
     if not isinstance(L2_PEN_W, (float, int)):
@@ -119,30 +121,31 @@ def loo_v_matrix(X,
     # handy constants (for speed purposes):
     Y_treated = Y[treated_units,:]
     Y_control = Y[control_units,:]
+    X_cols = X.tocsc() if issparse(X) else X # fast access to the columns of a sparse X
     # only used by step-down method: X_treated = X[treated_units,:]
     # only used by step-down method: X_control = X[control_units,:]
 
-    # INITIALIZE PARTIAL DERIVATIVES
-    # note that this section can be quite memory intensive with lots of controls: (1000 controls -> 8 MB per entry)
-    dA_dV_ki = [ [None,] *N1 for i in range(K)]
-    dB_dV_ki = [ [None,] *N1 for i in range(K)]
+    # PARTIAL DERIVATIVES
+    # For treated unit i and moment k, with x = X[in_controls[i], k] and xt = X[treated_units[i], k]:
+    #     dA_dV_ki = 2 * x.dot(x.T) # 8
+    #     dB_dV_ki = 2 * x * xt     # 9
+    # are rank one, so (dB - dA.dot(b)) is computed as 2 * x * (xt - x.dot(b))
+    # rather than storing K * N1 (N0 x N0) matrices (1000 controls -> 8 MB per entry)
+    # https://math.stackexchange.com/a/1471836/252693
     b_i = [None,] *N1 
-    for i, k in  itertools.product(range(N1), range(K)): # TREATED unit i, moment k
-        Xc = X[in_controls[i], : ]
-        Xt = X[treated_units[i], : ]
-        dA_dV_ki [k][i] = 2 * Xc[:, k ].dot(Xc[:, k ].T) # Xc[:, k ].dot(Xc[:, k ].T) + Xc[:, k ].dot(Xc[:, k ].T) # 8
-        dB_dV_ki [k][i] = 2 * Xc[:, k ].dot(Xt[:, k ].T) # Xc[:, k ].dot(Xt[:, k ].T) + Xt[:, k ].dot(Xc[:, k ].T) # 9
-
-    k=0 # for linting...
-    del Xc, Xt, i, k
 
-        #assert (dA_dV_ki [k][i] == X[index, k ].dot(X[index, k ].T) + X[index, k ].dot(X[index, k ].T)).all()
-        # https://math.stackexchange.com/a/1471836/252693
+    # INSTRUMENTATION (see SparseSC.utils.instrumentation)
+    stats = FitStats()
+    solve = stats.solver(linalg.solve)
+    # per gradient: dPI_dV, dGamma0_dV_term2 and a right hand side and solution per (unit, moment)
+    rhs_rows = [len(index) for index in in_controls]
+    derivative_bytes = (X.dtype.itemsize * (N0 * N1 + 2 * K * sum(rhs_rows)) + 8 * K,
+                        X.dtype.itemsize * (N0 * N1 + 2 * max(rhs_rows)) + 8 * K)
 
     def _score(V):
         dv = diag(V)
         weights, _, _ = _weights(dv)
-        Ey = (Y_treated - weights.T.dot(Y_control)).getA()
+        Ey = Y_treated - weights.T.dot(Y_control)
         # (...).copy() assures that x.flags.writeable is True:
         return (np.einsum('ij,ij->',Ey,Ey) + LAMBDA * absolute(V).sum()).copy()  # (Ey **2).sum() -> einsum
 
@@ -153,17 +156,19 @@ def loo_v_matrix(X,
         """
         dv = diag(V)
         weights, A, _ = _weights(dv)
-        Ey = (weights.T.dot(Y_control) - Y_treated).getA()
+        Ey = weights.T.dot(Y_control) - Y_treated
         dGamma0_dV_term2 = zeros(K)
-        dPI_dV = zeros((N0, N1)) # stupid notation: PI = W.T
+        dPI_dV = zeros((N0, N1), dtype=X.dtype) # stupid notation: PI = W.T
+        stats.count_derivatives(*derivative_bytes)
         # if solve_method == "step-down": Ai_cache = all_subinverses(A)
         for k in range(K):
             if verbose:  # for large sample sizes, linalg.solve is a huge bottle neck,
                 print("Calculating gradient for moment %s of %s" % (k ,K,))
             dPI_dV.fill(0) # faster than re-allocating the memory each loop.
+            X_k = column(X_cols, k)
             for i, index in enumerate(in_controls):
-                dA = dA_dV_ki[k][i]
-                dB = dB_dV_ki[k][i]
+                x = X_k[index]
+                dB_dA_b = 2 * x * (X_k[treated_units[i]] - x.dot(b_i[i])) # dB - dA.dot(b_i[i])
                 if solve_method == "step-down":
                     raise NotImplementedError("The solve_method 'step-down' is currently not implemented")
                     # b = Ai_cache[i].dot(dB - dA.dot(b_i[i]))
@@ -172,13 +177,14 @@ def loo_v_matrix(X,
                         print("Calculating weights, linalg.solve() call %s of %s" % 
                               (i + k*K , 
                                K * len(in_controls),))
-                    b = linalg.solve(A[in_controls2[i]],dB - dA.dot(b_i[i]))
+                    b = solve(A[in_controls2[i]],dB_dA_b)
                 dPI_dV[index, i] = b.flatten() # TODO: is the Transpose  an error???
             dGamma0_dV_term2[k] = 2 * np.einsum("ij,kj,ki->",Ey, Y_control, dPI_dV) # (Ey * Y_control.T.dot(dPI_dV).T.getA()).sum()
         return LAMBDA + dGamma0_dV_term2 
 
     def _weights(V):
-        weights = zeros((N0, N1))
+        V = V.astype(X.dtype, copy=False)
+        weights = zeros((N0, N1), dtype=X.dtype)
         if solve_method == "step-down":
             raise NotImplementedError("The solve_method 'step-down' is currently not implemented")
             # A = X_control.dot(V + V.T).dot(X_control.T) + 2 * L2_PEN_W * diag(ones(X_control.shape[0])) # 5
@@ -192,20 +198,23 @@ def loo_v_matrix(X,
             #     b_i[i] = b
             #     weights[out_controls[i], i] = b.flatten()
         elif solve_method == "standard":
-            A = X.dot(V + V.T).dot(X.T) + 2 * L2_PEN_W * diag(ones(X.shape[0])) # 5
-            B = X.dot(V + V.T).dot(X.T).T # 6
+            A = gram(X, V + V.T) + 2 * L2_PEN_W * diag(ones(X.shape[0], dtype=X.dtype)) # 5
+            B = gram(X, V + V.T).T # 6
             for i, trt_unit in enumerate(treated_units):
                 if verbose >= 2:  # for large sample sizes, linalg.solve is a huge bottle neck,
                     print("Calculating weights, linalg.solve() call %s of %s" % (i,len(in_controls),))
-                (b) = b_i[i] = linalg.solve(A[in_controls2[i]], 
+                (b) = b_i[i] = solve(A[in_controls2[i]], 
                                             B[in_controls[i], trt_unit] + 2 * L2_PEN_W / len(in_controls[i]))
                 weights[out_controls[i], i] = b.flatten()
         else:
             raise ValueError("Unknown Solve Method: " + solve_method)
         return weights, A, B
 
+    _score, _grad, _weights = stats.timed("score", _score), stats.timed("grad", _grad), stats.timed("weights", _weights)
+
     if max_lambda:
         grad0 = _grad(zeros(K))
+        report(stats)
         return -grad0[grad0 < 0].min()
 
     # DO THE OPTIMIZATION
@@ -221,6 +230,9 @@ def loo_v_matrix(X,
     errors = Y_treated - weights.T.dot(Y_control)
     ts_loss = opt.fun
     ts_score = linalg.norm(errors) / sqrt(prod(errors.shape))
+    stats.fits, stats.iterations = 1, getattr(opt, "nit", 0)
+    opt.stats = stats
+    report(stats)
 
     #if True:
     #    _do_gradient_check()
@@ -231,7 +243,18 @@ def loo_v_matrix(X,
 #--             weights[out_controls[i], i] += 1/len(out_controls[i])
     return weights, v_mat, ts_score, ts_loss, L2_PEN_W, opt
 
-def loo_weights(X, V, L2_PEN_W, treated_units = None, control_units = None, intercept = True, solve_method = "standard", verbose = False):
+def loo_weights(X, V, L2_PEN_W, treated_units = None, control_units = None, intercept = True, solve_method = "standard", verbose = False,
+                dtype = np.float64, refine = 0):
+    """ Computes the leave-one-out weights for the treated units
+
+    :param dtype: floating point type (np.float64 or np.float32) used to build
+        and factor the control system
+    :param refine: number of steps of iterative refinement against the
+        float64 system (see SparseSC.utils.mixed_precision)
+    """
+    start = timer()
+    X = as_float_array(X, "X", TypeError, accept_sparse=True)
+    X, V = prune(X, V) # only the active covariates enter the control system
     treated_units, control_units = complete_treated_control_list(X.shape[0], treated_units, control_units)
     control_units = np.array(control_units)
     treated_units = np.array(treated_units)
@@ -267,24 +290,45 @@ def loo_weights(X, V, L2_PEN_W, treated_units = None, control_units = None, inte
         #     if intercept:
         #         weights[out_controls[i], i] += 1/len(out_controls[i])
     elif solve_method == "standard":
-        A = X.dot(V + V.T).dot(X.T) + 2 * L2_PEN_W * diag(ones(X.shape[0])) # 5
-        B = X.dot(V + V.T).dot(X.T).T # 6
+        X_lo = X.astype(dtype, copy=False)
+        VV = np.asarray(V + V.T)
+        A = gram(X_lo, VV.astype(dtype)) + 2 * L2_PEN_W * diag(ones(X.shape[0], dtype=dtype)) # 5
+        B = gram(X_lo, VV.astype(dtype)).T # 6
         for i, trt_unit in enumerate(treated_units):
             if verbose >= 2:  # for large sample sizes, linalg.solve is a huge bottle neck,
                 print("Calculating weights, linalg.solve() call %s of %s" % (i,len(treated_units),))
-            (b) = linalg.solve(A[in_controls2[i]], 
-                               B[in_controls[i], trt_unit] + 2 * L2_PEN_W / len(in_controls[i]))
+            if refine:
+                # float64 right hand side for the iterative refinement
+                X_c = X[in_controls[i], :]
+                (b) = refined_solve(A[in_controls2[i]],
+                                    gram(X_c, VV, X[[trt_unit], :])[:, 0] + 2 * L2_PEN_W / len(in_controls[i]),
+                                    gram_matvec(X_c, VV, L2_PEN_W),
+                                    refine)
+            else:
+                (b) = linalg.solve(A[in_controls2[i]], 
+                                   B[in_controls[i], trt_unit] + 2 * L2_PEN_W / len(in_controls[i]))
 
             weights[out_controls[i], i] = b.flatten()
 #--             if intercept:
 #--                 weights[out_controls[i], i] += 1/len(out_controls[i])
     else:
         raise ValueError("Unknown Solve Method: " + solve_method)
+    count_weights(start, map(len, in_controls))
     return weights.T
 
 
 def loo_score(Y, X, V, L2_PEN_W, LAMBDA = 0, treated_units = None, control_units = None,**kwargs):
     treated_units, control_units = complete_treated_control_list(X.shape[0], treated_units, control_units)
+
+    try:
+        iter(L2_PEN_W)
+    except TypeError:
+        pass
+    else:
+        # L2_PEN_W is an iterable of values: score them all using a single
+        # eigendecomposition of each leave-one-out sub-problem
+        return _loo_score_l2_path(Y, X, V, L2_PEN_W, LAMBDA, treated_units, control_units, **kwargs)
+
     weights = loo_weights(X = X,
                           V = V,
                           L2_PEN_W = L2_PEN_W,
@@ -293,8 +337,41 @@ def loo_score(Y, X, V, L2_PEN_W, LAMBDA = 0, treated_units = None, control_units
                           **kwargs)
     Y_tr = Y[treated_units, :]
     Y_c = Y[control_units, :]
-    Ey = (Y_tr - weights.dot(Y_c)).getA()
+    Ey = np.asarray(Y_tr - weights.dot(Y_c))
     return np.einsum('ij,ij->',Ey,Ey) + LAMBDA * V.sum() # (Ey **2).sum() -> einsum
 
 
+def _loo_score_l2_path(Y, X, V, L2_PEN_W, LAMBDA, treated_units, control_units,
+                       intercept = True, solve_method = "standard", verbose = False, dtype = np.float64, refine = 0):
+    """ loo_score() for each element of `L2_PEN_W` (see SparseSC.utils.ridge_path),
+        taking the same keyword arguments as loo_weights()
+    """
+    if solve_method != "standard":
+        raise ValueError("Unknown Solve Method: " + solve_method)
+    if refine:
+        raise ValueError("refine is not supported for an iterable L2_PEN_W, which is solved by eigendecomposition")
+    control_units = np.array(control_units)
+    treated_units = np.array(treated_units)
+    X = as_float_array(X, "X", TypeError, dtype=dtype, accept_sparse=True)
+    Y = np.asarray(Y)
+    V = np.asarray(V, dtype=dtype)
+    X, V = prune(X, V)
+    L2_PEN_W = list(L2_PEN_W)
+
+    # the same indexes as loo_weights()
+    in_controls = [list(set(control_units) - set([trt_unit])) for trt_unit in treated_units]
+    in_controls2 = [np.ix_(i,i) for i in in_controls]
+    ctrl_rng = np.arange(len(control_units))
+    out_controls = [ctrl_rng[control_units != trt_unit] for trt_unit in treated_units] 
 
+    Y_tr = Y[treated_units, :]
+    Y_c = Y[control_units, :]
+    G = gram(X, V + V.T) # 5
+
+    sse = np.zeros(len(L2_PEN_W))
+    for i, trt_unit in enumerate(treated_units):
+        Y_c_i = Y_c[out_controls[i], :]
+        for j, b in enumerate(ridge_path_solve(G[in_controls2[i]], G[in_controls[i], trt_unit], L2_PEN_W)):
+            Ey = Y_tr[i, :] - b.dot(Y_c_i)
+            sse[j] += Ey.dot(Ey)
+    return sse + LAMBDA * V.sum()
@@ -3,24 +3,32 @@ from SparseSC.fit_loo import  loo_v_matrix
 from SparseSC.fit_ct import  ct_v_matrix
 from SparseSC.fit_fold import fold_v_matrix
 # from SparseSC.optimizers.cd_line_search import cdl_search
+from SparseSC.utils.validation import as_float_array
+from SparseSC.utils.sparse_matrix import row_stack, mean_var
+from SparseSC.utils.result_cache import fingerprint, as_result_cache
 import numpy as np
 
 def L2_pen_guestimate(X):
-    return np.mean(np.var(X, axis = 0))
+    return mean_var(X)
 
-def get_max_lambda(X,Y,L2_PEN_W=None,X_treat=None,Y_treat=None,**kwargs):
+def get_max_lambda(X,Y,L2_PEN_W=None,X_treat=None,Y_treat=None,result_cache=None,**kwargs):
     """ returns the maximum value of the L1 penalty for which the elements of tensor matrix (V) are not all zero.
+
+    :param result_cache: a SparseSC.utils.result_cache.ResultCache (or the
+        path of a cache directory) in which the result is looked up and stored
     """
+    if result_cache is not None:
+        result_cache = as_result_cache(result_cache)
+        key = fingerprint("get_max_lambda", X, Y, L2_PEN_W, X_treat, Y_treat, kwargs)
+        result = result_cache.get(key)
+        if result is None:
+            result = get_max_lambda(X, Y, L2_PEN_W, X_treat, Y_treat, **kwargs)
+            result_cache.put(key, result)
+        return result
 
     # PARAMETER QC
-    try:
-        X = np.asmatrix(X)
-    except ValueError:
-        raise ValueError("X is not coercible to a matrix")
-    try:
-        Y = np.asmatrix(Y)
-    except ValueError:
-        raise ValueError("Y is not coercible to a matrix")
+    X = as_float_array(X, "X", accept_sparse=True)
+    Y = as_float_array(Y, "Y")
     if X_treat is None != Y_treat is None:
         raise ValueError("parameters `X_treat` and `Y_treat` must both be Matrices or None")
     if X.shape[1] == 0:
@@ -30,15 +38,13 @@ def get_max_lambda(X,Y,L2_PEN_W=None,X_treat=None,Y_treat=None,**kwargs):
     if X.shape[0] != Y.shape[0]:
         raise ValueError("X and Y have different number of rows (%s and %s)" % (X.shape[0], Y.shape[0],))
     if L2_PEN_W is None:
-        L2_PEN_W = np.mean(np.var(X, axis = 0))
+        L2_PEN_W = mean_var(X)
 
     if X_treat is not None:
 
         # PARAMETER QC
-        if not isinstance(X_treat, np.matrix):
-            raise TypeError("X_treat is not a matrix")
-        if not isinstance(Y_treat, np.matrix):
-            raise TypeError("Y_treat is not a matrix")
+        X_treat = as_float_array(X_treat, "X_treat", TypeError, accept_sparse=True)
+        Y_treat = as_float_array(Y_treat, "Y_treat", TypeError)
         if X_treat.shape[1] == 0:
             raise ValueError("X_treat.shape[1] == 0")
         if Y_treat.shape[1] == 0:
@@ -54,7 +60,7 @@ def get_max_lambda(X,Y,L2_PEN_W=None,X_treat=None,Y_treat=None,**kwargs):
             _LAMBDA = iter(L2_PEN_W)
         except TypeError:
             # L2_PEN_W is a single value
-            return ct_v_matrix(X = np.vstack((X,X_treat)),
+            return ct_v_matrix(X = row_stack(X,X_treat),
                                Y = np.vstack((Y,Y_treat)),
                                L2_PEN_W = L2_PEN_W,
                                control_units = control_units,
@@ -64,7 +70,7 @@ def get_max_lambda(X,Y,L2_PEN_W=None,X_treat=None,Y_treat=None,**kwargs):
 
         else:
             # L2_PEN_W is an iterable of values
-            return [ ct_v_matrix(X = np.vstack((X,X_treat)),
+            return [ ct_v_matrix(X = row_stack(X,X_treat),
                                  Y = np.vstack((Y,Y_treat)),
                                  control_units = control_units,
                                  treated_units = treated_units,
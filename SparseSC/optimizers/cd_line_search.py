@@ -1,13 +1,10 @@
 import numpy as np
-from scipy.optimize import line_search
-
-import locale 
-locale.setlocale(locale.LC_ALL, '')
 
 class cd_res(object):
-    def __init__(self, x, fun):
+    def __init__(self, x, fun, nit = None):
         self.x = x
         self.fun = fun
+        self.nit = nit # number of iterations
 
 print_stop_iteration = 1
 
@@ -73,6 +70,7 @@ def cdl_search(score,
     assert 0 < aggressiveness < 1
     assert 0 < alpha_mult < 1
     assert (guess >=0).all(), "Initial guess (`guess`) should be in the closed positive orthant"
+    from scipy.optimize import line_search
 
     val_old = None
     grad = None
@@ -108,7 +106,7 @@ def cdl_search(score,
             # pointing in the all-negative direction
             if print_stop_iteration: 
                 print("[STOP ITERATION: gradient is zero] i: %s" % (_i,))
-            return cd_res(x_curr, val)
+            return cd_res(x_curr, val, _i + 1)
 
 
         # constrain to the positive orthant
@@ -165,12 +163,12 @@ def cdl_search(score,
                 # moving in the direction of the gradient yielded no improvement: stop
                 if print_stop_iteration: 
                     print("[STOP ITERATION: simple line search failed] i: %s" % (_i,))
-                return cd_res(x_curr, val)
+                return cd_res(x_curr, val, _i + 1)
         else:
             # moving in the direction of the gradient yielded no improvement: stop
             if print_stop_iteration: 
                 print("[STOP ITERATION: alpha is None] i: %s, grad: %s, step: %s" % (_i, grad, direction/max_alpha, ))
-            return cd_res(x_curr, val)
+            return cd_res(x_curr, val, _i + 1)
 
         # iterate
         if constrained:
@@ -214,7 +212,7 @@ def cdl_search(score,
             if (x_curr == 0).all():
                 if print_stop_iteration: 
                     print("[STOP ITERATION: Stuck at the origin] iteration: %s"% (_i,))
-                return cd_res(x_curr, score(x_curr)) # tricky tricky...
+                return cd_res(x_curr, score(x_curr), _i + 1) # tricky tricky...
 
         if (x_curr < 0).any():
             # This shouldn't ever happen if max_alpha is specified properly
@@ -227,7 +225,7 @@ def cdl_search(score,
                 if print_stop_iteration:
                     # this is kida stupid
                     print("[STOP ITERATION: val_diff/val < tol] i: %s, val: %s, val_diff: %s" % (_i, val, val_diff, ))
-                return cd_res(x_curr, val)
+                return cd_res(x_curr, val, _i + 1)
 
     # returns solution in for loop if successfully converges
     raise RuntimeError('Solution did not converge to default tolerance')
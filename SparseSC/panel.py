@@ -0,0 +1,226 @@
+""" Loading long-format panels
+
+    A long-format panel has one record per (unit, time, variable, value), as
+    exported from a database or written by `DataFrame.melt()`.  load_panel()
+    pivots the records straight into preallocated, C-contiguous arrays of
+    covariates (X) and pre- and post-period outcomes, ready for
+    estimate_effects() and CV_score().  The source is read in chunks of
+    `chunk_rows` records, so the records of a CSV file or a memory mapped
+    .npy file are never all in memory at once, and no intermediate table
+    (or DataFrame) is built.
+
+    The source is read twice: the first pass collects the distinct units,
+    periods, variables and (variable, period) pairs, which fixes the shapes
+    of the arrays, and the second pass scatters the values into them.
+"""
+import csv
+import itertools
+from collections import namedtuple
+import numpy as np
+
+Panel = namedtuple("Panel", "X Y_pre Y_post treated_units control_units units periods covariates")
+
+def load_panel(source,
+               outcome,
+               treated_units,
+               treatment_start,
+               covariates=None,
+               columns=("unit", "time", "variable", "value"),
+               dtype=np.float64,
+               missing=None,
+               chunk_rows=1000000,
+               delimiter=","):
+    """ Pivots a long-format panel into the arrays used by estimate_effects()
+        and CV_score()
+
+    :param source: the records: the path to a CSV file, the path to a .npy
+        file (which is memory mapped), or an array or `numpy.memmap`.  Arrays
+        are either structured, with the fields named in `columns`, or 2-d
+        with the unit, time, variable and value in that order (or at the
+        positions given in `columns`).
+    :param outcome: the variable holding the outcome
+    :param treated_units: the ids of the treated units
+    :param treatment_start: the first post-treatment period. The outcomes
+        for earlier periods are the pre-period outcomes.
+    :param covariates: the variables used as covariates (default: every
+        variable but the outcome).  Each (covariate, period) pair in the
+        panel is a column of X, so a covariate recorded at a single period
+        is a single column.
+    :param columns: the names (or positions) of the unit, time, variable and
+        value columns.  A CSV file has a header row unless every column is
+        given by position.
+    :param dtype: floating point type of the arrays
+    :param missing: value for the (unit, period, variable) cells which are
+        not in the panel.  By default a missing cell raises a ValueError.
+    :param chunk_rows: number of records read at a time
+    :param delimiter: delimiter of a CSV file
+
+    The ids in a CSV file are read as integers (or floats) when every id in
+    the column is a number, and as strings otherwise.
+
+    :raises ValueError: raised when the outcome, a covariate or a treated
+        unit is not in the panel, when there are no pre- or no post-treatment
+        periods, or when a cell is missing
+
+    :return: a Panel with X, Y_pre and Y_post (N x K, N x T0 and N x T1, with
+        the units in sorted order), the indices of the treated and control
+        units, the unit ids, the periods of the outcomes and the
+        (covariate, period) pair of each column of X
+    """
+    # PARAMETER QC
+    columns = tuple(columns)
+    if len(columns) != 4:
+        raise ValueError("columns must name the unit, time, variable and value columns")
+    if chunk_rows < 1:
+        raise ValueError("chunk_rows must be positive")
+    if np.dtype(dtype) not in (np.dtype(np.float32), np.dtype(np.float64)):
+        raise TypeError("dtype must be np.float32 or np.float64")
+
+    # FIRST PASS: THE DISTINCT UNITS, PERIODS, VARIABLES AND (VARIABLE, PERIOD) PAIRS
+    units = times = variables = None
+    pairs = set()
+    for unit, time, variable, _ in _chunks(source, columns, chunk_rows, delimiter):
+        chunk_times, time_index = np.unique(time, return_inverse=True)
+        chunk_variables, variable_index = np.unique(variable, return_inverse=True)
+        codes = np.unique(variable_index * len(chunk_times) + time_index)
+        pairs.update(zip(chunk_variables[codes // len(chunk_times)].tolist(),
+                         chunk_times[codes % len(chunk_times)].tolist()))
+        units = _union(units, np.unique(unit))
+        times = _union(times, chunk_times)
+        variables = _union(variables, chunk_variables)
+    if units is None:
+        raise ValueError("the panel is empty")
+
+    unit_ids, unit_rank = _sorted_ids(units)
+    periods, period_rank = _sorted_ids(times)
+    variable_ids, variable_rank = _sorted_ids(variables)
+    variable_list = variable_ids.tolist()
+    N, T = len(unit_ids), len(periods)
+
+    if outcome not in variable_list:
+        raise ValueError("%r is not a variable of the panel" % (outcome,))
+    outcome_rank = variable_list.index(outcome)
+    if covariates is None:
+        covariates = [v for v in variable_list if v != outcome]
+    covariate_position = np.full(len(variable_list), -1, dtype=np.intp)
+    for i, covariate in enumerate(covariates):
+        if covariate not in variable_list:
+            raise ValueError("%r is not a variable of the panel" % (covariate,))
+        covariate_position[variable_list.index(covariate)] = i
+
+    pair_variables, pair_times = (np.asarray(x) for x in zip(*pairs))
+    pair_variables = variable_rank[np.searchsorted(variables, pair_variables)]
+    pair_times = period_rank[np.searchsorted(times, pair_times)]
+
+    # THE COLUMNS OF X: THE (COVARIATE, PERIOD) PAIRS, BY COVARIATE AND THEN PERIOD
+    pair_position = covariate_position[pair_variables]
+    X_codes = np.unique((pair_position * T + pair_times)[pair_position >= 0])
+    X_columns = [(covariates[code // T], periods[code % T].item()) for code in X_codes]
+
+    # THE PERIODS OF THE OUTCOMES (SORTED, SO THE PRE-PERIODS ARE A PREFIX)
+    outcome_periods = np.unique(pair_times[pair_variables == outcome_rank])
+    outcome_column = np.full(T, -1, dtype=np.intp)
+    outcome_column[outcome_periods] = np.arange(len(outcome_periods))
+    periods = periods[outcome_periods]
+    T0 = int(np.count_nonzero(periods < treatment_start))
+    if T0 == 0 or T0 == len(periods):
+        raise ValueError("the panel has no %s-treatment periods" % ("pre" if T0 == 0 else "post"))
+
+    # TREATED AND CONTROL UNITS
+    treated_ids = np.asarray(list(treated_units))
+    treated_index = np.searchsorted(unit_ids, treated_ids)
+    for unit, index in zip(treated_ids.tolist(), treated_index):
+        if index == N or unit_ids[index] != unit:
+            raise ValueError("treated unit %r is not in the panel" % (unit,))
+    treated_index = np.unique(treated_index)
+    control_index = np.setdiff1d(np.arange(N), treated_index)
+
+    # SECOND PASS: SCATTER THE VALUES INTO THE ARRAYS
+    X = np.full((N, len(X_codes)), np.nan, dtype=dtype)
+    Y_pre = np.full((N, T0), np.nan, dtype=dtype)
+    Y_post = np.full((N, len(periods) - T0), np.nan, dtype=dtype)
+    for unit, time, variable, value in _chunks(source, columns, chunk_rows, delimiter):
+        u = unit_rank[np.searchsorted(units, unit)]
+        t = period_rank[np.searchsorted(times, time)]
+        v = variable_rank[np.searchsorted(variables, variable)]
+        value = np.asarray(value).astype(dtype)
+        c = outcome_column[t]
+        pre = (v == outcome_rank) & (c < T0)
+        Y_pre[u[pre], c[pre]] = value[pre]
+        post = (v == outcome_rank) & (c >= T0)
+        Y_post[u[post], c[post] - T0] = value[post]
+        x = covariate_position[v] >= 0
+        X[u[x], np.searchsorted(X_codes, covariate_position[v[x]] * T + t[x])] = value[x]
+
+    for name, array in (("X", X), ("Y_pre", Y_pre), ("Y_post", Y_post)):
+        empty = np.isnan(array)
+        if not empty.any():
+            continue
+        if missing is None:
+            raise ValueError("%s cells of %s are missing from the panel" % (np.count_nonzero(empty), name))
+        array[empty] = missing
+
+    return Panel(X, Y_pre, Y_post, treated_index, control_index, unit_ids, periods, X_columns)
+
+def _chunks(source, columns, chunk_rows, delimiter):
+    """ yields the unit, time, variable and value columns of each chunk of records """
+    if isinstance(source, str) and not source.endswith(".npy"):
+        for chunk in _csv_chunks(source, columns, chunk_rows, delimiter):
+            yield chunk
+        return
+    if isinstance(source, str):
+        source = np.load(source, mmap_mode="r")
+    if source.dtype.names:
+        fields = [source.dtype.names[c] if isinstance(c, int) else c for c in columns]
+        for field in fields:
+            if field not in source.dtype.names:
+                raise ValueError("the panel has no field %r" % (field,))
+        for start in range(0, len(source), chunk_rows):
+            block = source[start:start + chunk_rows]
+            yield tuple(np.asarray(block[field]) for field in fields)
+    else:
+        if source.ndim != 2:
+            raise ValueError("an unstructured panel must be a 2-d array")
+        positions = [c if isinstance(c, int) else i for i, c in enumerate(columns)]
+        for start in range(0, source.shape[0], chunk_rows):
+            block = np.asarray(source[start:start + chunk_rows])
+            yield tuple(block[:, p] for p in positions)
+
+def _csv_chunks(path, columns, chunk_rows, delimiter):
+    with open(path) as f:
+        reader = csv.reader(f, delimiter=delimiter)
+        if all(isinstance(c, int) for c in columns):
+            positions = columns
+        else:
+            header = [name.strip() for name in next(reader)]
+            for c in columns:
+                if not isinstance(c, int) and c not in header:
+                    raise ValueError("%s has no column %r" % (path, c))
+            positions = [c if isinstance(c, int) else header.index(c) for c in columns]
+        while True:
+            rows = list(itertools.islice(reader, chunk_rows))
+            if not rows:
+                return
+            rows = [row for row in rows if row]
+            if rows:
+                yield tuple(np.array([row[p].strip() for row in rows]) for p in positions)
+
+def _union(a, b):
+    return b if a is None else np.union1d(a, b)
+
+def _sorted_ids(raw):
+    """ returns the sorted ids, typed as numbers where possible, and the
+        position of each of the (sorted) raw values among them
+    """
+    ids = raw
+    if raw.dtype.kind in "US":
+        for id_type in (np.int64, np.float64):
+            try:
+                ids = raw.astype(id_type)
+                break
+            except ValueError:
+                pass
+    order = np.argsort(ids, kind="mergesort")
+    rank = np.empty(len(order), dtype=np.intp)
+    rank[order] = np.arange(len(order))
+    return ids[order], rank
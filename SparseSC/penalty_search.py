@@ -0,0 +1,316 @@
+""" Search strategies for the L1 (and L2) penalty parameters which require
+    far fewer full cross validations than scoring a fixed, dense grid.
+
+    The fitted V matrices of neighbouring penalties are close to each other,
+    so every new evaluation is warm started (fold by fold) from the V matrix of
+    the nearest penalty that has already been evaluated.
+"""
+from collections import namedtuple
+import warnings
+import numpy as np
+from SparseSC.cross_validation import _CV_setup, score_train_test, score_train_test_sorted_lambdas
+from SparseSC.lambda_utils import get_max_lambda, L2_pen_guestimate
+
+LambdaSearchResults = namedtuple("LambdaSearchResults", "best_lambda best_score lambdas scores n_evals")
+LambdaSearchResults.__doc__ = """ Results from adaptive_lambda_search()
+
+    :param best_lambda: the L1 penalty with the lowest cross validation error
+    :param best_score: its cross validation error
+    :param lambdas: every L1 penalty that was evaluated (sorted)
+    :param scores: the cross validation error of each element of `lambdas`
+    :param n_evals: the number of full cross validations performed
+"""
+
+# (3 - sqrt(5)) / 2
+_GOLDEN = 0.3819660112501051
+
+def _nearest_start(evaluated, x):
+    """ The per-fold starting values from the evaluated point nearest to x (on the log scale)"""
+    if not evaluated:
+        return None
+    nearest = min(evaluated, key=lambda _x: abs(_x - x))
+    return evaluated[nearest][1]
+
+def adaptive_lambda_search(X, Y,
+                           X_treat=None,
+                           Y_treat=None,
+                           splits=5,
+                           L2_PEN_W=None,
+                           lambda_max=None,
+                           lower=1e-4,
+                           n_init=5,
+                           tol=0.1,
+                           max_evals=30,
+                           quiet=False,
+                           **kwargs):
+    """ Finds the L1 penalty with the lowest cross validation error by
+        bracketing and then refining the minimum, rather than scoring a fixed
+        grid.
+
+        A coarse, log-spaced sweep of `n_init` penalties between `lower *
+        lambda_max` and `lambda_max` is scored first (from the largest penalty
+        to the smallest, caching the V matrix between penalties).  While the
+        best penalty is the smallest one scored, the sweep is extended below
+        it at the same spacing, so that the minimum is bracketed by lower
+        and higher penalties.  (Every penalty above get_max_lambda() gives
+        V = 0, so a minimum at the default `lambda_max` is genuine; a
+        `lambda_max` which is passed in is extended above in the same way.)
+        Golden-section search on log(LAMBDA) then refines the bracket around
+        the best penalty until it is narrower than `tol`.  The CV error is
+        assumed to be unimodal within the bracket.
+
+    :param X: Matrix of Covariates
+    :param Y: Matrix of Outcomes
+    :param X_treat: Optional matrix of Covariates for the treated units
+    :param Y_treat: Optional matrix of Outcomes for the treated units
+    :param splits: number of cross validation folds or a list of train/test splits
+    :param L2_PEN_W: L2 penalty, held fixed. Optional.
+    :param lambda_max: upper end of the search. Defaults to get_max_lambda()
+    :param lower: lower end of the search, relative to `lambda_max`
+    :param n_init: number of penalties in the initial sweep
+    :param tol: width of the final bracket on the log(LAMBDA) scale
+    :param max_evals: maximum number of cross validations (including the
+        initial sweep and its extension).  A warning is issued if the minimum
+        is still at the edge of the sweep when they run out.
+    :param quiet: If True, suppress messaging
+    :param kwargs: additional arguments passed to score_train_test() (e.g. `grad_splits`)
+
+    :return: the best penalty and every penalty evaluated along the way
+    :rtype: LambdaSearchResults
+    """
+    assert n_init >= 3, "n_init must be at least 3"
+    X, Y, X_treat, Y_treat, _, _, train_test_splits = _CV_setup(X, Y, 0, X_treat, Y_treat, splits, quiet)
+    if L2_PEN_W is None:
+        L2_PEN_W = L2_pen_guestimate(X)
+    extend_above = lambda_max is not None
+    if lambda_max is None:
+        max_lambda_kwargs = {}
+        if X_treat is None and kwargs.get("grad_splits") is not None:
+            max_lambda_kwargs["grad_splits"] = kwargs["grad_splits"]
+        lambda_max = get_max_lambda(X, Y, L2_PEN_W=L2_PEN_W, X_treat=X_treat, Y_treat=Y_treat, **max_lambda_kwargs)
+
+    # log(LAMBDA) -> (cross validation error, [diag(V) for each fold])
+    evaluated = {}
+
+    def cv_error(x):
+        starts = _nearest_start(evaluated, x)
+        total, v_diags = 0, []
+        for fold, (train, test) in enumerate(train_test_splits):
+            v_mat, _, s = score_train_test(X = X, Y = Y, X_treat = X_treat, Y_treat = Y_treat,
+                                           train = train, test = test,
+                                           LAMBDA = float(np.exp(x)), L2_PEN_W = L2_PEN_W,
+                                           start = None if starts is None else starts[fold],
+                                           FoldNumber = fold, **kwargs)
+            total += s
+            v_diags.append(np.diag(v_mat).copy())
+        evaluated[x] = (total, v_diags)
+        if not quiet:
+            print("lambda: %0.6g, Cross Validation Error: %s" % (np.exp(x), total))
+        return total
+
+    # INITIAL SWEEP (from the largest penalty to the smallest, caching V)
+    grid = np.linspace(np.log(lambda_max), np.log(lambda_max * lower), n_init)
+    sweep_scores = np.zeros(n_init)
+    sweep_v_diags = [[None] * len(train_test_splits) for _ in grid]
+    for fold, (train, test) in enumerate(train_test_splits):
+        v_mats, _, fold_scores = score_train_test_sorted_lambdas(X = X, Y = Y, X_treat = X_treat, Y_treat = Y_treat,
+                                                                  train = train, test = test,
+                                                                  LAMBDA = [float(l) for l in np.exp(grid)],
+                                                                  L2_PEN_W = L2_PEN_W,
+                                                                  cache = True,
+                                                                  FoldNumber = fold, **kwargs)
+        sweep_scores += np.array(fold_scores)
+        for i, v_mat in enumerate(v_mats):
+            sweep_v_diags[i][fold] = np.diag(v_mat).copy()
+    for i, x in enumerate(grid):
+        evaluated[x] = (sweep_scores[i], sweep_v_diags[i])
+    if not quiet:
+        for x, s in zip(grid, sweep_scores):
+            print("lambda: %0.6g, Cross Validation Error: %s" % (np.exp(x), s))
+
+    # EXTEND THE SWEEP UNTIL ITS BEST PENALTY IS NOT AT AN EDGE
+    grid = list(grid[::-1])
+    sweep_scores = list(sweep_scores[::-1])
+    step = grid[1] - grid[0]
+    n_evals = n_init
+    while n_evals < max_evals:
+        i = int(np.argmin(sweep_scores))
+        if i == 0:
+            grid.insert(0, grid[0] - step)
+            sweep_scores.insert(0, cv_error(grid[0]))
+        elif i == len(grid) - 1 and extend_above:
+            grid.append(grid[-1] + step)
+            sweep_scores.append(cv_error(grid[-1]))
+        else:
+            break
+        n_evals += 1
+
+    # BRACKET THE MINIMUM: a <= m <= b (on the log scale, increasing)
+    i = int(np.argmin(sweep_scores))
+    if i == 0 or (i == len(grid) - 1 and extend_above):
+        warnings.warn("The lowest cross validation error is at the edge of the penalties searched (%0.6g); increase max_evals" % np.exp(grid[i]))
+    a, m, b = grid[max(i - 1, 0)], grid[i], grid[min(i + 1, len(grid) - 1)]
+    f_m = sweep_scores[i]
+
+    # GOLDEN SECTION REFINEMENT
+    while (b - a) > tol and n_evals < max_evals:
+        if (b - m) >= (m - a):
+            x = m + _GOLDEN * (b - m)
+            f_x = cv_error(x)
+            if f_x < f_m:
+                a, m, f_m = m, x, f_x
+            else:
+                b = x
+        else:
+            x = m - _GOLDEN * (m - a)
+            f_x = cv_error(x)
+            if f_x < f_m:
+                b, m, f_m = m, x, f_x
+            else:
+                a = x
+        n_evals += 1
+
+    xs = sorted(evaluated)
+    return LambdaSearchResults(float(np.exp(m)), f_m,
+                               np.exp(np.array(xs)),
+                               np.array([evaluated[x][0] for x in xs]),
+                               n_evals)
+
+
+def joint_penalty_search(X, Y,
+                         X_treat=None,
+                         Y_treat=None,
+                         L1_pen_start=None,
+                         L2_pen_start=None,
+                         bounds=((-6,6,),)*2,
+                         splits=5,
+                         n_grid=5,
+                         step_tol=0.25,
+                         max_evals=60,
+                         parallel=False,
+                         max_workers=None,
+                         worker_type="process",
+                         quiet=False,
+                         **kwargs):
+    """ Joint optimization of the L1 and L2 penalties using a coarse 2-D grid
+        followed by a local pattern search, as a sample efficient alternative
+        to differential evolution.
+
+        Penalties are searched on the scale of `x = (log(L1 / L1_pen_start),
+        log(L2 / L2_pen_start))` within `bounds`.  The `n_grid` x `n_grid`
+        grid is scored as a single batch, then the 8 neighbours of the best
+        point at distance `step` are scored as a batch; the search moves to
+        the best neighbour if it improves on the current point, otherwise
+        `step` is halved, until `step < step_tol` or `max_evals` points have
+        been scored.
+
+        Each point is memoized, and each fold is warm started from the V matrix
+        fitted to the same fold at the nearest point already scored.  With
+        `parallel = True` every (point, fold) pair in a batch is submitted to
+        the worker pool.
+
+    :param X: Matrix of Covariates
+    :param Y: Matrix of Outcomes
+    :param X_treat: Optional matrix of Covariates for the treated units
+    :param Y_treat: Optional matrix of Outcomes for the treated units
+    :param L1_pen_start: L1 penalty at the origin of the search. Defaults to get_max_lambda()
+    :param L2_pen_start: L2 penalty at the origin of the search. Defaults to L2_pen_guestimate()
+    :param bounds: bounds of the search on the log scale
+    :param splits: number of cross validation folds or a list of train/test splits
+    :param n_grid: points per dimension in the initial grid
+    :param step_tol: smallest step of the pattern search (on the log scale)
+    :param max_evals: maximum number of points scored
+    :param parallel: If True, score each batch in a worker pool
+    :param max_workers: number of workers in the pool
+    :param worker_type: "process" or "thread"
+    :param quiet: If True, suppress messaging
+    :param kwargs: additional arguments passed to score_train_test()
+
+    :return: an OptimizeResult with `x` (the L1 and L2 penalties), `fun`,
+        `nfev`, and `points` and `scores` (every point scored, on the log scale)
+    :rtype: scipy.optimize.OptimizeResult
+    """
+    from scipy.optimize import OptimizeResult
+    from SparseSC import cross_validation
+    import itertools
+
+    X, Y, X_treat, Y_treat, _, _, train_test_splits = _CV_setup(X, Y, 0, X_treat, Y_treat, splits, quiet)
+    if L2_pen_start is None:
+        L2_pen_start = L2_pen_guestimate(X)
+    if L1_pen_start is None:
+        max_lambda_kwargs = {}
+        if X_treat is None and kwargs.get("grad_splits") is not None:
+            max_lambda_kwargs["grad_splits"] = kwargs["grad_splits"]
+        L1_pen_start = get_max_lambda(X, Y, L2_PEN_W=L2_pen_start, X_treat=X_treat, Y_treat=Y_treat, **max_lambda_kwargs)
+    lo = np.array([b[0] for b in bounds], dtype=float)
+    hi = np.array([b[1] for b in bounds], dtype=float)
+
+    # (x0, x1) -> (cross validation error, [diag(V) for each fold])
+    evaluated = {}
+
+    def key(x):
+        return tuple(np.round(np.clip(x, lo, hi), 10))
+
+    def nearest_start(x, fold):
+        if not evaluated:
+            return None
+        nearest = min(evaluated, key=lambda _x: np.sum(np.square(np.array(_x) - x)))
+        return evaluated[nearest][1][fold]
+
+    def score_batch(points):
+        points = [p for p in sorted(set(key(p) for p in points)) if p not in evaluated]
+        points = points[:max(max_evals - len(evaluated), 0)]
+        if not points:
+            return
+        tasks = [ dict(X = X, Y = Y, X_treat = X_treat, Y_treat = Y_treat,
+                       train = train, test = test,
+                       LAMBDA = float(L1_pen_start * np.exp(p[0])),
+                       L2_PEN_W = float(L2_pen_start * np.exp(p[1])),
+                       start = nearest_start(np.array(p), fold),
+                       FoldNumber = fold, **kwargs)
+                  for p in points for fold, (train, test) in enumerate(train_test_splits) ]
+        if parallel:
+            promises = [ cross_validation._submit(pool, score_train_test, **task) for task in tasks ]
+            results = [ cross_validation._result(promise) for promise in promises ]
+        else:
+            results = [ score_train_test(**task) for task in tasks ]
+        n_splits = len(train_test_splits)
+        for i, p in enumerate(points):
+            fold_results = results[i * n_splits:(i + 1) * n_splits]
+            score = sum(s for _, _, s in fold_results)
+            evaluated[p] = (score, [np.diag(v_mat).copy() for v_mat, _, _ in fold_results])
+            if not quiet:
+                print("points: %s, x0: %0.4f, x1: %0.4f, Cross Validation Error: %s" % (len(evaluated), p[0], p[1], score))
+
+    if parallel:
+        if max_workers is None:
+            import multiprocessing
+            max_workers = max(multiprocessing.cpu_count() - 2, 1)
+        pool = cross_validation._new_worker_pool(max_workers, worker_type)
+    try:
+        # COARSE GRID
+        axes = [np.linspace(lo[d], hi[d], n_grid) for d in range(2)]
+        score_batch([np.array(p) for p in itertools.product(*axes)])
+        best = min(evaluated, key=lambda p: evaluated[p][0])
+
+        # LOCAL PATTERN SEARCH
+        step = (hi - lo) / (2. * max(n_grid - 1, 1))
+        directions = [np.array(d) for d in itertools.product((-1, 0, 1), repeat=2) if d != (0, 0)]
+        while step.max() >= step_tol and len(evaluated) < max_evals:
+            score_batch([np.array(best) + d * step for d in directions])
+            new_best = min(evaluated, key=lambda p: evaluated[p][0])
+            if evaluated[new_best][0] < evaluated[best][0]:
+                best = new_best
+            else:
+                step = step / 2.
+    finally:
+        if parallel:
+            pool.shutdown()
+
+    points = sorted(evaluated)
+    return OptimizeResult(x = np.array([L1_pen_start * np.exp(best[0]), L2_pen_start * np.exp(best[1])]),
+                          fun = evaluated[best][0],
+                          nfev = len(evaluated),
+                          success = True,
+                          points = np.array(points),
+                          scores = np.array([evaluated[p][0] for p in points]))
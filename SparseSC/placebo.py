@@ -0,0 +1,649 @@
+""" Placebo (permutation) inference for the effects estimated by estimate_effects()
+
+    Each placebo replaces the N1 treated units with N1 of the N0 control
+    units and computes the same statistics (the effect vector, the
+    standardized effect vector, and the joint and joint standardized
+    effects) as for the treated units.  Every statistic is the mean over the
+    chosen units of a per-unit value, so the per-unit values are stacked into
+    a single (N0 x 2*T1+2) matrix and the placebos are processed in blocks.
+
+    Random placebos are drawn as blocks of index matrices, and the placebo
+    means for the whole block are computed with a single gather-and-reduce.
+    When every combination is enumerated, the combinations are visited in
+    revolving-door (Gray code) order, in which consecutive combinations differ
+    by a single unit, so the placebo sums within a block are a cumulative sum
+    of the differences of single rows: O(T1) rather than O(N1 * T1) per
+    placebo.  The sums are recomputed from scratch at the start of each block
+    so rounding error doesn't accumulate.
+"""
+import warnings
+from collections import namedtuple
+import numpy as np
+
+EstResultCI = namedtuple('EstResults', 'effect p ci')
+SparseSCEstResults = namedtuple('SparseSCEstResults', 'effect_vec_res std_p joint_p joint_std_p N_placebo placebo_effect_vecs')
+
+# number of random placebos drawn from each independent random stream when
+# `seed` is given (fixed, so the draws don't depend on the number of workers)
+_DRAWS_PER_STREAM = 2 ** 16
+
+# target number of elements in the gathered (block_size x N1 x n_stats) array
+# (block_size x n_stats for revolving-door blocks)
+_BLOCK_ELEMENTS = 2 ** 22
+
+def _ncr(n, r):
+    #https://stackoverflow.com/questions/4941753/is-there-a-math-ncr-function-in-python
+    import operator as op
+    import functools
+    r = min(r, n-r)
+    numer = functools.reduce(op.mul, range(n, n-r, -1), 1) #from py2 xrange()
+    denom = functools.reduce(op.mul, range(1, r+1), 1) #from py2 xrange()
+    return numer//denom
+
+def _default_block_size(N1, n_stats):
+    return max(1, _BLOCK_ELEMENTS // max(N1 * n_stats, 1))
+
+def _revolving_door_blocks(n, t, block_size):
+    """ Enumerates every combination of t of the n integers range(n) in
+        revolving-door order (Knuth, TAOCP 7.2.1.3, Algorithm R), in which
+        each combination differs from the previous one by swapping a single
+        element.  Yields blocks of (at most) `block_size` combinations, each
+        as (the first combination in the block, the elements removed, the
+        elements added) for each subsequent combination in the block.
+    """
+    assert 0 < t <= n
+    # c[1..t] is the current combination, with sentinels c[0] and c[t+1]
+    c = [None] + list(range(t)) + [n]
+    state = {"start": list(range(t)), "outs": [], "ins": []}
+
+    def swap(out, inn):
+        """ records the move to the next combination; returns the previous block if it is complete """
+        if len(state["outs"]) == block_size - 1:
+            block = (np.array(state["start"], dtype=np.intp),
+                     np.array(state["outs"], dtype=np.intp),
+                     np.array(state["ins"], dtype=np.intp))
+            state["start"], state["outs"], state["ins"] = c[1:t+1], [], []
+            return block
+        state["outs"].append(out)
+        state["ins"].append(inn)
+        return None
+
+    while True:
+        # R3: easy case?
+        block = None
+        j = None
+        if t % 2:
+            if c[1] + 1 < c[2]:
+                c[1] += 1
+                block = swap(c[1] - 1, c[1])
+            else:
+                j, step = 2, "R4"
+        else:
+            if c[1] > 0:
+                c[1] -= 1
+                block = swap(c[1] + 1, c[1])
+            else:
+                j, step = 2, "R5"
+        while j is not None:
+            if j > t:
+                # R6: terminate
+                yield (np.array(state["start"], dtype=np.intp),
+                       np.array(state["outs"], dtype=np.intp),
+                       np.array(state["ins"], dtype=np.intp))
+                return
+            if step == "R4":
+                # try to decrease c[j]; (c[j] == c[j-1] + 1)
+                if c[j] >= j:
+                    out = c[j]
+                    c[j], c[j-1] = c[j-1], j - 2
+                    block = swap(out, j - 2)
+                    break
+                j, step = j + 1, "R5"
+            else:
+                # try to increase c[j]; (c[j-1] == j - 2)
+                if c[j] + 1 < c[j+1]:
+                    out = c[j-1]
+                    c[j-1], c[j] = c[j], c[j] + 1
+                    block = swap(out, c[j])
+                    break
+                j, step = j + 1, "R4"
+        if block is not None:
+            yield block
+
+def _random_combination_blocks(N0, N1, n, block_size, random_sample):
+    """ Yields n random combinations of N1 of the N0 control units, as blocks
+        of (up to) block_size x N1 index matrices
+
+    :param random_sample: a function which returns uniform random numbers of a
+        given shape, such as `np.random.random_sample`
+    """
+    for start in range(0, n, block_size):
+        size = min(block_size, n - start)
+        # the N1 smallest of N0 iid uniforms are a uniformly random combination
+        yield np.argpartition(random_sample((size, N0)), N1 - 1, axis=1)[:, :N1]
+
+def _stat_matrix(effect_vecs, pre_tr_rmspes, control_effect_vecs, pre_c_rmspes):
+    """ Returns the observed statistics for the treated units and the matrix
+        of per-unit statistics for the control units (the placebo statistics
+        are the means of rows of this matrix), each with columns
+        [effect vector (T1) | standardized effect vector (T1) | joint effect | joint standardized effect]
+    """
+    effect_vecs = np.asarray(effect_vecs)
+    control_effect_vecs = np.asarray(control_effect_vecs)
+    pre_tr_rmspes = np.asarray(pre_tr_rmspes).ravel()
+    pre_c_rmspes = np.asarray(pre_c_rmspes).ravel()
+
+    def unit_stats(effects, rmspes):
+        ##Get the joint effects
+        joint_effects = np.sqrt(np.mean(np.square(effects), axis=1))
+        ## Standardized effect vecs
+        std_effects = effects / rmspes[:, None]
+        ##Get the standardized joint effects
+        joint_std_effects = joint_effects / rmspes
+        return np.hstack((effects, std_effects, joint_effects[:, None], joint_std_effects[:, None]))
+
+    #Compute the outcomes for treatment
+    observed = np.mean(unit_stats(effect_vecs, pre_tr_rmspes), axis=0)
+    return observed, unit_stats(control_effect_vecs, pre_c_rmspes)
+
+def _gathered_means(stats, index_blocks):
+    """ Yields the placebo means for each block of combinations (index matrices) """
+    for block in index_blocks:
+        yield stats[block].mean(axis=1)
+
+def _revolving_door_means(stats, N1, block_size):
+    """ Yields the placebo means for every combination of N1 of the rows of
+        `stats`, in blocks, using running sums along the revolving-door order
+    """
+    return _revolving_door_block_means(stats, N1, _revolving_door_blocks(stats.shape[0], N1, block_size))
+
+def _revolving_door_block_means(stats, N1, blocks):
+    """ Yields the placebo means for each block from _revolving_door_blocks() """
+    for start, outs, ins in blocks:
+        sums = np.empty((len(outs) + 1, stats.shape[1]))
+        sums[0, :] = stats[start].sum(axis=0)
+        np.cumsum(stats[ins] - stats[outs], axis=0, out=sums[1:, :])
+        sums[1:, :] += sums[0, :]
+        yield sums / N1
+
+class _TailOrderStatistics(object):
+    """ Tracks the k smallest and the k largest values of each column of a
+        stream of blocks, in O(k) memory per column.  Blocks are buffered until
+        there are at least 2k rows, so the cost of the selection (a partition)
+        is amortized to O(1) per value.
+    """
+    def __init__(self, k, n_cols):
+        self.k = k
+        self.low = np.empty((0, n_cols))
+        self.high = np.empty((0, n_cols))
+        self._pending = []
+        self._n_pending = 0
+
+    def update(self, block):
+        """ Adds the rows of `block` to the stream """
+        self._pending.append(np.asarray(block))
+        self._n_pending += len(block)
+        if self._n_pending >= 2 * self.k:
+            self._reduce()
+
+    def merge(self, other):
+        """ Adds the values tracked by another instance (with the same k) """
+        other._reduce()
+        self._reduce()
+        self._select(np.vstack((self.low, other.low)), np.vstack((self.high, other.high)))
+
+    def _reduce(self):
+        if not self._pending:
+            return
+        low = np.vstack([self.low] + self._pending)
+        high = np.vstack([self.high] + self._pending)
+        self._pending, self._n_pending = [], 0
+        self._select(low, high)
+
+    def _select(self, low, high):
+        if low.shape[0] > self.k:
+            low = np.partition(low, self.k - 1, axis=0)[:self.k, :]
+        if high.shape[0] > self.k:
+            high = np.partition(high, high.shape[0] - self.k, axis=0)[-self.k:, :]
+        self.low, self.high = low, high
+
+    def kth_smallest(self, k=None):
+        """ the k-th smallest value of each column (k defaults to self.k) """
+        self._reduce()
+        if k is None or k == self.low.shape[0]:
+            return self.low.max(axis=0)
+        return np.partition(self.low, k - 1, axis=0)[k - 1, :]
+
+    def kth_largest(self, k=None):
+        """ the k-th largest value of each column (k defaults to self.k) """
+        self._reduce()
+        if k is None or k == self.high.shape[0]:
+            return self.high.min(axis=0)
+        return np.partition(self.high, self.high.shape[0] - k, axis=0)[self.high.shape[0] - k, :]
+
+def _wilson_stop(p_tol, p_tol_level):
+    """ Returns a sequential stopping rule for the random placebo draws: stop
+        once the two-sided `p_tol_level` Wilson score interval for every
+        p-value is no wider than +/- `p_tol`.
+    """
+    from scipy.stats import norm
+    z = norm.ppf(1 - (1 - p_tol_level) / 2.)
+    def stop(counts, n):
+        half_width = z / (n + z * z) * np.sqrt(counts * (n - counts) / float(n) + z * z / 4.)
+        return (half_width <= p_tol).all()
+    return stop
+
+def _placebo_counts(observed, mean_blocks, keep=None, out=None, tails=None, stop=None):
+    """ Counts, for each column, the placebos whose absolute mean statistic is
+        at least as large as the observed one.  (The joint statistics are
+        non-negative, so the absolute value makes no difference for them.)
+
+    :param observed: the observed statistics (length n_stats)
+    :param mean_blocks: an iterable of (n_placebos x n_stats) blocks of placebo means
+    :param keep: optional index of the columns whose placebo means should be stored in `out`
+    :param out: array with a row for each placebo, for the kept columns
+    :param tails: optional _TailOrderStatistics which is updated with the kept columns
+    :param stop: optional function of the counts and number of placebos so far,
+        which is called after each block and ends the loop when it returns True
+
+    :return: the counts and the number of placebos
+    """
+    abs_observed = np.abs(observed)
+    counts = np.zeros(len(observed), dtype=np.int64)
+    n = 0
+    for placebo_means in mean_blocks:
+        counts += (np.abs(placebo_means) >= abs_observed).sum(axis=0)
+        if out is not None:
+            out[n:n + len(placebo_means), :] = placebo_means[:, keep]
+        if tails is not None:
+            tails.update(placebo_means[:, keep])
+        n += len(placebo_means)
+        if stop is not None and stop(counts, n):
+            break
+    return counts, n
+
+def _seeded_placebo_chunk(stats, observed, N1, n, seed_seq, block_size, T1, ret_pl, k):
+    """ Draws n random placebos from the stream `seed_seq` and returns the
+        counts, the placebo effect vectors (if `ret_pl`) and the tail order
+        statistics (if k is not None)
+    """
+    random_sample = np.random.default_rng(seed_seq).random
+    placebo_effect_vecs = np.empty((n, T1)) if ret_pl else None
+    tails = None if k is None else _TailOrderStatistics(k, T1)
+    counts, _ = _placebo_counts(observed,
+                                _gathered_means(stats, _random_combination_blocks(stats.shape[0], N1, n, block_size, random_sample)),
+                                keep = np.arange(T1),
+                                out = placebo_effect_vecs,
+                                tails = tails)
+    if tails is not None:
+        tails._reduce()
+    return counts, placebo_effect_vecs, tails
+
+def _seeded_chunk_results(args, parallel, max_workers, worker_type, wave_size):
+    """ Yields the result of _seeded_placebo_chunk() for each element of
+        `args`, in order, computing up to `wave_size` of them at a time in a
+        worker pool if `parallel`
+    """
+    if not parallel or len(args) <= 1:
+        for a in args:
+            yield _seeded_placebo_chunk(*a)
+        return
+    from SparseSC.cross_validation import _new_worker_pool, _submit, _result
+    pool = _new_worker_pool(max_workers, worker_type)
+    promises = []
+    try:
+        for start in range(0, len(args), wave_size):
+            promises = [_submit(pool, _seeded_placebo_chunk, *a) for a in args[start:start + wave_size]]
+            for promise in promises:
+                yield _result(promise)
+    finally:
+        # if the stopping rule ended the draws, don't wait for the rest of the wave
+        for promise in promises:
+            promise.cancel()
+        pool.shutdown()
+
+def _seeded_placebo_counts(stats, observed, N1, comb_len, seed, block_size, T1,
+                           out, tails, parallel, max_workers, worker_type,
+                           stop=None, draws_per_stream=None):
+    """ Draws comb_len random placebos from independent streams spawned from
+        `seed` (one per `draws_per_stream` draws), optionally in a worker pool.
+        The counts and tails are merged exactly and in stream order, and the
+        placebo effect vectors are stored in stream order, so the results are
+        identical for a given seed regardless of the number of workers.
+
+        With a stopping rule (`stop`) the streams are merged one at a time and
+        the remaining streams are discarded once it returns True.
+
+    :return: the counts and the number of placebos drawn
+    """
+    if draws_per_stream is None:
+        draws_per_stream = _DRAWS_PER_STREAM
+    starts = list(range(0, comb_len, draws_per_stream))
+    sizes = [min(draws_per_stream, comb_len - start) for start in starts]
+    seed_seqs = np.random.SeedSequence(seed).spawn(len(starts))
+    k = None if tails is None else tails.k
+    args = [(stats, observed, N1, size, seed_seq, block_size, T1, out is not None, k)
+            for size, seed_seq in zip(sizes, seed_seqs)]
+    if stop is None:
+        wave_size = len(args)
+    else:
+        import multiprocessing
+        wave_size = max_workers if max_workers is not None else multiprocessing.cpu_count()
+
+    counts = np.zeros(len(observed), dtype=np.int64)
+    n = 0
+    results = _seeded_chunk_results(args, parallel, max_workers, worker_type, wave_size)
+    for size, (chunk_counts, chunk_pl, chunk_tails) in zip(sizes, results):
+        counts += chunk_counts
+        if out is not None:
+            out[n:n + size, :] = chunk_pl
+        if tails is not None:
+            tails.merge(chunk_tails)
+        n += size
+        if stop is not None and stop(counts, n):
+            break
+    results.close()
+    return counts, n
+
+def _placebo_combinations(N0, N1, max_n_pl, seed, block_size):
+    """ Enumerates (or draws) the placebo combinations once, so that they can
+        be replayed against each block of periods.  Random combinations are
+        drawn from the same streams as _seeded_placebo_counts(), so the
+        placebos are the same as for _gen_placebo_stats_from_diffs() with the
+        same seed.
+
+    :return: the number of placebos and a list of chunks, each a list of
+        blocks of combinations: revolving-door blocks (a single chunk, as
+        exact enumeration is serial) or index matrices (a chunk for each
+        random stream)
+    """
+    n_pl = _ncr(N0, N1)
+    if not (max_n_pl > 0 and n_pl > max_n_pl):
+        return n_pl, [list(_revolving_door_blocks(N0, N1, block_size))]
+    index_type = np.min_scalar_type(N0) # the stored indexes are a small fraction of the effects
+    starts = list(range(0, max_n_pl, _DRAWS_PER_STREAM))
+    chunks = []
+    for start, seed_seq in zip(starts, np.random.SeedSequence(seed).spawn(len(starts))):
+        random_sample = np.random.default_rng(seed_seq).random
+        size = min(_DRAWS_PER_STREAM, max_n_pl - start)
+        chunks.append([block.astype(index_type)
+                       for block in _random_combination_blocks(N0, N1, size, block_size, random_sample)])
+    return max_n_pl, chunks
+
+def _replayed_placebo_chunk(stats, observed, N1, blocks, n_keep, ret_pl, k):
+    """ _seeded_placebo_chunk() for a chunk of stored combinations (from
+        _placebo_combinations())
+    """
+    if isinstance(blocks[0], tuple):
+        n = sum(len(outs) + 1 for _, outs, _ in blocks)
+        mean_blocks = _revolving_door_block_means(stats, N1, blocks)
+    else:
+        n = sum(len(block) for block in blocks)
+        mean_blocks = _gathered_means(stats, blocks)
+    placebo_means = np.empty((n, n_keep)) if ret_pl else None
+    tails = None if k is None else _TailOrderStatistics(k, n_keep)
+    counts, _ = _placebo_counts(observed, mean_blocks,
+                                keep = np.arange(n_keep),
+                                out = placebo_means,
+                                tails = tails)
+    if tails is not None:
+        tails._reduce()
+    return counts, placebo_means, tails
+
+def _ci_indexes(comb_len, level):
+    """ The (0-based) positions of the lower and upper bounds of the
+        two-sided `level` interval in the sorted placebo distribution
+    """
+    #CI - All hypothetical true effects (beta0) that would not be reject at the certain level
+    # To test non-zero beta0, apply beta0 to get unexpected deviation beta_hat-beta0 and compare to permutation distribution
+    # This means that we take the level-bounds of the permutation distribution then "flip it around beta_hat"
+    # To make the math a bit nicer, I will reject a hypothesis if pval<=(1-level)
+    assert 0 <= level <= 1, "Use a level in [0,1]"
+    alpha = (1-level)
+    p2min = 2./comb_len
+    alpha_ind = int(max((1,round(alpha/p2min))))
+    return alpha_ind - 1, comb_len - alpha_ind
+
+def _gen_placebo_stats_from_diffs(effect_vecs, pre_tr_rmspes,
+                                  control_effect_vecs, pre_c_rmspes,
+                                  max_n_pl = 1000000, ret_pl = False, ret_CI=False, level=0.95,
+                                  block_size=None, seed=None, parallel=False, max_workers=None,
+                                  worker_type="process", p_tol=None, p_tol_level=0.99, n_pl_batch=1000):
+    """ Placebo inference for the effects of the treated units
+
+    :param effect_vecs: N1 x T1 matrix of post-period effects for the treated units
+    :param pre_tr_rmspes: pre-period RMSPE of each treated unit
+    :param control_effect_vecs: N0 x T1 matrix of post-period effects for the control units
+    :param pre_c_rmspes: pre-period RMSPE of each control unit
+    :param max_n_pl: If the number of combinations of N1 of the N0 controls
+        exceeds this, `max_n_pl` combinations are drawn at random, otherwise
+        every combination is enumerated (in revolving-door order)
+    :param ret_pl: If True, return the placebo effect vectors
+    :param ret_CI: If True, return confidence intervals for the effect vector.
+        Only the order statistics in the tails of the placebo distribution
+        are kept, so this doesn't require storing the placebo effect vectors.
+    :param level: level of the confidence intervals
+    :param block_size: number of combinations processed at a time (defaults to
+        a block of about 32MB)
+    :param seed: If not None, random placebos are drawn from independent
+        streams spawned from `numpy.random.SeedSequence(seed)` (rather than
+        the global numpy random state), and the results are identical for a
+        given seed regardless of `parallel` and `max_workers`
+    :param parallel: If True, the random placebo draws are spread across a
+        worker pool (exact enumeration is always serial)
+    :param max_workers: number of workers in the pool
+    :param worker_type: "process" or "thread"
+    :param p_tol: If not None, random placebos are drawn in batches of
+        `n_pl_batch` and the draws stop (before `max_n_pl`) once the
+        `p_tol_level` (Wilson score) confidence interval for every p-value
+        (per period, standardized, joint and joint standardized) is within
+        +/- `p_tol`.  The number of placebos drawn is returned as
+        `N_placebo`.  Exact enumeration is never stopped early.
+    :param p_tol_level: confidence level of the stopping rule
+    :param n_pl_batch: number of placebos drawn between checks of the stopping rule
+    """
+    effect_vecs = np.asarray(effect_vecs)
+    N1 = effect_vecs.shape[0]
+    T1 = effect_vecs.shape[1]
+    #ret_p1s=False
+
+    observed, stats = _stat_matrix(effect_vecs, pre_tr_rmspes, control_effect_vecs, pre_c_rmspes)
+    effect_vec = observed[:T1]
+
+    counts, comb_len, placebo_effect_vecs, tails = \
+            _placebo_pass(observed, stats, N1, T1, max_n_pl, ret_pl, level if ret_CI else None,
+                          block_size, seed, parallel, max_workers, worker_type,
+                          p_tol, p_tol_level, n_pl_batch)
+
+    p2s = counts[:T1].reshape((1,T1))/float(comb_len)
+    p2s_std = counts[T1:2*T1].reshape((1,T1))/float(comb_len)
+    joint_p = counts[2*T1]/float(comb_len)
+    joint_std_p = counts[2*T1+1]/float(comb_len)
+    #p2s = 2*p1s #Ficher 2-sided p-vals (less common)
+    if ret_CI:
+        CIs = _effect_CIs(effect_vec, tails, comb_len, level)
+    else:
+        CIs = None
+
+    ret_struct = SparseSCEstResults(EstResultCI(effect_vec, p2s, CIs), p2s_std, joint_p, joint_std_p, comb_len, placebo_effect_vecs)
+    return ret_struct
+
+def _effect_CIs(effect_vec, tails, comb_len, level):
+    """ The `level` confidence intervals for the effects, from the tails of
+        the placebo distribution
+    """
+    low_ind, high_ind = _ci_indexes(comb_len, level)
+    low_effect = tails.kth_smallest(low_ind + 1) #TODO: check with Stata about sort order
+    high_effect = tails.kth_largest(comb_len - high_ind)
+    if (np.sign(low_effect)==np.sign(high_effect)).any():
+        warnings.warn("CI doesn't containt effect. You might not have enough placebo effects.")
+    return np.vstack((effect_vec - high_effect, effect_vec - low_effect))
+
+def _placebo_pass(observed, stats, N1, n_keep, max_n_pl, ret_pl, ci_level,
+                  block_size, seed, parallel, max_workers, worker_type,
+                  p_tol, p_tol_level, n_pl_batch):
+    """ Runs the placebo enumeration (or random draws) for the columns of
+        `stats`, keeping the placebo means of the first `n_keep` columns (the
+        effects) if `ret_pl`, and their tails if `ci_level` is not None
+
+    :return: the counts, the number of placebos, the kept placebo means (or
+        None) and the _TailOrderStatistics (or None)
+    """
+    N0 = stats.shape[0]
+    keep = np.arange(n_keep)
+    n_pl = _ncr(N0, N1)
+    randomize = max_n_pl > 0 and n_pl > max_n_pl
+    comb_len = max_n_pl if randomize else n_pl
+    placebo_means = None
+    if ret_pl:
+        placebo_means = np.empty((comb_len,n_keep))
+    tails = None
+    if ci_level is not None:
+        # only the alpha tails of the placebo distribution are needed
+        low_ind, high_ind = _ci_indexes(comb_len, ci_level)
+        tails = _TailOrderStatistics(min(max(low_ind + 1, comb_len - high_ind), comb_len), n_keep)
+
+    stop = None
+    if randomize and p_tol is not None:
+        stop = _wilson_stop(p_tol, p_tol_level)
+
+    if randomize:
+        if block_size is None:
+            block_size = _default_block_size(N1, stats.shape[1])
+        if stop is not None:
+            block_size = min(block_size, n_pl_batch)
+        if seed is not None or parallel:
+            counts, n_drawn = _seeded_placebo_counts(stats, observed, N1, comb_len, seed, block_size, n_keep,
+                                                     placebo_means, tails, parallel, max_workers, worker_type,
+                                                     stop = stop,
+                                                     draws_per_stream = n_pl_batch if stop is not None else None)
+        else:
+            mean_blocks = _gathered_means(stats, _random_combination_blocks(N0, N1, comb_len, block_size, np.random.random_sample))
+            counts, n_drawn = _placebo_counts(observed, mean_blocks,
+                                              keep = keep,
+                                              out = placebo_means,
+                                              tails = tails,
+                                              stop = stop)
+        if n_drawn < comb_len:
+            # stopped early
+            comb_len = n_drawn
+            if ret_pl:
+                placebo_means = placebo_means[:comb_len, :]
+    else:
+        if block_size is None:
+            block_size = _default_block_size(1, stats.shape[1])
+        mean_blocks = _revolving_door_means(stats, N1, block_size)
+        counts, _ = _placebo_counts(observed, mean_blocks,
+                                    keep = keep,
+                                    out = placebo_means,
+                                    tails = tails)
+    return counts, comb_len, placebo_means, tails
+
+def _gen_placebo_stats_from_diff_blocks(diff_blocks, pre_tr_rmspes, pre_c_rmspes,
+                                        max_n_pl = 1000000, ret_pl = False, ret_CI=False, level=0.95,
+                                        block_size=None, seed=None, parallel=False, max_workers=None,
+                                        worker_type="process"):
+    """ _gen_placebo_stats_from_diffs() for post-period effects which arrive
+        in blocks of periods, so that only one block of effects (and the one
+        read ahead of it) is held in memory at a time.
+
+        The placebo combinations are enumerated (or drawn) once, when the
+        first block arrives, and replayed against each block: the counts,
+        tails and placebo effects of each block are accumulated in a single
+        pass over the stored combinations, whose size depends on the number
+        of placebos but not on the number of periods.  The sums of squares
+        for the joint statistics are accumulated as the blocks arrive, and
+        the joint statistics are tested in the same pass as the last block.
+
+    :param diff_blocks: an iterable of (N1 x b effects for the treated units,
+        N0 x b effects for the control units) for consecutive blocks of
+        post-periods
+    :param pre_tr_rmspes: pre-period RMSPE of each treated unit
+    :param pre_c_rmspes: pre-period RMSPE of each control unit
+
+    The remaining parameters are as in _gen_placebo_stats_from_diffs().  (If
+    random placebos are needed and `seed` is None, a seed is drawn from the
+    global numpy random state.)
+    """
+    pre_tr_rmspes = np.asarray(pre_tr_rmspes).ravel()
+    pre_c_rmspes = np.asarray(pre_c_rmspes).ravel()
+    N1, N0 = len(pre_tr_rmspes), len(pre_c_rmspes)
+    if seed is None and max_n_pl > 0 and _ncr(N0, N1) > max_n_pl:
+        # the same random placebos are needed for every block
+        seed = np.random.randint(np.iinfo(np.int32).max)
+
+    effect_vec, p2s, p2s_std, CIs, placebo_effect_vecs = [], [], [], [], []
+    tr_sum_squares, c_sum_squares = np.zeros(N1), np.zeros(N0)
+    T1 = 0
+    chunks = None
+    blocks = iter(diff_blocks)
+    block = next(blocks, None)
+    if block is None:
+        raise ValueError("there are no post-periods")
+    pool = None
+    if parallel:
+        from SparseSC.cross_validation import _new_worker_pool, _submit, _result
+        pool = _new_worker_pool(max_workers, worker_type)
+    try:
+        while block is not None:
+            effect_block, control_effect_block = (np.asarray(a) for a in block)
+            b = effect_block.shape[1]
+            T1 += b
+            tr_sum_squares += np.square(effect_block).sum(axis=1)
+            c_sum_squares += np.square(control_effect_block).sum(axis=1)
+
+            observed = np.hstack((effect_block.mean(axis=0), (effect_block / pre_tr_rmspes[:, None]).mean(axis=0)))
+            stats = np.hstack((control_effect_block, control_effect_block / pre_c_rmspes[:, None]))
+            block = next(blocks, None)
+            if block is None:
+                # THE LAST BLOCK: TEST THE JOINT EFFECTS IN THE SAME PASS
+                tr_joint_effects = np.sqrt(tr_sum_squares / T1)
+                c_joint_effects = np.sqrt(c_sum_squares / T1)
+                observed = np.hstack((observed, tr_joint_effects.mean(), (tr_joint_effects / pre_tr_rmspes).mean()))
+                stats = np.column_stack((stats, c_joint_effects, c_joint_effects / pre_c_rmspes))
+
+            if chunks is None:
+                randomize = max_n_pl > 0 and _ncr(N0, N1) > max_n_pl
+                if block_size is None:
+                    block_size = _default_block_size(N1 if randomize else 1, stats.shape[1])
+                comb_len, chunks = _placebo_combinations(N0, N1, max_n_pl, seed, block_size)
+                tails_k = None
+                if ret_CI:
+                    low_ind, high_ind = _ci_indexes(comb_len, level)
+                    tails_k = min(max(low_ind + 1, comb_len - high_ind), comb_len)
+
+            args = [(stats, observed, N1, chunk, b, ret_pl, tails_k) for chunk in chunks]
+            if pool is not None and len(args) > 1:
+                results = [_result(promise) for promise in
+                           [_submit(pool, _replayed_placebo_chunk, *a) for a in args]]
+            else:
+                results = (_replayed_placebo_chunk(*a) for a in args)
+            counts = np.zeros(len(observed), dtype=np.int64)
+            tails = None if tails_k is None else _TailOrderStatistics(tails_k, b)
+            placebo_means = []
+            for chunk_counts, chunk_pl, chunk_tails in results:
+                counts += chunk_counts
+                if ret_pl:
+                    placebo_means.append(chunk_pl)
+                if tails is not None:
+                    tails.merge(chunk_tails)
+
+            effect_vec.append(observed[:b])
+            p2s.append(counts[:b]/float(comb_len))
+            p2s_std.append(counts[b:2*b]/float(comb_len))
+            if ret_CI:
+                CIs.append(_effect_CIs(observed[:b], tails, comb_len, level))
+            if ret_pl:
+                placebo_effect_vecs.append(np.vstack(placebo_means))
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    effect_vec = np.hstack(effect_vec)
+    CIs = np.hstack(CIs) if ret_CI else None
+    return SparseSCEstResults(EstResultCI(effect_vec, np.hstack(p2s).reshape((1,T1)), CIs),
+                              np.hstack(p2s_std).reshape((1,T1)),
+                              counts[2*b]/float(comb_len),
+                              counts[2*b+1]/float(comb_len),
+                              comb_len,
+                              np.hstack(placebo_effect_vecs) if ret_pl else None)
@@ -1,20 +1,61 @@
 from SparseSC.fit_fold import fold_v_matrix
 from SparseSC.fit_loo import loo_v_matrix
 from SparseSC.fit_ct import ct_v_matrix
+from SparseSC.autotune import autotune as _autotune, ExecutionPlan
+from SparseSC.utils.validation import as_float_array
+from SparseSC.utils.sparse_matrix import row_stack
+from SparseSC.utils.pruning import active_covariates
+from SparseSC.utils.result_cache import fingerprint, as_result_cache
+from collections import namedtuple
 import numpy as np
 
-def tensor(X, Y, X_treat=None, Y_treat=None, grad_splits=None, **kwargs):
+CompactTensor = namedtuple("CompactTensor", "V active V_active X_active X_treat_active")
+CompactTensor.__doc__ = """ A fitted tensor matrix restricted to its active covariates, as
+    returned by `tensor(..., compact=True)`
+
+    :param V: the (K x K) tensor matrix
+    :param active: the index of the covariates with non-zero weight in V
+    :param V_active: V[active, active]
+    :param X_active: X[:, active] for the control units
+    :param X_treat_active: X_treat[:, active] for the treated units (or None)
+
+    The weights depend on the active covariates only, so repeated calls to
+    weights() can be made with `X_active` and `V_active` in place of the
+    full X and V (see SparseSC.utils.pruning).
+"""
+
+def tensor(X, Y, X_treat=None, Y_treat=None, grad_splits=None, autotune=False, quiet=False, dtype=np.float64,
+           compact=False, result_cache=None, **kwargs):
     """ Presents a unified api for ct_v_matrix and loo_v_matrix
+
+    :param autotune: If True, choose between leave-one-out and k-fold gradient
+        descent (i.e. `grad_splits`) using SparseSC.autotune.autotune() and
+        report the chosen plan.  A previously computed `ExecutionPlan` may also
+        be passed.
+    :param quiet: If True, the autotuned plan is not printed
+    :param dtype: floating point type (np.float64 or np.float32) used to fit
+        V.  With np.float32 the data, the control system and the solves take
+        half the memory (see SparseSC.utils.mixed_precision).
+    :param compact: If True, return a `CompactTensor` with the active
+        covariates and the matching columns of X and X_treat rather than V
+
+    :param result_cache: a SparseSC.utils.result_cache.ResultCache (or the
+        path of a cache directory) in which the result is looked up and stored
+
+    `X` and `X_treat` may be `scipy.sparse` matrices (see
+    SparseSC.utils.sparse_matrix).
     """
+    if result_cache is not None:
+        result_cache = as_result_cache(result_cache)
+        key = fingerprint("tensor", X, Y, X_treat, Y_treat, grad_splits, autotune, np.dtype(dtype).str, compact, kwargs)
+        result = result_cache.get(key)
+        if result is None:
+            result = tensor(X, Y, X_treat, Y_treat, grad_splits, autotune, quiet, dtype, compact, **kwargs)
+            result_cache.put(key, result)
+        return result
     # PARAMETER QC
-    try:
-        X = np.asmatrix(X)
-    except ValueError:  
-        raise ValueError("X is not coercible to a matrix")
-    try:
-        Y = np.asmatrix(Y)
-    except ValueError:  
-        raise ValueError("Y is not coercible to a matrix")
+    X = as_float_array(X, "X", dtype=dtype, accept_sparse=True)
+    Y = as_float_array(Y, "Y", dtype=dtype)
     if X.shape[1] == 0:
         raise ValueError("X.shape[1] == 0")
     if Y.shape[1] == 0:
@@ -25,14 +66,20 @@ def tensor(X, Y, X_treat=None, Y_treat=None, grad_splits=None, **kwargs):
     if X_treat is None != Y_treat is None: 
         raise ValueError("parameters `X_treat` and `Y_treat` must both be Matrices or None")
 
+    if autotune:
+        if not isinstance(autotune, ExecutionPlan):
+            autotune = _autotune(X, Y, kwargs.get("LAMBDA", 0), X_treat=X_treat, Y_treat=Y_treat, splits=None)
+        if not quiet:
+            print("Autotuned execution plan: %s" % (autotune,))
+        if X_treat is None:
+            grad_splits = autotune.grad_splits
+
     if X_treat is not None:
         # Fit the Treated units to the control units; assuming that Y contains pre-intervention outcomes:
 
         # PARAMETER QC
-        if not isinstance(X_treat, np.matrix):
-            raise TypeError("X_treat is not a matrix")
-        if not isinstance(Y_treat, np.matrix):
-            raise TypeError("Y_treat is not a matrix")
+        X_treat = as_float_array(X_treat, "X_treat", TypeError, dtype, accept_sparse=True)
+        Y_treat = as_float_array(Y_treat, "Y_treat", TypeError, dtype)
         if X_treat.shape[1] == 0:
             raise ValueError("X_treat.shape[1] == 0")
         if Y_treat.shape[1] == 0:
@@ -44,10 +91,11 @@ def tensor(X, Y, X_treat=None, Y_treat=None, grad_splits=None, **kwargs):
         # FIT THE V-MATRIX AND POSSIBLY CALCULATE THE L2_PEN_W
         # note that the weights, score, and loss function value returned here are for the in-sample predictions
         _, v_mat, _, _, _, _ = \
-                    ct_v_matrix(X = np.vstack((X,X_treat)),
+                    ct_v_matrix(X = row_stack(X,X_treat),
                                 Y = np.vstack((Y,Y_treat)),
                                 control_units = np.arange(X.shape[0]),
                                 treated_units = np.arange(X_treat.shape[0]) + X.shape[0],
+                                dtype = dtype,
                                 **kwargs)
 
     else: 
@@ -61,6 +109,7 @@ def tensor(X, Y, X_treat=None, Y_treat=None, grad_splits=None, **kwargs):
                                  treated_units = np.arange(X.shape[0]),
                                  grad_splits = grad_splits,
                                  # treated_units = [X.shape[0] + i for i in  range(len(train))],
+                                 dtype = dtype,
                                  **kwargs)
 
         else:
@@ -70,5 +119,13 @@ def tensor(X, Y, X_treat=None, Y_treat=None, grad_splits=None, **kwargs):
                                  control_units = np.arange(X.shape[0]),
                                  treated_units = np.arange(X.shape[0]),
                                  # treated_units = [X.shape[0] + i for i in  range(len(train))],
+                                 dtype = dtype,
                                  **kwargs)
+    if compact:
+        active = active_covariates(v_mat)
+        return CompactTensor(V = v_mat,
+                             active = active,
+                             V_active = v_mat[np.ix_(active, active)],
+                             X_active = X[:, active],
+                             X_treat_active = None if X_treat is None else X_treat[:, active])
     return v_mat
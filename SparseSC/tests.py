@@ -1,6 +1,10 @@
 import unittest
 import numpy as np
 import random
+try:
+    from unittest import mock
+except ImportError:
+    import mock
 import SparseSC as SC
 
 def ge_dgp(N0,N1,T0,T1,K,S,R,groups,group_scale,beta_scale,confounders_scale,model= "full"):
@@ -132,6 +136,124 @@ class TestDGPs(unittest.TestCase):
 
         #self.failUnlessEqual(calc, truth)
 
+    def testBatchEffects(self):
+        N1, N0 = 4,30
+        T0,T1 = 8, 4
+        X_control, X_treated, Y_pre_control, Y_pre_treated, Y_post_control, Y_post_treated = factor_dgp(N0,N1,T0,T1,3,3,3)
+        Y_post = np.vstack( (Y_post_treated,Y_post_control, ) )
+        X = np.vstack( (X_treated, X_control, ) )
+        Y_pre  = np.vstack( (Y_pre_treated, Y_pre_control, ) )
+        pool = list(range(N1, N1 + N0))
+
+        # treatment cohorts drawn from one control pool: a single fit of V
+        cohorts = [[0, 1], [2], [3]]
+        with SC.profile() as stats:
+            batch = SC.estimate_effects_batch(X, [(Y_pre, Y_post, cohort) for cohort in cohorts], control_units = pool,
+                                              V_penalty = 0, W_penalty = 0.001)
+        self.assertEqual(stats.fits, 1)
+        for cohort, result in zip(cohorts, batch):
+            rows = cohort + pool
+            single = SC.estimate_effects(X[rows], Y_pre[rows], Y_post[rows], list(range(len(cohort))),
+                                         V_penalty = 0, W_penalty = 0.001)
+            np.testing.assert_allclose(result.effect_vec_res.effect, single.effect_vec_res.effect)
+            np.testing.assert_allclose(result.effect_vec_res.p, single.effect_vec_res.p)
+        self.assertEqual(batch[1].N_placebo, N0)
+
+        # different outcomes over the same control pool share a (joint) fit too
+        with SC.profile() as stats:
+            batch = SC.estimate_effects_batch(X, [(Y_pre, Y_post, [0]), (Y_pre, 2 * Y_post, [1])], control_units = pool,
+                                              V_penalty = 0, W_penalty = 0.001)
+        self.assertEqual(stats.fits, 1)
+        self.assertEqual([r.effect_vec_res.effect.shape for r in batch], [(T1,), (T1,)])
+
+    def testStreamingEffects(self):
+        import os, tempfile
+        from SparseSC import placebo
+        N1, N0 = 2,12
+        T0,T1 = 8, 7
+        X_control, X_treated, Y_pre_control, Y_pre_treated, Y_post_control, Y_post_treated = factor_dgp(N0,N1,T0,T1,3,3,3)
+        Y_post = np.asarray(np.vstack( (Y_post_treated,Y_post_control, ) ))
+        X = np.asarray(np.vstack( (X_treated, X_control, ) ))
+        Y_pre  = np.asarray(np.vstack( (Y_pre_treated, Y_pre_control, ) ))
+        path = os.path.join(tempfile.mkdtemp(), "Y_post.npy")
+        np.save(path, Y_post)
+
+        # the weights are fit as in estimate_effects()
+        controls = list(range(N1, N0 + N1))
+        X_and_Y_pre = np.hstack((X, Y_pre))
+        V = SC.loo_v_matrix(X_and_Y_pre[controls], Y_post[controls], LAMBDA = 0, L2_PEN_W = 0.001)[1]
+        weights = SC.loo_weights(X_and_Y_pre, V, 0.001, treated_units = list(range(N0 + N1)), control_units = controls)
+
+        calls = []
+        def counted(fun):
+            def wrapper(*args):
+                calls.append(fun.__name__)
+                return fun(*args)
+            return wrapper
+
+        for max_n_pl in (1000000, 20):
+            single = SC.estimate_effects(X, Y_pre, Y_post, [0,1], V_penalty = 0, W_penalty = 0.001,
+                                         max_n_pl = max_n_pl, ret_CI = True, level = 0.5, seed = 7)
+            del calls[:]
+            with mock.patch.object(placebo, "_revolving_door_blocks", counted(placebo._revolving_door_blocks)), \
+                 mock.patch.object(placebo, "_random_combination_blocks", counted(placebo._random_combination_blocks)):
+                streamed = SC.estimate_effects_streaming(X, Y_pre, path, [0,1], weights, period_block = 3,
+                                                         max_n_pl = max_n_pl, ret_CI = True, level = 0.5, seed = 7)
+            # one pass over the placebos for the 3 blocks and the joint statistics
+            self.assertEqual(len(calls), 1)
+            self.assertEqual(streamed.N_placebo, single.N_placebo)
+            for a, b in ((streamed.effect_vec_res.effect, single.effect_vec_res.effect),
+                         (streamed.effect_vec_res.p, single.effect_vec_res.p),
+                         (streamed.effect_vec_res.ci, single.effect_vec_res.ci),
+                         (streamed.std_p, single.std_p),
+                         (streamed.joint_p, single.joint_p),
+                         (streamed.joint_std_p, single.joint_std_p)):
+                np.testing.assert_allclose(a, b)
+
+        # a pathlib.Path, and random placebos from several streams spread across a worker pool
+        import pathlib
+        draws_per_stream = placebo._DRAWS_PER_STREAM
+        placebo._DRAWS_PER_STREAM = 5
+        try:
+            runs = [SC.estimate_effects_streaming(X, Y_pre, pathlib.Path(path), [0,1], weights, period_block = 3,
+                                                  max_n_pl = 20, ret_CI = True, level = 0.5, seed = 7,
+                                                  placebo_parallel = worker_type is not None, placebo_max_workers = 2,
+                                                  placebo_worker_type = worker_type or "process")
+                    for worker_type in (None, "thread", "process")]
+        finally:
+            placebo._DRAWS_PER_STREAM = draws_per_stream
+        for par in runs[1:]:
+            np.testing.assert_array_equal(par.effect_vec_res.p, runs[0].effect_vec_res.p)
+            np.testing.assert_array_equal(par.effect_vec_res.ci, runs[0].effect_vec_res.ci)
+            self.assertEqual(par.joint_p, runs[0].joint_p)
+
+        self.assertRaises(ValueError, SC.estimate_effects_streaming, X, Y_pre, path, [0,1], None)
+        self.assertRaises(ValueError, SC.estimate_effects_streaming, X, Y_pre, path, [0,1], weights[:, 1:])
+
+    def testStreamingMemory(self):
+        import os, tempfile, tracemalloc
+        N1, N0, T0 = 2, 98, 10
+        np.random.seed(0)
+        X = np.random.normal(0,1,(N0 + N1, 3))
+        weights = np.full((N0 + N1, N0), 1./N0)
+        directory = tempfile.mkdtemp()
+
+        def peak(T1):
+            Y_pre_path = os.path.join(directory, "Y_pre%s.npy" % T1)
+            Y_post_path = os.path.join(directory, "Y_post%s.npy" % T1)
+            np.save(Y_pre_path, np.random.normal(0,1,(N0 + N1, T0)))
+            np.save(Y_post_path, np.random.normal(0,1,(N0 + N1, T1)))
+            tracemalloc.start()
+            try:
+                SC.estimate_effects_streaming(X, Y_pre_path, Y_post_path, [0,1], weights, period_block = 10)
+                return tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+
+        short, full = peak(20), peak(2000)
+        # peak memory grows by the per-period results, not the outcomes (1.6MB)
+        self.assertLess(full - short, 0.25 * (N0 + N1) * 2000 * 8)
+
     #Simulations
     #1) As T0 and N0 increases do 
     ##a) SC match actuals in terms of the factor loadings
@@ -140,6 +262,535 @@ class TestDGPs(unittest.TestCase):
     # Other Counterfactual prediction:
     ## a) Compare to SC (big N0, small T0, then SC; or many factors; should do bad) to basic time-series model
 
+class TestCVScoreIter(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        self.X = np.random.normal(0,1,(20,3))
+        self.Y = self.X[:, :1].dot(np.random.normal(0,1,(1,2))) + np.random.normal(0,0.1,(20,2))
+        self.LAMBDA = [0.01, 0.1]
+
+    def testFoldResults(self):
+        records = list(SC.CV_score_iter(self.X, self.Y, self.LAMBDA, splits = 2, quiet = True))
+        self.assertEqual(sorted((r.fold, r.lambda_index) for r in records), [(0, 0), (0, 1), (1, 0), (1, 1)])
+        for r in records:
+            self.assertEqual(r.LAMBDA, self.LAMBDA[r.lambda_index])
+            self.assertEqual(r.v_mat.shape, (3, 3))
+            self.assertGreater(r.l2_pen_w, 0)
+            self.assertGreaterEqual(r.seconds, 0)
+        totals = [sum(r.score for r in records if r.lambda_index == i) for i in range(2)]
+        np.testing.assert_allclose(totals, SC.CV_score(self.X, self.Y, self.LAMBDA, splits = 2, quiet = True))
+
+    def testParallelClose(self):
+        first = SC.CV_score_iter(self.X, self.Y, self.LAMBDA, splits = 4, quiet = True, parallel = True, max_workers = 2)
+        second = SC.CV_score_iter(self.X, self.Y, self.LAMBDA, splits = 4, quiet = True, parallel = True, max_workers = 2)
+        next(first)
+        next(second)
+        first.close() # cancels its outstanding folds and shuts down its own pool only
+        self.assertEqual(len(list(second)), 7)
+
+    def testFoldCopies(self):
+        from SparseSC import cross_validation
+        X_treat = np.random.normal(0,1,(6,3))
+        Y_treat = X_treat[:, :1].dot(np.random.normal(0,1,(1,2)))
+        LAMBDA = [0.001, 0.01, 0.1]
+        for fitter, kwargs in (("loo_v_matrix", {}),
+                               ("fold_v_matrix", {"grad_splits": 2}),
+                               ("ct_v_matrix", {"X_treat": X_treat, "Y_treat": Y_treat})):
+            fits = []
+            def recorded(fun):
+                def wrapper(**kw):
+                    fits.append(kw["X"])
+                    return fun(**kw)
+                return wrapper
+            with mock.patch.object(cross_validation, fitter, recorded(getattr(cross_validation, fitter))):
+                scores = SC.CV_score(self.X, self.Y, LAMBDA, splits = 2, quiet = True, **kwargs)
+            # the training data is copied (or stacked) once per fold, not once per fold and penalty
+            self.assertEqual(len(fits), 6)
+            self.assertEqual(len(set(id(X) for X in fits)), 2)
+            self.assertTrue(all(fits[i] is fits[i - i % 3] for i in range(6)))
+            self.assertEqual(len(scores), 3)
+
+class TestRacing(unittest.TestCase):
+    def testRacing(self):
+        np.random.seed(0)
+        X = np.random.normal(0,1,(30,4))
+        Y = X[:, :1].dot(np.random.normal(0,1,(1,3))) + np.random.normal(0,0.3,(30,3))
+        grid = [0.001, 0.01, 0.1, 1, 10, 100]
+        scores = SC.CV_score(X, Y, grid, splits = 3, quiet = True)
+        for parallel in (False, True):
+            race = SC.CV_score_racing(X, Y, grid, splits = 3, quiet = True, parallel = parallel, max_workers = 2)
+            self.assertEqual(race.best_lambda, grid[int(np.argmin(scores))])
+            self.assertLess(race.n_fits, len(grid) * 3)
+            self.assertEqual(race.n_fits, np.sum(~np.isnan(race.scores)))
+
+class TestPenaltySearch(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        self.X = np.random.normal(0,1,(30,4))
+        self.Y = self.X[:, :1].dot(np.random.normal(0,1,(1,2))) + np.random.normal(0,0.1,(30,2))
+
+    def testAdaptiveLambdaSearch(self):
+        result = SC.adaptive_lambda_search(self.X, self.Y, splits = 3, quiet = True)
+        # the initial sweep's minimum is at its lower edge, so the sweep is extended below it
+        self.assertLess(result.lambdas.min(), result.best_lambda)
+        self.assertLess(result.best_lambda, result.lambdas.max())
+        grid = np.exp(np.linspace(np.log(result.lambdas.min()), np.log(result.lambdas.max()), 25))
+        dense = SC.CV_score(self.X, self.Y, list(grid), splits = 3, quiet = True)
+        self.assertLessEqual(result.best_score, min(dense) * 1.01)
+
+    def testJointPenaltySearch(self):
+        grid = np.linspace(-3, 3, 3)
+        for parallel in (False, True):
+            result = SC.joint_penalty_search(self.X, self.Y, bounds = ((-3, 3),) * 2, splits = 2, n_grid = 3,
+                                             max_evals = 20, parallel = parallel, max_workers = 2, quiet = True)
+            on_grid = np.all(np.isin(np.round(result.points, 10), np.round(grid, 10)), axis = 1)
+            self.assertEqual(np.sum(on_grid), 9)
+            self.assertGreater(result.nfev, 9) # the pattern search scored some points
+            self.assertLessEqual(result.fun, result.scores[on_grid].min())
+            self.assertEqual(result.fun, result.scores.min())
+
+class TestAutotune(unittest.TestCase):
+    def testPlan(self):
+        from SparseSC.autotune import autotune, ExecutionPlan, _gradient_cost
+        # leave-one-out systems are larger than k-fold systems
+        _, _, loo_bytes = _gradient_cost(1000, 1000, 10)
+        _, _, fold_bytes = _gradient_cost(1000, 1000, 10, grad_splits=5)
+        self.assertTrue(fold_bytes < loo_bytes)
+
+        X = np.random.normal(0,1,(40,5))
+        Y = np.random.normal(0,1,(40,3))
+        plan = autotune(X, Y, [1.,10.], splits=4, memory_limit=1e9)
+        self.assertIsInstance(plan, ExecutionPlan)
+        self.assertIsNone(plan.grad_splits)
+        # too little memory for leave-one-out gradient descent
+        _, _, fold_bytes = _gradient_cost(30, 30, 5, grad_splits=10)
+        plan = autotune(X, Y, [1.,10.], splits=4, memory_limit=fold_bytes)
+        self.assertIsNotNone(plan.grad_splits)
+        self.assertRaises(ValueError, autotune, X, Y, [1.,10.], n_probe_evals=0)
+
+    def testParallelPlan(self):
+        from SparseSC import autotune as autotune_module
+        X = np.random.normal(0,1,(40,5))
+        Y = np.random.normal(0,1,(40,3))
+        LAMBDA = [0.001, 0.01, 0.1, 1., 10., 100.]
+        plan = lambda **kwargs: autotune_module.autotune(X, Y, LAMBDA, memory_limit=1e9, min_parallel_seconds=0, **kwargs)
+        with mock.patch.object(autotune_module.multiprocessing, "cpu_count", lambda: 10):
+            # 8 usable cores: 2 folds, each split into 4 chunks of (at most) 2 penalties
+            self.assertEqual(plan(splits=2)[:5], (True, "process", 8, None, 2))
+            # with a cached V each fold runs its penalties in order
+            self.assertEqual(plan(splits=2, cache=True)[:5], (True, "process", 2, None, None))
+            # large training sets share memory in threads
+            self.assertEqual(plan(splits=2, large_n=10).worker_type, "thread")
+            # a single fit (tensor()) isn't parallel
+            self.assertEqual(plan(splits=None)[:3], (False, "process", None))
+        with mock.patch.object(autotune_module.multiprocessing, "cpu_count", lambda: 1):
+            self.assertEqual(plan(splits=2)[:3], (False, "process", None))
+
+    def testEndToEnd(self):
+        import importlib
+        from SparseSC import cross_validation
+        from SparseSC.autotune import ExecutionPlan
+        tensor_module = importlib.import_module("SparseSC.tensor")
+        X = np.random.normal(0,1,(30,4))
+        Y = X[:, :1].dot(np.random.normal(0,1,(1,2))) + np.random.normal(0,0.1,(30,2))
+        X_treat = np.random.normal(0,1,(6,4))
+        Y_treat = X_treat[:, :1].dot(np.random.normal(0,1,(1,2)))
+        LAMBDA = [0.01, 0.1]
+        plans = []
+        def recorded(fun):
+            def wrapper(*args, **kwargs):
+                plans.append(fun(*args, **kwargs))
+                return plans[-1]
+            return wrapper
+
+        splits = [(np.arange(15, 30), np.arange(15)), (np.arange(15), np.arange(15, 30))]
+        with mock.patch.object(cross_validation, "_autotune", recorded(cross_validation._autotune)):
+            scores = SC.CV_score(X, Y, LAMBDA, splits = splits, quiet = True, autotune = True)
+        plan = plans[-1]
+        self.assertIsInstance(plan, ExecutionPlan)
+        self.assertEqual(plan.max_workers is None, not plan.parallel)
+        self.assertIn(plan.worker_type, ("process", "thread"))
+        self.assertIn(plan.grad_splits, (None, 10, 5, 3, 2))
+        self.assertGreater(plan.est_fold_seconds, 0)
+        self.assertGreater(plan.est_worker_bytes, 0)
+        # the same plan, given explicitly, gives the same scores
+        np.testing.assert_allclose(SC.CV_score(X, Y, LAMBDA, splits = splits, quiet = True, autotune = plan), scores)
+
+        treated_splits = [(np.arange(3, 6), np.arange(3)), (np.arange(3), np.arange(3, 6))]
+        scores = SC.CV_score(X, Y, LAMBDA, X_treat = X_treat, Y_treat = Y_treat, splits = treated_splits,
+                             quiet = True, autotune = True)
+        self.assertEqual(len(scores), 2)
+
+        with mock.patch.object(tensor_module, "_autotune", recorded(tensor_module._autotune)):
+            V = SC.tensor(X, Y, LAMBDA = 0.01, autotune = True, quiet = True)
+            V_treat = SC.tensor(X, Y, X_treat, Y_treat, LAMBDA = 0.01, autotune = True, quiet = True)
+        self.assertEqual((V.shape, V_treat.shape), ((4, 4), (4, 4)))
+        # a single fit is never parallel, and only the controls-only fit chooses grad_splits
+        self.assertEqual([p.parallel for p in plans[-2:]], [False, False])
+        self.assertIsNone(plans[-1].grad_splits)
+        np.testing.assert_allclose(SC.tensor(X, Y, LAMBDA = 0.01, grad_splits = plans[-2].grad_splits), V)
+
+class TestEstimator(unittest.TestCase):
+    def testWeights(self):
+        """ the cached factorization gives the same weights as ct_weights() """
+        N0, N1, K = 30, 4, 6
+        X = np.random.normal(0,1,(N0,K))
+        X_treat = np.random.normal(0,1,(N1,K))
+        Y = np.random.normal(0,1,(N0,5))
+        V = np.diag([0., 1., 0.5, 0., 2., 0.1])
+        model = SC.SyntheticControl(L2_PEN_W=0.1).fit(X, Y, X_treat, V=V)
+        np.testing.assert_allclose(model.active_, [1, 2, 4, 5])
+        weights = SC.ct_weights(np.asmatrix(np.vstack((X, X_treat))), V, 0.1,
+                                treated_units=np.arange(N1) + N0, control_units=np.arange(N0))
+        np.testing.assert_allclose(model.weights_, weights)
+        np.testing.assert_allclose(model.weights_for(X_treat[:2]), weights[:2])
+        np.testing.assert_allclose(model.effects(np.zeros((N1,5)), Y), -weights.dot(Y))
+        # a full V is rejected rather than silently reduced to its diagonal
+        self.assertRaises(ValueError, SC.SyntheticControl(L2_PEN_W=0.1).fit, X, Y, X_treat, V=V + 0.01)
+
+    def testFit(self):
+        X = np.random.normal(0,1,(20,3))
+        Y = np.random.normal(0,1,(20,2))
+        model = SC.SyntheticControl(LAMBDA=0.01, L2_PEN_W=0.1).fit(X, Y)
+        self.assertEqual(model.V_.shape, (3,3))
+        self.assertEqual(model.predict(Y, X[:2]).shape, (2,2))
+        self.assertRaises(ValueError, model.predict, Y)
+
+    def testIncrementalUpdates(self):
+        """ adding periods and control units matches refitting with the same V """
+        K = 4
+        X = np.random.normal(0,1,(25,K))
+        X_new = np.random.normal(0,1,(3,K))
+        X_treat = np.random.normal(0,1,(2,K))
+        Y = np.random.normal(0,1,(28,3))
+        Y_more = np.random.normal(0,1,(28,2))
+        V = np.diag([1., 0., 0.5, 2.])
+        model = SC.SyntheticControl(L2_PEN_W=0.1).fit(X, Y[:25], X_treat, V=V)
+        model.add_periods(Y_more[:25]).add_controls(X_new, np.hstack((Y[25:], Y_more[25:])))
+        full = SC.SyntheticControl(L2_PEN_W=0.1).fit(np.vstack((X, X_new)), np.hstack((Y, Y_more)), X_treat, V=V)
+        np.testing.assert_allclose(model.cho_[0], full.cho_[0])
+        np.testing.assert_allclose(model.weights_, full.weights_)
+        np.testing.assert_allclose(model.synthetic_, full.synthetic_)
+
+    def testSaveLoad(self):
+        import tempfile
+        X = np.random.normal(0,1,(25,4))
+        X_treat = np.random.normal(0,1,(2,4))
+        Y = np.random.normal(0,1,(25,3))
+        model = SC.SyntheticControl(L2_PEN_W=0.1).fit(X, Y, X_treat, V=np.diag([1., 0., 0.5, 2.]))
+        path = tempfile.mkdtemp()
+        model.save(path)
+        loaded = SC.SyntheticControl.load(path)
+        self.assertIsInstance(loaded.cho_[0], np.memmap)
+        self.assertEqual(loaded.L2_PEN_W_, model.L2_PEN_W_)
+        np.testing.assert_array_equal(loaded.weights_, model.weights_)
+        np.testing.assert_array_equal(loaded.weights_for(X_treat), model.weights_for(X_treat))
+        np.testing.assert_array_equal(loaded.predict(Y), model.predict(Y))
+        self.assertRaises(ValueError, SC.SyntheticControl.load, tempfile.mkdtemp())
+
+class TestL2Path(unittest.TestCase):
+    def testL2Path(self):
+        from SparseSC.fit_fold import fold_score
+        X = np.random.normal(0,1,(20,4))
+        Y = np.random.normal(0,1,(20,3))
+        V = np.diag(np.random.random(4))
+        pens = [0.01, 1., 100.]
+        np.testing.assert_allclose(SC.ct_score(Y, X, V, pens, treated_units=[0,1,2]),
+                                   [SC.ct_score(np.asmatrix(Y), np.asmatrix(X), V, p, treated_units=[0,1,2]) for p in pens])
+        np.testing.assert_allclose(SC.loo_score(Y, X, V, pens),
+                                   [SC.loo_score(np.asmatrix(Y), np.asmatrix(X), V, p) for p in pens])
+        np.testing.assert_allclose(fold_score(Y, X, V, pens, grad_splits=4),
+                                   [fold_score(np.asmatrix(Y), np.asmatrix(X), V, p, grad_splits=4) for p in pens])
+
+    def testL2PathOptions(self):
+        from scipy import sparse
+        from SparseSC.fit_fold import fold_score
+        X = np.random.normal(0,1,(20,4))
+        Y = np.random.normal(0,1,(20,3))
+        V = np.diag(np.random.random(4))
+        pens = [0.01, 1., 100.]
+        for score, kwargs in ((SC.ct_score, {"treated_units": [0,1,2]}), (SC.loo_score, {}), (fold_score, {"grad_splits": 4})):
+            dense = score(Y, X, V, pens, **kwargs)
+            np.testing.assert_allclose(score(Y, sparse.csr_matrix(X), V, pens, **kwargs), dense)
+            np.testing.assert_allclose(score(Y, X, V, pens, dtype=np.float32, **kwargs), dense, rtol=1e-3)
+            self.assertRaises(ValueError, score, Y, X, V, pens, refine=1, **kwargs)
+            self.assertRaises(TypeError, score, Y, X, V, pens, no_such_option=1, **kwargs)
+
+class TestMixedPrecision(unittest.TestCase):
+    def testRefinedWeights(self):
+        X = np.random.normal(0,1,(40,4))
+        X_treat = np.random.normal(0,1,(5,4))
+        V = np.diag(np.random.random(4))
+        for kwargs in ({}, {"grad_splits": 4}, {"X_treat": X_treat}):
+            w64 = SC.weights(X, V = V, L2_PEN_W = 0.1, **kwargs)
+            w32 = SC.weights(X, V = V, L2_PEN_W = 0.1, dtype = np.float32, **kwargs)
+            np.testing.assert_allclose(w32, w64, atol=1e-3)
+            w32 = SC.weights(X, V = V, L2_PEN_W = 0.1, dtype = np.float32, refine = 3, **kwargs)
+            np.testing.assert_allclose(w32, w64, atol=1e-10)
+
+    def testFloat32Tensor(self):
+        X = np.random.normal(0,1,(30,4))
+        Y = X[:, :2].dot(np.random.normal(0,1,(2,3))) + np.random.normal(0,0.1,(30,3))
+        V64 = SC.tensor(X, Y, LAMBDA = 0.01, L2_PEN_W = 0.1, grad_splits = 3, quiet = True)
+        V32 = SC.tensor(X, Y, LAMBDA = 0.01, L2_PEN_W = 0.1, grad_splits = 3, quiet = True, dtype = np.float32)
+        # the optimizer may stop at a slightly different V, with the same fit
+        self.assertEqual(V32.dtype, np.float64)
+        np.testing.assert_allclose(SC.loo_score(Y, X, V32, 0.1), SC.loo_score(Y, X, V64, 0.1), rtol=1e-2)
+
+class TestCompactTensor(unittest.TestCase):
+    def testCompactWeights(self):
+        X = np.random.normal(0,1,(30,6))
+        Y = X[:, :2].dot(np.random.normal(0,1,(2,3))) + np.random.normal(0,0.1,(30,3))
+        model = SC.tensor(X, Y, LAMBDA = 0.1, grad_splits = 3, compact = True)
+        self.assertIsInstance(model, SC.CompactTensor)
+        np.testing.assert_array_equal(model.active, np.flatnonzero(np.diag(model.V)))
+        self.assertEqual(model.X_active.shape, (30, len(model.active)))
+        np.testing.assert_allclose(SC.weights(model.X_active, V = model.V_active, L2_PEN_W = 0.1),
+                                   SC.weights(X, V = model.V, L2_PEN_W = 0.1))
+        # the weights functions prune a full V themselves
+        V = np.diag([1., 0., 0., 2., 0., 0.5])
+        np.testing.assert_allclose(SC.ct_weights(X, V, 0.1, treated_units = [0, 1]),
+                                   SC.ct_weights(X[:, [0, 3, 5]], np.diag([1., 2., 0.5]), 0.1, treated_units = [0, 1]))
+
+class TestSparseCovariates(unittest.TestCase):
+    def testSparseMatchesDense(self):
+        from scipy import sparse
+        # two continuous covariates and a block of one-hot indicators
+        X = np.hstack((np.random.normal(0,1,(30,2)), np.eye(6)[np.random.randint(0,6,30)]))
+        Y = X.dot(np.random.normal(0,1,(8,2))) + np.random.normal(0,0.1,(30,2))
+        X_treat = np.hstack((np.random.normal(0,1,(4,2)), np.eye(6)[np.random.randint(0,6,4)]))
+        Y_treat = X_treat.dot(np.random.normal(0,1,(8,2)))
+        V = np.diag(np.random.random(8))
+        for kwargs in ({}, {"grad_splits": 3}, {"X_treat": X_treat}):
+            sparse_kwargs = dict(kwargs)
+            if "X_treat" in kwargs:
+                sparse_kwargs["X_treat"] = sparse.csr_matrix(X_treat)
+            np.testing.assert_allclose(SC.weights(sparse.csc_matrix(X), V = V, L2_PEN_W = 0.1, **sparse_kwargs),
+                                       SC.weights(X, V = V, L2_PEN_W = 0.1, **kwargs))
+        np.testing.assert_allclose(SC.get_max_lambda(sparse.csr_matrix(X), Y, X_treat = sparse.csr_matrix(X_treat), Y_treat = Y_treat),
+                                   SC.get_max_lambda(X, Y, X_treat = X_treat, Y_treat = Y_treat))
+        np.testing.assert_allclose(SC.get_max_lambda(sparse.csr_matrix(X), Y), SC.get_max_lambda(X, Y))
+        V_sparse = SC.tensor(sparse.csr_matrix(X), Y, LAMBDA = 0.01, grad_splits = 3)
+        self.assertEqual(V_sparse.shape, (8, 8))
+
+    def testSparseAutotune(self):
+        from scipy import sparse
+        from SparseSC.utils.sparse_matrix import nbytes
+        X = np.hstack((np.random.normal(0,1,(30,2)), np.eye(6)[np.random.randint(0,6,30)]))
+        Y = X.dot(np.random.normal(0,1,(8,2))) + np.random.normal(0,0.1,(30,2))
+        X_treat = np.hstack((np.random.normal(0,1,(4,2)), np.eye(6)[np.random.randint(0,6,4)]))
+        Y_treat = X_treat.dot(np.random.normal(0,1,(8,2)))
+        X_csr = sparse.csr_matrix(X)
+        self.assertEqual(nbytes(X_csr), X_csr.data.nbytes + X_csr.indices.nbytes + X_csr.indptr.nbytes)
+        self.assertEqual(SC.tensor(X_csr, Y, LAMBDA = 0.01, autotune = True, quiet = True).shape, (8, 8))
+        self.assertEqual(SC.tensor(X_csr, Y, sparse.csr_matrix(X_treat), Y_treat, LAMBDA = 0.01,
+                                   autotune = True, quiet = True).shape, (8, 8))
+
+class TestResultCache(unittest.TestCase):
+    def testCache(self):
+        import os, tempfile
+        from SparseSC.utils.result_cache import ResultCache, fingerprint
+        X = np.random.normal(0,1,(20,3))
+        Y = X[:, :1].dot(np.random.normal(0,1,(1,2))) + np.random.normal(0,0.1,(20,2))
+        cache = ResultCache(tempfile.mkdtemp())
+        scores = SC.CV_score(X, Y, LAMBDA = [0.01, 0.1], splits = 2, quiet = True, result_cache = cache)
+        self.assertEqual(len(os.listdir(cache.path)), 4) # one entry per fold and penalty
+        self.assertEqual(SC.CV_score(X, Y, LAMBDA = [0.01, 0.1], splits = 2, quiet = True, result_cache = cache), scores)
+        self.assertEqual(SC.get_max_lambda(X, Y, result_cache = cache), SC.get_max_lambda(X, Y))
+        self.assertNotEqual(fingerprint(X, 0.1), fingerprint(X, 0.2))
+        cache.max_bytes = 0
+        cache.put(fingerprint(X), X)
+        self.assertEqual(os.listdir(cache.path), [])
+
+class TestPanel(unittest.TestCase):
+    def testLoadPanel(self):
+        import os, csv, tempfile
+        X = np.random.normal(0,1,(6,2))
+        Y = np.random.normal(0,1,(6,5))
+        records = [(10 + i, 2000 + t, "y", Y[i, t]) for i in range(6) for t in range(5)] + \
+                  [(10 + i, 1999, "x%s" % k, X[i, k]) for i in range(6) for k in range(2)]
+        random.shuffle(records)
+        path = os.path.join(tempfile.mkdtemp(), "panel.csv")
+        with open(path, "w") as f:
+            writer = csv.writer(f)
+            writer.writerow(["unit", "time", "variable", "value"])
+            writer.writerows(records)
+        panel = SC.load_panel(path, "y", [11, 14], 2003, chunk_rows = 7)
+        np.testing.assert_array_equal(panel.treated_units, [1, 4])
+        np.testing.assert_array_equal(panel.control_units, [0, 2, 3, 5])
+        np.testing.assert_array_equal(panel.periods, np.arange(2000, 2005))
+        self.assertEqual(panel.covariates, [("x0", 1999), ("x1", 1999)])
+        np.testing.assert_allclose(panel.X, X)
+        np.testing.assert_allclose(panel.Y_pre, Y[:, :3])
+        np.testing.assert_allclose(panel.Y_post, Y[:, 3:])
+        self.assertTrue(panel.Y_post.flags.c_contiguous)
+        # a 2-d numeric array with the variables coded as numbers
+        coded = np.array([(u, t, 0 if v == "y" else 1 + int(v[1]), x) for u, t, v, x in records])
+        np.testing.assert_array_equal(SC.load_panel(coded, 0, [11, 14], 2003, chunk_rows = 5).Y_pre, panel.Y_pre)
+        self.assertRaises(ValueError, SC.load_panel, coded[1:], 0, [11, 14], 2003)
+
+class TestImport(unittest.TestCase):
+    def testLazyImport(self):
+        """ `import SparseSC` is cheap and has no side effects; the public
+            names are loaded on first use
+        """
+        import os, sys, subprocess
+        code = ("import sys, time, locale\n"
+                "locale_before = locale.setlocale(locale.LC_ALL)\n"
+                "start = time.time()\n"
+                "import SparseSC\n"
+                "print(time.time() - start)\n"
+                "print(' '.join(m for m in sys.modules if m.split('.')[0] in ('numpy', 'scipy', 'sklearn', 'SparseSC')))\n"
+                "print(locale.setlocale(locale.LC_ALL) == locale_before)\n"
+                # importing the submodules of the same name (SparseSC.estimator
+                # imports SparseSC.tensor) doesn't shadow the functions
+                "SparseSC.SyntheticControl\n"
+                "import SparseSC.weights\n"
+                "print(SparseSC.tensor.__module__, SparseSC.weights.__module__)\n")
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        seconds, modules, same_locale, names = subprocess.check_output([sys.executable, "-c", code], env=env).decode().splitlines()
+        self.assertEqual(modules.split(), ["SparseSC"])
+        self.assertEqual(same_locale, "True")
+        self.assertEqual(names, "SparseSC.tensor SparseSC.weights")
+        self.assertLess(float(seconds), 0.5)
+
+    def testSubmoduleImports(self):
+        """ `import SparseSC.<submodule> as m` binds the submodule, except for
+            `tensor` and `weights`, which are the functions of the same name
+        """
+        import sys, types, importlib
+        import SparseSC.tensor as T
+        import SparseSC.weights as W
+        import SparseSC.estimator as E
+        self.assertIs(T, SC.tensor)
+        self.assertIs(W, SC.weights)
+        self.assertTrue(callable(T) and callable(W))
+        self.assertIsInstance(E, types.ModuleType)
+        self.assertIs(E, sys.modules["SparseSC.estimator"])
+        # the submodules themselves are still importable
+        for name in ("SparseSC.tensor", "SparseSC.weights"):
+            self.assertIsInstance(importlib.import_module(name), types.ModuleType)
+            self.assertIs(importlib.import_module(name), sys.modules[name])
+        from SparseSC.tensor import CompactTensor
+        self.assertIs(CompactTensor, SC.CompactTensor)
+
+class TestBenchmark(unittest.TestCase):
+    def testCompare(self):
+        from SparseSC.benchmark import run_benchmarks, compare
+        results = run_benchmarks([{"N0": 10, "N1": 3, "K": 4, "T": 4}], ["ct_weights", "get_max_lambda"], repeat = 1)
+        self.assertEqual([r["case"] for r in results], ["ct_weights", "get_max_lambda"])
+        self.assertEqual(results[0]["solves"], {"solve": 1})
+        self.assertGreater(results[1]["peak_bytes"], 0)
+        self.assertEqual(compare(results, results), [])
+        baseline = [dict(r, peak_bytes = r["peak_bytes"] // 2) for r in results]
+        self.assertEqual([r["metric"] for r in compare(results, baseline)], ["peak_bytes", "peak_bytes"])
+
+class TestInstrumentation(unittest.TestCase):
+    def testStats(self):
+        X = np.random.normal(0,1,(20,3))
+        Y = X[:, :1].dot(np.random.normal(0,1,(1,2))) + np.random.normal(0,0.1,(20,2))
+        opt = SC.loo_v_matrix(X, Y, LAMBDA = 0.01, L2_PEN_W = 1)[-1]
+        self.assertEqual(opt.stats.fits, 1)
+        self.assertGreater(opt.stats.iterations, 0)
+        self.assertGreater(opt.stats.grad_calls, 0)
+        self.assertGreaterEqual(opt.stats.solves, 20 * opt.stats.grad_calls)
+        self.assertEqual(opt.stats.max_solve_rows, 19)
+        with SC.profile() as stats:
+            SC.CV_score(X, Y, LAMBDA = [0.01, 0.1], splits = 2, quiet = True)
+        self.assertEqual(stats.fits, 4) # one per fold and penalty
+        self.assertGreater(stats.derivative_bytes, 0)
+
+class TestPlacebo(unittest.TestCase):
+    def testExactPlaceboPValues(self):
+        """ compare the block engine to a brute force loop over the combinations """
+        import itertools
+        from SparseSC.placebo import _gen_placebo_stats_from_diffs
+        N0, N1, T1 = 10, 3, 4
+        effect_vecs = np.random.normal(0,1,(N1,T1)) + 0.5
+        control_effect_vecs = np.random.normal(0,1,(N0,T1))
+        pre_tr_rmspes = np.random.random(N1) + 0.5
+        pre_c_rmspes = np.random.random(N0) + 0.5
+
+        res = _gen_placebo_stats_from_diffs(effect_vecs, pre_tr_rmspes, control_effect_vecs, pre_c_rmspes, block_size=7)
+
+        effect_vec = effect_vecs.mean(0)
+        joint_effect = np.sqrt(np.mean(np.square(effect_vecs), 1)).mean()
+        control_joint_effects = np.sqrt(np.mean(np.square(control_effect_vecs), 1))
+        p2s, joint_p, n = np.zeros(T1), 0, 0
+        for comb in itertools.combinations(range(N0), N1):
+            comb = list(comb)
+            p2s += abs(control_effect_vecs[comb,:].mean(0)) >= abs(effect_vec)
+            joint_p += control_joint_effects[comb].mean() >= joint_effect
+            n += 1
+        self.assertEqual(res.N_placebo, n)
+        np.testing.assert_allclose(res.effect_vec_res.p.ravel(), p2s / n)
+        self.assertAlmostEqual(res.joint_p, joint_p / float(n))
+
+    def testTailCI(self):
+        """ the CI from the tail order statistics matches the one from the sorted placebo effects """
+        from SparseSC.placebo import _gen_placebo_stats_from_diffs, _ci_indexes
+        N0, N1, T1 = 12, 2, 5
+        effect_vecs = np.random.normal(0,1,(N1,T1))
+        control_effect_vecs = np.random.normal(0,1,(N0,T1))
+        args = (effect_vecs, np.ones(N1), control_effect_vecs, np.ones(N0))
+        for level in (0.95, 0.5):
+            res = _gen_placebo_stats_from_diffs(*args, ret_pl=True, ret_CI=True, level=level, block_size=5)
+            low_ind, high_ind = _ci_indexes(res.N_placebo, level)
+            sorted_eff = np.sort(res.placebo_effect_vecs, axis=0)
+            np.testing.assert_allclose(res.effect_vec_res.ci,
+                                       np.vstack((effect_vecs.mean(0) - sorted_eff[high_ind, :],
+                                                  effect_vecs.mean(0) - sorted_eff[low_ind, :])))
+
+    def testSeededParallelPlacebos(self):
+        """ seeded random placebos don't depend on the number of workers """
+        from SparseSC import placebo
+        N0, N1, T1 = 30, 4, 3
+        args = (np.random.normal(0,1,(N1,T1)), np.ones(N1), np.random.normal(0,1,(N0,T1)), np.ones(N0))
+        draws_per_stream = placebo._DRAWS_PER_STREAM
+        placebo._DRAWS_PER_STREAM = 1000
+        try:
+            serial = placebo._gen_placebo_stats_from_diffs(*args, max_n_pl=5000, ret_pl=True, ret_CI=True, seed=123)
+            pars = [placebo._gen_placebo_stats_from_diffs(*args, max_n_pl=5000, ret_pl=True, ret_CI=True, seed=123,
+                                                          parallel=True, max_workers=3, worker_type="thread")]
+            with SC.profile(): # process workers return their counters with their results
+                pars.append(placebo._gen_placebo_stats_from_diffs(*args, max_n_pl=5000, ret_pl=True, ret_CI=True, seed=123,
+                                                                  parallel=True, max_workers=2, worker_type="process"))
+        finally:
+            placebo._DRAWS_PER_STREAM = draws_per_stream
+        for par in pars:
+            np.testing.assert_array_equal(serial.placebo_effect_vecs, par.placebo_effect_vecs)
+            np.testing.assert_array_equal(serial.effect_vec_res.p, par.effect_vec_res.p)
+            np.testing.assert_array_equal(serial.effect_vec_res.ci, par.effect_vec_res.ci)
+            self.assertEqual(serial.joint_p, par.joint_p)
+
+    def testPlaceboEarlyStopping(self):
+        """ random placebo draws stop once every p-value is within the tolerance """
+        from SparseSC.placebo import _gen_placebo_stats_from_diffs
+        N0, N1, T1 = 40, 5, 3
+        args = (np.random.normal(0,1,(N1,T1)) + 3, np.ones(N1), np.random.normal(0,1,(N0,T1)), np.ones(N0))
+        res = _gen_placebo_stats_from_diffs(*args, max_n_pl=100000, ret_pl=True, seed=1, p_tol=0.01, n_pl_batch=500)
+        self.assertTrue(res.N_placebo < 100000)
+        self.assertEqual(res.N_placebo % 500, 0)
+        self.assertEqual(res.placebo_effect_vecs.shape, (res.N_placebo, T1))
+        self.assertTrue(res.joint_p <= 0.01)
+
+    def testRevolvingDoor(self):
+        """ every combination is visited once, each differing from the last by a single swap """
+        import itertools
+        from SparseSC.placebo import _revolving_door_blocks
+        for n, t in ((6, 1), (7, 3), (8, 4), (5, 5)):
+            combs = []
+            for start, outs, ins in _revolving_door_blocks(n, t, 4):
+                comb = set(start)
+                combs.append(frozenset(comb))
+                for out, inn in zip(outs, ins):
+                    self.assertIn(out, comb)
+                    self.assertNotIn(inn, comb)
+                    comb = (comb - set([out])) | set([inn])
+                    combs.append(frozenset(comb))
+            self.assertEqual(set(combs), set(frozenset(c) for c in itertools.combinations(range(n), t)))
+            self.assertEqual(len(combs), len(set(combs)))
+
 if __name__ == '__main__':
     random.seed(12345)
     np.random.seed(10101)
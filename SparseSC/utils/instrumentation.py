@@ -0,0 +1,161 @@
+""" Counters for the hot paths of the fitting functions
+
+    Each fit of V (ct_v_matrix(), loo_v_matrix() and fold_v_matrix()) counts
+    in a FitStats, returned as `opt.stats`:
+
+    * the calls to (and inclusive time spent in) its score, gradient and
+      weights functions,
+    * the number and size (rows) of its linear solves,
+    * the bytes allocated for the partial derivatives of the weights, and
+    * the optimizer iterations.
+
+    The counters are always on: they cost a few integer increments per
+    solve, which is negligible next to the solve itself.  To aggregate them
+    across calls, e.g. over every fold and penalty of CV_score(), use the
+    opt-in profiler:
+
+        with profile() as stats:
+            CV_score(X, Y, LAMBDA, parallel=True)
+        print(stats.as_dict())
+
+    Within a profile() context the public weights functions, and hits and
+    misses of the result cache (see SparseSC.utils.result_cache), are counted
+    too.  Fits run in a process pool by CV_score() and joint_penalty_search()
+    are profiled in the worker and their counters are added to the parent's.
+"""
+import timeit
+import threading
+from contextlib import contextmanager
+
+timer = timeit.default_timer
+
+_COUNTERS = ("fits", "iterations",
+             "score_calls", "score_seconds", "grad_calls", "grad_seconds", "weights_calls", "weights_seconds",
+             "solves", "solve_rows", "max_solve_rows",
+             "derivative_bytes", "max_derivative_bytes",
+             "cache_hits", "cache_misses")
+
+class FitStats(object):
+    """ Counters for one or more fits
+
+    :param fits: number of fits of V
+    :param iterations: optimizer iterations
+    :param score_calls: calls to the score function (and likewise `grad_`
+        and `weights_`)
+    :param score_seconds: time spent in the score function, including the
+        calls it makes to the weights function (and likewise `grad_` and
+        `weights_`)
+    :param solves: calls to `linalg.solve()` (or the mixed precision solver)
+    :param solve_rows: total number of rows of the systems solved, so
+        `solve_rows / solves` is the mean system size
+    :param max_solve_rows: size of the largest system solved
+    :param derivative_bytes: total bytes allocated for the partial
+        derivatives, over all gradient evaluations
+    :param max_derivative_bytes: the largest number of bytes of partial
+        derivatives held at once
+    :param cache_hits: results read from the result cache
+    :param cache_misses: results computed and stored in the result cache
+    """
+    def __init__(self, **counts):
+        for name in _COUNTERS:
+            setattr(self, name, counts.pop(name, 0))
+        if counts:
+            raise TypeError("Unknown counters: %s" % ", ".join(sorted(counts)))
+
+    def timed(self, name, fun):
+        """ Returns `fun`, counting its calls and time in `<name>_calls` and
+            `<name>_seconds`
+        """
+        calls, seconds = name + "_calls", name + "_seconds"
+        def wrapped(*args, **kwargs):
+            start = timer()
+            try:
+                return fun(*args, **kwargs)
+            finally:
+                setattr(self, calls, getattr(self, calls) + 1)
+                setattr(self, seconds, getattr(self, seconds) + timer() - start)
+        return wrapped
+
+    def solver(self, solve):
+        """ Returns `solve(A, B)`, counting the solves and their sizes """
+        def counted(A, B, *args, **kwargs):
+            self.count_solve(A.shape[0])
+            return solve(A, B, *args, **kwargs)
+        return counted
+
+    def count_solve(self, rows):
+        self.solves += 1
+        self.solve_rows += rows
+        if rows > self.max_solve_rows:
+            self.max_solve_rows = rows
+
+    def count_derivatives(self, allocated, held):
+        """ Counts the bytes allocated for the partial derivatives in one
+            gradient evaluation, and the most held at once
+        """
+        self.derivative_bytes += allocated
+        if held > self.max_derivative_bytes:
+            self.max_derivative_bytes = held
+
+    def add(self, other):
+        """ Adds the counters of another FitStats """
+        for name in _COUNTERS:
+            if name.startswith("max_"):
+                setattr(self, name, max(getattr(self, name), getattr(other, name)))
+            else:
+                setattr(self, name, getattr(self, name) + getattr(other, name))
+        return self
+
+    def as_dict(self):
+        return dict((name, getattr(self, name)) for name in _COUNTERS)
+
+    def __repr__(self):
+        return "FitStats(%s)" % ", ".join("%s=%s" % (name, getattr(self, name)) for name in _COUNTERS)
+
+_profilers = []
+_lock = threading.Lock()
+
+@contextmanager
+def profile():
+    """ Aggregates the counters of every fit (in this process, or in a
+        process pool used by CV_score()) made within the context
+
+    :return: the FitStats to which the counters are added
+    """
+    stats = FitStats()
+    with _lock:
+        _profilers.append(stats)
+    try:
+        yield stats
+    finally:
+        with _lock:
+            _profilers.remove(stats)
+
+def profiling():
+    """ True within a profile() context """
+    return bool(_profilers)
+
+def report(stats):
+    """ Adds the counters of a finished fit to the active profilers """
+    if _profilers:
+        with _lock:
+            for profiler in _profilers:
+                profiler.add(stats)
+
+def count_weights(start, solve_rows):
+    """ Reports a call to a public weights function, which started at `start`
+        and solved systems of `solve_rows` rows, to the active profilers
+    """
+    if _profilers:
+        stats = FitStats(weights_calls=1, weights_seconds=timer() - start)
+        for rows in solve_rows:
+            stats.count_solve(rows)
+        report(stats)
+
+def call_profiled(fun, *args, **kwargs):
+    """ Calls `fun` in a profile() context (in a worker process) and returns
+        its result and the counters
+    """
+    with profile() as stats:
+        result = fun(*args, **kwargs)
+    return result, stats
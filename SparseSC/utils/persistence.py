@@ -0,0 +1,73 @@
+""" A versioned container for fitted results: a directory holding a JSON
+    header and one uncompressed .npy file per array
+
+    The arrays are stored as raw .npy files (rather than in a zipped .npz
+    archive) so they can be memory mapped when loaded.  Loading then costs
+    the same regardless of the size of the weights and factors, and the
+    pages of a model served by several processes are shared through the
+    page cache.
+
+    The header records the kind of result, the format version, the scalar
+    attributes and the file, dtype and shape of each array.  It is written
+    last, so a partially written container is never loaded.
+"""
+import os
+import json
+import numpy as np
+
+FORMAT_VERSION = 1
+_HEADER = "header.json"
+
+def save_arrays(path, kind, arrays, attrs):
+    """ Saves a fitted result
+
+    :param path: directory to write (created if it does not exist)
+    :param kind: the kind of result, checked by load_arrays()
+    :param arrays: dict of arrays (entries which are None are skipped)
+    :param attrs: dict of JSON serializable attributes
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    header_path = os.path.join(path, _HEADER)
+    if os.path.exists(header_path):
+        os.remove(header_path)
+    header = {"format": kind, "version": FORMAT_VERSION, "attrs": attrs, "arrays": {}}
+    for name, array in sorted(arrays.items()):
+        if array is None:
+            continue
+        array = np.ascontiguousarray(array)
+        file_name = name + ".npy"
+        np.save(os.path.join(path, file_name), array, allow_pickle=False)
+        header["arrays"][name] = {"file": file_name, "dtype": array.dtype.str, "shape": list(array.shape)}
+    with open(header_path, "w") as f:
+        json.dump(header, f, indent=2, sort_keys=True)
+
+def load_arrays(path, kind, mmap_mode="r"):
+    """ Loads a result saved by save_arrays()
+
+    :param path: the directory passed to save_arrays()
+    :param kind: the expected kind of result
+    :param mmap_mode: passed to `np.load()`; "r" (the default) memory maps
+        the arrays read-only, None reads them into memory
+
+    :raises ValueError: raised when `path` does not hold a result of the
+        given kind, or was written by a newer version of the format
+    :return: the attributes and a dict of arrays
+    """
+    header_path = os.path.join(path, _HEADER)
+    if not os.path.exists(header_path):
+        raise ValueError("%s does not contain a saved result" % (path,))
+    with open(header_path) as f:
+        header = json.load(f)
+    if header.get("format") != kind:
+        raise ValueError("%s contains a %s, not a %s" % (path, header.get("format"), kind))
+    if header.get("version", 0) > FORMAT_VERSION:
+        raise ValueError("%s was saved with format version %s; this version of SparseSC reads versions up to %s" %
+                         (path, header.get("version"), FORMAT_VERSION))
+    arrays = {}
+    for name, spec in header["arrays"].items():
+        array = np.load(os.path.join(path, spec["file"]), mmap_mode=mmap_mode, allow_pickle=False)
+        if list(array.shape) != spec["shape"] or array.dtype.str != spec["dtype"]:
+            raise ValueError("%s does not match the header of %s" % (spec["file"], path))
+        arrays[name] = array
+    return header["attrs"], arrays
@@ -0,0 +1,33 @@
+""" Most of the diagonal of a fitted tensor matrix (V) is zero, and the
+    covariates with zero weight drop out of the control system
+
+        X (V + V.T) X.T = X[:, active] (V + V.T)[active, active] X[:, active].T
+
+    so the weights (and scores and effects) for a fitted V are computed from
+    the active columns of X only, at a cost which scales with the number of
+    selected covariates rather than K.
+"""
+import numpy as np
+
+def active_covariates(V):
+    """ Returns the index of the covariates with non-zero weight in V, or
+        None if V is not diagonal
+    """
+    V = np.asarray(V)
+    v = np.diag(V)
+    if np.count_nonzero(V - np.diag(v)):
+        return None
+    return np.flatnonzero(v)
+
+def prune(X, V):
+    """ Drops the covariates with zero weight in a diagonal tensor matrix
+
+    :param X: Matrix of covariates (dense or sparse)
+    :param V: the tensor matrix
+    :return: X[:, active] and V[active, active], or X and V unchanged if V
+        is not diagonal or every covariate is active
+    """
+    active = active_covariates(V)
+    if active is None or len(active) == X.shape[1]:
+        return X, V
+    return X[:, active], np.asarray(V)[np.ix_(active, active)]
@@ -0,0 +1,139 @@
+""" An opt-in, content-addressed cache of fitted results on the local disk
+
+    Results are keyed by a fingerprint (SHA-1) of everything which determines
+    them: the data, the units and splits, the penalties, the optimizer
+    settings and the package version.  Each result is stored in its own file
+    and a hit costs one read, so repeated calls to CV_score() (one entry per
+    fold and L1 penalty), get_max_lambda() and tensor() with identical inputs
+    return without re-running the optimization.
+
+    The cache is bounded: when the total size of the entries exceeds
+    `max_bytes`, the least recently used entries (by modification time,
+    which is touched on every hit) are evicted.  Entries are written to a
+    temporary file and renamed into place, so concurrent workers sharing a
+    cache directory never read a partial entry.
+"""
+import os
+import types
+import pickle
+import hashlib
+import threading
+import numpy as np
+from SparseSC.utils.sparse_matrix import issparse
+from SparseSC.utils.instrumentation import FitStats, report
+
+_SUFFIX = ".pkl"
+
+def _package_version():
+    from SparseSC import __version__
+    return __version__
+
+def fingerprint(*parts):
+    """ Returns a hex digest of the parts (arrays, sparse matrices, numbers,
+        strings, functions and nested lists, tuples and dicts of them) and
+        the package version
+    """
+    digest = hashlib.sha1()
+    _update(digest, (_package_version(),) + parts)
+    return digest.hexdigest()
+
+def _update(digest, obj):
+    if isinstance(obj, np.ndarray):
+        array = np.ascontiguousarray(obj)
+        digest.update(("ndarray %s %s;" % (array.dtype.str, array.shape)).encode("utf-8"))
+        digest.update(array.data if array.dtype != object else repr(array.tolist()).encode("utf-8"))
+    elif issparse(obj):
+        obj = obj.tocsr()
+        digest.update(("sparse %s;" % (obj.shape,)).encode("utf-8"))
+        for array in (obj.data, obj.indices, obj.indptr):
+            _update(digest, array)
+    elif isinstance(obj, dict):
+        digest.update(("dict %s;" % len(obj)).encode("utf-8"))
+        for key in sorted(obj, key = repr):
+            _update(digest, key)
+            _update(digest, obj[key])
+    elif isinstance(obj, (list, tuple)):
+        digest.update(("%s %s;" % (type(obj).__name__, len(obj))).encode("utf-8"))
+        for item in obj:
+            _update(digest, item)
+    elif isinstance(obj, (types.FunctionType, type)):
+        # the repr of a function includes its address, which differs between processes
+        digest.update(("function %s.%s;" % (obj.__module__, obj.__name__)).encode("utf-8"))
+    elif isinstance(obj, np.generic):
+        _update(digest, obj.item())
+    else:
+        digest.update(("%s %r;" % (type(obj).__name__, obj)).encode("utf-8"))
+
+class ResultCache(object):
+    """ A directory of cached results with a size cap and LRU eviction
+
+    :param path: the cache directory (created if it does not exist)
+    :param max_bytes: the maximum total size of the cached entries
+    """
+    def __init__(self, path, max_bytes=2 ** 30):
+        self.path = path
+        self.max_bytes = max_bytes
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+
+    def _file(self, key):
+        return os.path.join(self.path, key + _SUFFIX)
+
+    def get(self, key, default=None):
+        """ Returns the result stored under `key`, or `default` """
+        file_name = self._file(key)
+        try:
+            with open(file_name, "rb") as f:
+                value = pickle.load(f)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            report(FitStats(cache_misses=1))
+            return default
+        report(FitStats(cache_hits=1))
+        try:
+            os.utime(file_name, None) # mark as recently used
+        except OSError:
+            pass
+        return value
+
+    def put(self, key, value):
+        """ Stores a result and evicts the least recently used entries if
+            the cache is over its size cap
+        """
+        file_name = self._file(key)
+        tmp_name = "%s.%s.%s.tmp" % (file_name, os.getpid(), threading.current_thread().ident)
+        with open(tmp_name, "wb") as f:
+            pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+        getattr(os, "replace", os.rename)(tmp_name, file_name)
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith(_SUFFIX):
+                continue
+            file_name = os.path.join(self.path, name)
+            try:
+                stat = os.stat(file_name)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, file_name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, file_name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(file_name)
+            except OSError:
+                pass
+            total -= size
+
+def as_result_cache(result_cache):
+    """ Returns `result_cache` as a ResultCache (a path is opened with the
+        default size cap), or None
+    """
+    if result_cache is None or isinstance(result_cache, ResultCache):
+        return result_cache
+    return ResultCache(result_cache)
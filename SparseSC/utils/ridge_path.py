@@ -0,0 +1,38 @@
+""" For a fixed tensor matrix (V) the weights are the solution to
+
+        (G + 2 * L2_PEN_W * I) W = B0 + 2 * L2_PEN_W / N0
+
+    where G = X_c.dot(2V).dot(X_c.T) and B0 = X_c.dot(2V).dot(X_t.T).  The
+    only term that varies with L2_PEN_W is the ridge on the diagonal, so given
+    the eigendecomposition G = Q diag(lam) Q.T,
+
+        W = Q diag(1 / (lam + 2 * L2_PEN_W)) (Q.T B0 + 2 * L2_PEN_W / N0 * Q.T 1)
+
+    and the weights for any number of L2 penalties cost one O(N0^3)
+    decomposition plus O(N0^2 N1) per penalty, rather than one O(N0^3) solve
+    per penalty.
+"""
+import numpy as np
+
+def ridge_path_solve(G, B, L2_PEN_W, n=None):
+    """ Yields `linalg.solve(G + 2 * c * I, B + 2 * c / n)` for each value (c)
+        of `L2_PEN_W`, using a single eigendecomposition of `G`.
+
+    :param G: a symmetric, positive semi-definite matrix
+    :param B: a matrix (or vector) with the same number of rows as G
+    :param L2_PEN_W: an iterable of L2 penalties
+    :param n: the denominator of the intercept term (defaults to G.shape[0])
+    """
+    G = np.asarray(G)
+    B = np.asarray(B)
+    if n is None:
+        n = G.shape[0]
+    vector = B.ndim == 1
+    if vector:
+        B = B[:, None]
+    lam, Q = np.linalg.eigh(G)
+    QtB = Q.T.dot(B)
+    Qt1 = Q.T.sum(axis=1)[:, None]
+    for c in L2_PEN_W:
+        out = Q.dot((QtB + (2. * c / n) * Qt1) / (lam + 2. * c)[:, None])
+        yield out[:, 0] if vector else out
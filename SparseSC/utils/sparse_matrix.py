@@ -0,0 +1,75 @@
+""" Helpers which let the fitting functions take either a dense ndarray or a
+    `scipy.sparse` matrix of covariates
+
+    Covariates such as one-hot indicators are mostly zeros, so for a sparse X
+    the system X (V + V.T) X.T is computed by scaling the columns of X by the
+    diagonal of V and a sparse-sparse product, which costs time proportional
+    to the number of non-zero products rather than O(N^2 K), and the
+    gradient only ever holds a single dense column of X.  The system itself
+    (N0 x N0) is returned dense, as it is factored by a dense solver.
+
+    scipy.sparse is only imported to handle a sparse matrix, so dense
+    covariates never pay for loading it.
+"""
+import sys
+import numpy as np
+
+def issparse(X):
+    """ scipy.sparse.issparse(), without importing scipy.sparse (a sparse
+        matrix can only exist once scipy.sparse has been imported)
+    """
+    module = sys.modules.get("scipy.sparse")
+    return module is not None and module.issparse(X)
+
+def gram(X, VV, Z=None):
+    """ Returns X.dot(VV).dot(Z.T) as a dense ndarray
+
+    :param X: dense or sparse matrix of covariates
+    :param VV: a (K x K) matrix, usually diagonal
+    :param Z: dense or sparse matrix of covariates (defaults to X)
+    """
+    if Z is None:
+        Z = X
+    if not (issparse(X) or issparse(Z)):
+        return X.dot(VV).dot(Z.T)
+    from scipy import sparse
+    VV = np.asarray(VV)
+    v = np.diag(VV)
+    if np.count_nonzero(VV - np.diag(v)):
+        # general V: one dense (N x K) intermediate
+        XV = np.asarray(X.dot(VV))
+        return np.asarray(Z.dot(XV.T)).T
+    XV = sparse.csr_matrix(X).multiply(v).tocsr()
+    return np.asarray(XV.dot(sparse.csr_matrix(Z).T).todense())
+
+def column(X, k):
+    """ Returns the k-th column of X as a dense 1-d array (use a CSC matrix
+        for fast access to the columns of a sparse X)
+    """
+    if issparse(X):
+        return X[:, k].toarray().ravel()
+    return X[:, k]
+
+def row_stack(X, Z):
+    """ np.vstack() for dense or sparse matrices """
+    if issparse(X) or issparse(Z):
+        from scipy import sparse
+        return sparse.vstack((X, Z), format="csr")
+    return np.vstack((X, Z))
+
+def nbytes(X):
+    """ X.nbytes for dense or sparse X (the bytes of its stored entries and
+        their indexes)
+    """
+    if issparse(X):
+        X = X.tocsr()
+        return X.data.nbytes + X.indices.nbytes + X.indptr.nbytes
+    return np.asarray(X).nbytes
+
+def mean_var(X):
+    """ np.mean(np.var(X, axis = 0)) for dense or sparse X """
+    if issparse(X):
+        mean = np.asarray(X.mean(axis = 0)).ravel()
+        mean_sq = np.asarray(X.multiply(X).mean(axis = 0)).ravel()
+        return float(np.mean(mean_sq - mean ** 2))
+    return float(np.mean(np.var(X, axis = 0)))
@@ -35,7 +35,7 @@ def all_subinverses(x,eps=None):
         if eps is not None:
             if not (abs(out[k] - x[np.ix_(k_rng,k_rng)].I) < eps).all():
                 raise RuntimeError("Fast and brute force methods were not within epsilon (%s) for sub-matrix k = %s; max difference = %s" % 
-                                   (eps, k,  abs(xi_k - x[k_rng2].I).max(), ) )
+                                   (eps, k,  abs(out[k] - x[np.ix_(k_rng,k_rng)].I).max(), ) )
     return out
 
 def subinv_k(xi,k,eps=None):
@@ -99,15 +99,15 @@ if __name__ == "__main__":
         # create a sub-matrix that meets the matching criteria
         x = np.matrix(np.random.random((n,n,)))
         try:
-            zz = subinv(x,10e-10)
+            zz = all_subinverses(x,10e-10)
             break
         except:
             pass
     else:
-        print("Failed to generate a %sx%s matrix whose inverses are all within %s of the quick method")
+        print("Failed to generate a %sx%s matrix whose inverses are all within %s of the quick method" % (n, n, 10e-10))
 
 
-    k = 5
+    k = 2
     n_tests = 1000
 
     # =======================
@@ -153,19 +153,19 @@ if __name__ == "__main__":
 
     t0 = time.time()
     for i in range(100): 
-        zz = subinv(x,10e-10)
+        zz = all_subinverses(x,10e-10)
 
     t1 = time.time()
     slow_time = t1 - t0
-    print("Full set of inverses: brute force time (N = %s): %s", (n,t1 - t0))
+    print("Full set of inverses: brute force time (N = %s): %s" % (n,t1 - t0))
 
     t0 = time.time()
     for i in range(100): 
-        zz = subinv(x)
+        zz = all_subinverses(x)
 
     t1 = time.time()
     fast_time = t1 - t0
-    print("Full set of inverses: quick time (N = %s): %s", (n,t1 - t0))
+    print("Full set of inverses: quick time (N = %s): %s" % (n,t1 - t0))
 
     # ---------------------------------------------
     # ---------------------------------------------
@@ -0,0 +1,38 @@
+""" Parameter QC shared by the public entry points and the fitting functions
+
+    The public functions convert their data once, to C-contiguous float64
+    ndarrays, and the fitting functions work with ndarrays throughout.  The
+    conversion is a no-op for data which has already been converted, so the
+    same arrays (and views and index arrays into them) are handed down the
+    stack rather than a fresh `np.matrix` copy at every layer.
+"""
+import numpy as np
+from SparseSC.utils.sparse_matrix import issparse
+
+def as_float_array(X, name, error=ValueError, dtype=np.float64, accept_sparse=False):
+    """ Returns `X` as a 2-d, C-contiguous float64 (or `dtype`) ndarray,
+        without copying it if it already is one (a 1-d array is treated as a
+        single row, as by `np.asmatrix`).
+
+    :param X: array-like (including `np.matrix`)
+    :param name: name of the parameter, for the error message
+    :param error: the exception raised if X is not coercible to a matrix
+    :param dtype: the floating point type of the returned array
+    :param accept_sparse: If True, a `scipy.sparse` matrix is returned as a
+        CSR matrix (for fast access to the rows) rather than densified
+    """
+    if np.dtype(dtype) not in (np.float32, np.float64):
+        raise ValueError("dtype must be float32 or float64")
+    if accept_sparse and issparse(X):
+        if len(X.shape) != 2:
+            raise error("%s is not coercible to a matrix" % name)
+        return X.tocsr().astype(dtype, copy=False)
+    try:
+        X = np.ascontiguousarray(X, dtype=dtype)
+    except (ValueError, TypeError):
+        raise error("%s is not coercible to a matrix" % name)
+    if X.ndim == 1:
+        X = X[None, :]
+    elif X.ndim != 2:
+        raise error("%s is not coercible to a matrix" % name)
+    return X
@@ -1,17 +1,22 @@
 from SparseSC.fit_loo import loo_weights
 from SparseSC.fit_ct import ct_weights
 from SparseSC.fit_fold import fold_weights
+from SparseSC.utils.validation import as_float_array
+from SparseSC.utils.sparse_matrix import row_stack
 import numpy as np
 
 def weights(X, X_treat=None, grad_splits = None, **kwargs):
     """ Calculate synthetic control weights
+
+    Pass `dtype = np.float32` to build and factor the control system in
+    single precision, and `refine` (the number of steps of iterative
+    refinement) to recover float64-accurate weights; see
+    SparseSC.utils.mixed_precision.  `X` and `X_treat` may be `scipy.sparse`
+    matrices.
     """
 
     # PARAMETER QC
-    try:
-        X = np.asmatrix(X)
-    except ValueError:
-        raise TypeError("X is not coercible to a matrix")
+    X = as_float_array(X, "X", TypeError, accept_sparse=True)
 
     if X_treat is not None:
         # weight for the control units against the remaining controls:
@@ -20,16 +25,13 @@ def weights(X, X_treat=None, grad_splits = None, **kwargs):
             raise ValueError("X_treat.shape[1] == 0")
 
         # PARAMETER QC
-        try:
-            X_treat = np.asmatrix(X_treat)
-        except ValueError:
-            raise ValueError("X_treat is not coercible to a matrix")
+        X_treat = as_float_array(X_treat, "X_treat", accept_sparse=True)
         if X_treat.shape[1] == 0:
             raise ValueError("X_treat.shape[1] == 0")
 
         # FIT THE V-MATRIX AND POSSIBLY CALCULATE THE L2_PEN_W
         # note that the weights, score, and loss function value returned here are for the in-sample predictions
-        return ct_weights(X = np.vstack((X,X_treat)),
+        return ct_weights(X = row_stack(X,X_treat),
                           control_units = np.arange(X.shape[0]),
                           treated_units = np.arange(X_treat.shape[0]) + X.shape[0],
                           **kwargs)
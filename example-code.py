@@ -327,6 +327,20 @@ if __name__ == "__main__":
 
         print("DE optimized L2 Penalty: %s, DE optimized  L1 penalty: %s"  % (NEW_best_L1_penalty_ct, best_L2_penalty,) )
 
+    # -----------------------------------------------------------------
+    # Scoring a sweep of L2 Penalties for a fixed V matrix
+    # -----------------------------------------------------------------
+    if False:
+        # passing an array of L2 penalties to ct_score() / loo_score() costs a
+        # single eigendecomposition rather than one solve per penalty
+        L2_grid = L2_pen_start_ct * np.exp(np.linspace(-6,6,25))
+        L2_sweep_scores = SC.ct_score(X = np.vstack((X_control, X_treated,)),
+                                      Y = np.vstack((Y_post_control, Y_post_treated,)),
+                                      control_units = np.arange(X_control.shape[0]),
+                                      V = V_ct,
+                                      L2_PEN_W = L2_grid)
+        print("Best L2 Penalty for the fixed V matrix: %s" % (L2_grid[np.argmin(L2_sweep_scores)],))
+
     # -----------------------------------------------------------------
     # Optimization of the L2 Parameter alone
     # -----------------------------------------------------------------